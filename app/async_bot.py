@@ -0,0 +1,79 @@
+"""Update transport of the bot built on AsyncTeleBot.
+
+Updates are polled on an event loop and each one is handed to the bot of youtube_bot.py, which filters it, runs the
+middleware and the handler in the executor of HANDLER_THREADS threads. The handlers, quotas, batches, the download
+pipeline, message edits and the storage are the ones of youtube_bot.py; DBMessages run on the executor of AioDB
+instead of the DB thread.
+
+This is not a coroutine runtime: sends, edits, yt-dlp and ffmpeg run in threads like in youtube_bot.py, so the thread
+count still grows with the active jobs. What it saves is the polling thread and the idle DB thread.
+Run it instead of youtube_bot.py:  python async_bot.py
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from telebot import logger
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+
+import youtube_bot
+from config_parse import Config
+from database.aio_db_access import AioDB
+
+cfg = Config()
+log = logger
+
+
+class UpdateTransport(AsyncTeleBot):
+    """Polls on the event loop, the updates are processed by the bot of youtube_bot.py in handler_executor"""
+
+    async def process_new_updates(self, updates: List[Update]):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(handler_executor, youtube_bot.bot.process_new_updates, [update])
+                               for update in updates))
+
+
+########################################################################################################################
+# Application state. Nothing is started at import, create_app() builds it
+
+transport: Optional[UpdateTransport] = None
+handler_executor: Optional[ThreadPoolExecutor] = None
+
+
+def create_app() -> UpdateTransport:
+    """Build the shared application of youtube_bot with the AioDB adapter, without its polling threads"""
+    global transport, handler_executor
+    youtube_bot.create_app(db_queue=AioDB(), threaded=False)
+    handler_executor = ThreadPoolExecutor(max_workers=youtube_bot.HANDLER_THREADS, thread_name_prefix='handler')
+    transport = UpdateTransport(cfg.main.telegram_token)
+    return transport
+
+
+def shutdown():
+    """Handlers which are running finish first, they may still use the DB and the pipeline"""
+    if handler_executor is not None:
+        handler_executor.shutdown(wait=True)
+    youtube_bot.shutdown()
+
+
+def main():
+    if cfg.main.ingest_mode == 'webhook':
+        log.error('async_bot polls for updates, the webhook is served by youtube_bot.py')
+        return
+    create_app()
+    print(f'Elemental YouTube DL Tg Bot Version {youtube_bot.BOT_VERSION} (asyncio)')
+    log.info(f'Starting Elemental YouTube DL Tg Bot Version {youtube_bot.BOT_VERSION} (asyncio)')
+    try:
+        asyncio.run(transport.infinity_polling())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log.exception(e)
+    finally:
+        shutdown()
+        print('Quit')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import queue
+from typing import Optional
+
+from sqlalchemy import select
+from telebot import logger as log
+
+from database.async_db_access import DBMessage, DBCommand
+from database.schema import AudioCache
+
+
+def get_cached_file_id(db_request_queue: queue.Queue, source_key: str) -> Optional[str]:
+    """file_id of the audio already sent for this source by any worker, None if there is no one"""
+    query = (select(AudioCache.file_id).where(AudioCache.source_key == source_key)
+             .order_by(AudioCache.id.desc()).limit(1))
+    result_queue = queue.Queue(maxsize=1)
+    db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                         block=False)
+    try:
+        result = result_queue.get(block=True, timeout=10)
+    except queue.Empty as e:
+        log.exception(e)
+        return None
+    if not result:
+        return None
+    return result[0][0]
+
+
+def store_file_id(db_request_queue: queue.Queue, source_key: str, file_id: str, title: str = None):
+    db_request_queue.put(DBMessage(command=DBCommand.AddNew,
+                                   db_obj=AudioCache(source_key=source_key, file_id=file_id, title=title)),
+                         block=False)
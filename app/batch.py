@@ -0,0 +1,213 @@
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from telebot import TeleBot, logger as log
+from telebot.types import Message, InputMediaAudio
+
+from config_parse import Config, BotConfig
+from downloader import DownloadTask, after_upload
+from job_metrics import record_job
+from lang_support import BOT_MSG
+from link_router import RoutedLink, link_router
+from msg_editor import MSGMessage, MSGCommand
+from retry_policy import extractor_endpoint
+from storage_manager import StorageManager
+from utils import choose_language as lang, retry, retry_in_background, bot_answer_with_error, \
+    delete_file_from_server
+from ydl_pool import ydl_pool
+
+cfg: BotConfig = Config()
+
+
+def expand_links(bot: TeleBot, message: Message, routed_links: List[RoutedLink]) -> List[RoutedLink]:
+    """Playlists become their entries (flat extraction, no info of every video), at most batch_max_items.
+    A link of unknown type is probed the same way, it stays one item if it isn't a playlist"""
+    items: List[RoutedLink] = []
+    for routed in routed_links:
+        if len(items) >= cfg.advanced.batch_max_items:
+            break
+        if routed.is_playlist is False:
+            items.append(routed)
+            continue
+        with ydl_pool.acquire({'extract_flat': 'in_playlist'}) as ydl:
+            info = retry(ydl.extract_info)(routed.url, endpoint=extractor_endpoint(routed.extractor), gen_answer=True,
+                                           bot_obj=bot, download=False, tg_message_obj=message,
+                                           tg_error_msg=BOT_MSG[lang(message)]["error_getting_ydl_info"])
+        if routed.is_playlist is None and (info or {}).get('_type') not in ('playlist', 'multi_video'):
+            if info:
+                items.append(routed._replace(is_playlist=False))
+            continue
+        for entry in (info or {}).get('entries') or []:
+            if len(items) >= cfg.advanced.batch_max_items:
+                break
+            entry_url = (entry or {}).get('url') or (entry or {}).get('webpage_url')
+            entry_routed = link_router.route(entry_url) if entry_url else None
+            if entry_routed is not None and entry_routed.is_playlist is False:
+                items.append(entry_routed)
+    return items
+
+
+class _ItemProgress(object):
+    """msg_queue of one item, the batch shows its text in the common status message"""
+
+    def __init__(self, batch: 'BatchJob', index: int):
+        self.batch = batch
+        self.index = index
+
+    def put(self, message: MSGMessage, block=True, timeout=None):
+        if message.command == MSGCommand.Edit and message.message_str is not None:
+            # Edits with retry are steps (downloaded, converted), not progress ticks, they are not throttled
+            self.batch.item_progress(self.index, message.message_str, force=message.with_retry)
+
+
+class BatchJob(object):
+    """Playlist or several links of one message.
+
+    At most batch_concurrency items are in the pipeline at once, one status message shows the progress of the whole
+    batch. Results are sent in the order of the links, batch_group_size files per send_media_group"""
+
+    def __init__(self, bot: TeleBot, message: Message, bot_msg: Message, routed_links: List[RoutedLink],
+                 submit: Callable[[DownloadTask], None], msg_queue: queue.Queue, db_request_queue: queue.Queue,
+                 storage: StorageManager, on_finish: Callable[[DownloadTask], None] = None,
+                 on_done: Callable[[], None] = None, charge_bytes: Callable[[int, int], None] = None):
+        self.bot = bot
+        self.message = message
+        self.bot_msg = bot_msg
+        self.routed_links = routed_links
+        self.submit = submit
+        self.msg_queue = msg_queue
+        self.db_request_queue = db_request_queue
+        self.storage = storage
+        self.on_finish = on_finish
+        self.on_done = on_done
+        self.charge_bytes = charge_bytes
+        self.condition = threading.Condition()
+        self.tasks: List[DownloadTask] = []
+        self.done: Dict[int, bool] = {}
+        self.running = 0
+        self.progress_text = ''
+        self.previous_edit = 0.0
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name=f'batch-{self.message.chat.id}-{self.message.message_id}')
+        thread.start()
+        return thread
+
+    def item_progress(self, index: int, text: str, force=False):
+        with self.condition:
+            self.progress_text = f'#{index + 1} {text}'
+        self._show_progress(force=force)
+
+    def _item_done(self, index: int):
+        with self.condition:
+            self.done[index] = True
+            self.running -= 1
+            self.condition.notify_all()
+        self._show_progress(force=True)
+
+    def _show_progress(self, force=False):
+        now = time.time()
+        with self.condition:
+            if not force and now - self.previous_edit < 1.0:
+                return
+            self.previous_edit = now
+            text = (f'{BOT_MSG[lang(self.message)]["batch_progress"]} {len(self.done)}/{len(self.tasks)}\n'
+                    f'{self.progress_text}')
+        self.msg_queue.put(MSGMessage(command=MSGCommand.Edit, message_object=self.bot_msg, message_str=text,
+                                      with_retry=False), block=False)
+
+    def run(self):
+        try:
+            items = expand_links(self.bot, self.message, self.routed_links)
+            self._process(items)
+        except Exception as e:
+            log.exception(e)
+            bot_answer_with_error(self.bot, self.message, BOT_MSG[lang(self.message)]['file_sending_error'])
+        finally:
+            # Items which haven't been sent because the batch has failed
+            for task in self.tasks:
+                task.release_file()
+            retry_in_background(self.bot.delete_message)(self.bot_msg.chat.id, self.bot_msg.message_id)
+            if self.on_done is not None:
+                self.on_done()
+
+    def _process(self, items: List[RoutedLink]):
+        if not items:
+            retry_in_background(self.bot.send_message)(self.message.chat.id,
+                                                       BOT_MSG[lang(self.message)]["unsupported_link"])
+            return
+        for index, routed in enumerate(items):
+            task = DownloadTask(self.message, self.bot_msg, routed.url, routed.key,
+                                msg_queue=_ItemProgress(self, index),
+                                on_done=lambda success, i=index: self._item_done(i), time_range=routed.time_range)
+            task.batch = self
+            task.batch_index = index
+            if self.on_finish is not None:
+                task.on_finish(lambda t=task: self.on_finish(t))
+            self.tasks.append(task)
+        log.info(f'Batch of {len(self.tasks)} item(s) from {self.message.from_user.id} has started')
+        group_size = max(1, min(10, cfg.advanced.batch_group_size))
+        next_to_submit = 0
+        next_to_send = 0
+        while next_to_send < len(self.tasks):
+            while next_to_submit < len(self.tasks) and self.running < cfg.advanced.batch_concurrency:
+                with self.condition:
+                    self.running += 1
+                self.submit(self.tasks[next_to_submit])
+                next_to_submit += 1
+            with self.condition:
+                ready = 0
+                while next_to_send + ready < len(self.tasks) and self.done.get(next_to_send + ready):
+                    ready += 1
+                if next_to_send + ready < len(self.tasks):
+                    # Only full groups until the end of the batch
+                    ready -= ready % group_size
+                if not ready:
+                    self.condition.wait(timeout=5)
+                    continue
+            for start in range(next_to_send, next_to_send + ready, group_size):
+                self._send_group(self.tasks[start:min(start + group_size, next_to_send + ready)])
+            for task in self.tasks[next_to_send:next_to_send + ready]:
+                record_job(self.db_request_queue, task)
+            next_to_send += ready
+
+    def _send_group(self, tasks: List[DownloadTask]):
+        tasks = [t for t in tasks if t.success and (t.cached_file_id or t.file_path)]
+        if not tasks:
+            return
+        chat_id = self.message.chat.id
+
+        def send() -> List[Message]:
+            files = []
+            try:
+                media = []
+                for task in tasks:
+                    if task.cached_file_id is not None:
+                        media.append(InputMediaAudio(task.cached_file_id))
+                    else:
+                        files.append(open(task.file_path, 'rb'))
+                        media.append(InputMediaAudio(files[-1]))
+                if len(media) == 1:
+                    return [self.bot.send_audio(chat_id, audio=media[0].media, timeout=cfg.advanced.send_timeout)]
+                return self.bot.send_media_group(chat_id, media, timeout=cfg.advanced.send_timeout)
+            finally:
+                for file_object in files:
+                    file_object.close()
+
+        sent = retry(send)(endpoint='telegram', gen_answer=True, bot_obj=self.bot, tg_message_obj=self.message,
+                           tg_error_msg=BOT_MSG[lang(self.message)]['file_sending_error']) or []
+        for position, task in enumerate(tasks):
+            if task.cached_file_id is not None:
+                continue
+            sent_message: Optional[Message] = sent[position] if position < len(sent) else None
+            file_size = os.path.getsize(task.file_path) if os.path.isfile(task.file_path) else 0
+            task.success = False
+            after_upload(self.db_request_queue, self.storage, task, sent_message, file_size)
+            if task.success and self.charge_bytes is not None:
+                self.charge_bytes(task.message.from_user.id, file_size)
+            if not self.storage.enabled and not task.from_storage:
+                delete_file_from_server(task.file_path)
+            task.release_file()
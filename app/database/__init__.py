@@ -1,13 +1,72 @@
 import sys
+import threading
+from typing import Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text, Engine, Insert
+from sqlalchemy.dialects import postgresql, sqlite
+from database.history_fts import install_history_fts
 from database.schema import Base
 from telebot import logger as log
 
-try:
-    db_engine = create_engine('sqlite:///database.db')
-except Exception as e:
-    log.exception(e)
-    sys.exit(-1)
-else:
-    Base.metadata.create_all(db_engine)
+from config_parse import Config
+
+
+def _engine_options(dsn: str) -> dict:
+    if dsn.startswith('sqlite'):
+        # Timeout lets worker processes wait for the write lock of the shared file instead of failing
+        return {'connect_args': {'timeout': 30}}
+    return {'pool_pre_ping': True}
+
+
+def _add_missing_columns(engine: Engine):
+    """create_all doesn't touch existing tables, new nullable columns (and their indexes) are added here"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing and column.nullable]
+        if not missing:
+            continue
+        with engine.begin() as connection:
+            for column in missing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                log.info(f'Column {table.name}.{column.name} has been added')
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+_engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
+_history_fts_ready = False
+
+
+def get_engine() -> Engine:
+    """The engine is created at the first use (not at import), together with the schema and its migrations"""
+    global _engine, _history_fts_ready
+    with _engine_lock:
+        if _engine is not None:
+            return _engine
+        try:
+            dsn = Config().main.db_dsn
+            engine = create_engine(dsn, **_engine_options(dsn))
+        except Exception as e:
+            log.exception(e)
+            sys.exit(-1)
+        Base.metadata.create_all(engine)
+        _add_missing_columns(engine)
+        _history_fts_ready = install_history_fts(engine)
+        _engine = engine
+        return _engine
+
+
+def is_history_fts_ready() -> bool:
+    """False - no full-text index, the history search falls back to LIKE"""
+    get_engine()
+    return _history_fts_ready
+
+
+def dialect_insert(model) -> Insert:
+    """INSERT of the dialect of the engine, it has on_conflict_do_update (SQLite, PostgreSQL)"""
+    return (postgresql.insert if get_engine().dialect.name == 'postgresql' else sqlite.insert)(model)
@@ -0,0 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from database.async_db_access import DBCommand, DBMessage, execute_db_message
+
+
+class AioDB(object):
+    """DB adapter of the asyncio runtime in place of the DB thread. It takes the same DBMessages (put() like the
+    request queue), they run one by one on the executor thread, no thread polls a queue while the bot is idle"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aio-db')
+
+    def put(self, db_message: DBMessage, block=True, timeout=None):
+        if db_message.command is DBCommand.Quit:
+            self.close()
+            return
+        self._executor.submit(execute_db_message, db_message)
+
+    def close(self):
+        """Messages which have already been put are executed first"""
+        self._executor.shutdown(wait=True)
@@ -5,7 +5,7 @@ from queue import Queue
 from typing import List, Optional, Tuple, Sequence
 
 import telebot.types
-from database import db_engine
+from database import get_engine
 from database.schema import Base
 from sqlalchemy import Executable
 from sqlalchemy.orm import Session
@@ -19,6 +19,9 @@ class DBCommand(Enum):
     AddNew = auto()
     Insert = auto()
     Get_Admins = auto()
+    Execute = auto()
+    # Statements of execute_objs in one transaction
+    Transaction = auto()
     Quit = auto()
 
 
@@ -36,6 +39,90 @@ class DBMessage(object):
         self.kwargs = {**kwargs}
 
 
+def execute_db_message(db_message: DBMessage):
+    """Run one DBMessage (not Quit) and put the answer into its result_queue"""
+    if db_message.command is DBCommand.AddNew:
+        log.debug('Received AddNew command')
+        with Session(get_engine()) as session:
+            session.begin()
+            try:
+                session.add(db_message.db_obj)
+            except Exception as e:
+                log.exception(e)
+                session.rollback()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(False, timeout=3)
+            else:
+                session.commit()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(True, timeout=3)
+    if db_message.command == DBCommand.Select:
+        log.debug('Received select command')
+        with Session(get_engine()) as session:
+            session.expire_on_commit = False
+            try:
+                result = session.execute(db_message.execute_obj,
+                                         execution_options={"prebuffer_rows": True})
+
+            except Exception as e:
+                log.exception(e)
+                db_message.result_queue.put(None)
+            else:
+                # session.expunge_all()
+                db_message.result_queue.put(result.all(), block=False)
+
+    if db_message.command == DBCommand.Update:
+        log.debug('Received Insert command')
+        with Session(get_engine()) as session:
+            session.begin()
+            try:
+                session.execute(db_message.execute_obj, *db_message.args,
+                                execution_options={"prebuffer_rows": True})
+            except Exception as e:
+                log.exception(e)
+                session.rollback()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(False, timeout=3)
+            else:
+                session.commit()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(True, timeout=3)
+    if db_message.command in (DBCommand.Delete, DBCommand.Transaction):
+        log.debug(f'Received {db_message.command.name} command')
+        with Session(get_engine()) as session:
+            session.begin()
+            try:
+                for execute_obj in db_message.execute_objs:
+                    session.execute(execute_obj, execution_options={"prebuffer_rows": True})
+            except Exception as e:
+                log.exception(e)
+                session.rollback()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(False, timeout=3)
+            else:
+                session.commit()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(True, timeout=3)
+
+    if db_message.command == DBCommand.Execute:
+        # Statement in its own transaction, returns rows (e.g. UPDATE ... RETURNING) or the rowcount
+        log.debug('Received Execute command')
+        with Session(get_engine()) as session:
+            session.begin()
+            try:
+                result = session.execute(db_message.execute_obj, *db_message.args)
+                answer = result.all() if result.returns_rows else result.rowcount
+            except Exception as e:
+                log.exception(e)
+                session.rollback()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(None, timeout=3)
+            else:
+                session.commit()
+                if db_message.result_queue is not None:
+                    db_message.result_queue.put(answer, timeout=3)
+
+
 def db_consumer(q: Queue):
     log.info("BD consumer thread has started")
     while True:
@@ -43,69 +130,7 @@ def db_consumer(q: Queue):
         if incoming_db_message.command is DBCommand.Quit:
             log.debug('Received quit command')
             break
-        if incoming_db_message.command is DBCommand.AddNew:
-            log.debug('Received AddNew command')
-            with Session(db_engine) as session:
-                session.begin()
-                try:
-                    session.add(incoming_db_message.db_obj)
-                except Exception as e:
-                    log.exception(e)
-                    session.rollback()
-                    if incoming_db_message.result_queue is not None:
-                        incoming_db_message.result_queue.put(False, timeout=3)
-                else:
-                    session.commit()
-                    if incoming_db_message.result_queue is not None:
-                        incoming_db_message.result_queue.put(True, timeout=3)
-        if incoming_db_message.command == DBCommand.Select:
-            log.debug('Received select command')
-            with Session(db_engine) as session:
-                session.expire_on_commit = False
-                try:
-                    result = session.execute(incoming_db_message.execute_obj,
-                                             execution_options={"prebuffer_rows": True})
-
-                except Exception as e:
-                    log.exception(e)
-                    incoming_db_message.result_queue.put(None)
-                else:
-                    # session.expunge_all()
-                    incoming_db_message.result_queue.put(result.all(), block=False)
-
-        if incoming_db_message.command == DBCommand.Update:
-            log.debug('Received Insert command')
-            with Session(db_engine) as session:
-                session.begin()
-                try:
-                    session.execute(incoming_db_message.execute_obj, *incoming_db_message.args,
-                                    execution_options={"prebuffer_rows": True})
-                except Exception as e:
-                    log.exception(e)
-                    session.rollback()
-                    if incoming_db_message.result_queue is not None:
-                        incoming_db_message.result_queue.put(False, timeout=3)
-                else:
-                    session.commit()
-                    if incoming_db_message.result_queue is not None:
-                        incoming_db_message.result_queue.put(True, timeout=3)
-        if incoming_db_message.command == DBCommand.Delete:
-            log.debug('Received Delete command')
-            with Session(db_engine) as session:
-                session.begin()
-                try:
-                    for execute_obj in incoming_db_message.execute_objs:
-                        session.execute(execute_obj, execution_options={"prebuffer_rows": True})
-                except Exception as e:
-                    log.exception(e)
-                    session.rollback()
-                    if incoming_db_message.result_queue is not None:
-                        incoming_db_message.result_queue.put(False, timeout=3)
-                else:
-                    session.commit()
-                    if incoming_db_message.result_queue is not None:
-                        incoming_db_message.result_queue.put(True, timeout=3)
-
+        execute_db_message(incoming_db_message)
     log.info("BD consumer thread has closed")
 
 
@@ -128,6 +153,17 @@ def delete_items_with_result(db_q: queue.Queue, queries: List[Executable]) -> bo
     return True
 
 
+def execute_with_result(db_q: queue.Queue, query: Executable, timeout=10):
+    """Run a statement via the DB thread and wait for rows or rowcount, None if something went wrong"""
+    answer_queue = queue.Queue(maxsize=1)
+    db_q.put(DBMessage(command=DBCommand.Execute, execute_obj=query, result_queue=answer_queue), block=False)
+    try:
+        return answer_queue.get(block=True, timeout=timeout)
+    except queue.Empty as ex:
+        log.exception(ex)
+        return None
+
+
 def select_entries_and_count(entries_query: Executable, count_query: Executable, db_request_queue: queue.Queue) -> (
         Optional)[Tuple[Sequence[str], Sequence[int]]]:
     entries_queue = queue.Queue()
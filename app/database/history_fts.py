@@ -0,0 +1,42 @@
+from sqlalchemy import Engine, inspect, text
+from telebot import logger as log
+
+# External content FTS5 table over bot_history, the rows are kept by triggers on every insert, update and delete
+FTS_TABLE = 'bot_history_fts'
+FTS_COLUMNS = ('title', 'uploader', 'source_key', 'msg_text')
+
+_COLUMNS = ', '.join(FTS_COLUMNS)
+_NEW_VALUES = ', '.join(f'new.{c}' for c in FTS_COLUMNS)
+_OLD_VALUES = ', '.join(f'old.{c}' for c in FTS_COLUMNS)
+
+_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5({_COLUMNS}, content='bot_history', "
+    f"content_rowid='id')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON bot_history BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, {_COLUMNS}) VALUES (new.id, {_NEW_VALUES}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON bot_history BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_COLUMNS}) VALUES ('delete', old.id, {_OLD_VALUES}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF {_COLUMNS} ON bot_history BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_COLUMNS}) VALUES ('delete', old.id, {_OLD_VALUES}); "
+    f"INSERT INTO {FTS_TABLE}(rowid, {_COLUMNS}) VALUES (new.id, {_NEW_VALUES}); END",
+]
+
+
+def install_history_fts(engine: Engine) -> bool:
+    """Create the index and its triggers once, history written before them is indexed by a rebuild.
+    False - no full-text index (not SQLite or SQLite without FTS5), the search falls back to LIKE"""
+    if engine.dialect.name != 'sqlite':
+        return False
+    existed = inspect(engine).has_table(FTS_TABLE)
+    try:
+        with engine.begin() as connection:
+            for statement in _DDL:
+                connection.execute(text(statement))
+            if not existed:
+                connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    except Exception as e:
+        log.exception(e)
+        return False
+    if not existed:
+        log.info(f'{FTS_TABLE} has been created')
+    return True
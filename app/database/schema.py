@@ -1,8 +1,9 @@
 import datetime
+import json
 from typing import Optional, List
 
 import telebot.types
-from sqlalchemy import ForeignKey, DateTime, func
+from sqlalchemy import ForeignKey, DateTime, Text, func, select
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -98,10 +99,16 @@ class Chat(Base):
 
 
 class BotHistory(Base):
+    """Every link message, indexed for search by bot_history_fts (database.history_fts) on SQLite"""
     __tablename__ = "bot_history"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement='auto')
     msg_text: Mapped[str] = mapped_column(nullable=False)
     user_id: Mapped[str] = mapped_column(ForeignKey('telegram_user.id'))
+    # Canonical key of the media (link_router.RoutedLink.key), None for playlists and several links
+    source_key: Mapped[Optional[str]] = mapped_column(nullable=True, index=True)
+    # Resolved by the probe of the job (history_search.enrich_history)
+    title: Mapped[Optional[str]] = mapped_column(nullable=True)
+    uploader: Mapped[Optional[str]] = mapped_column(nullable=True)
     created_date: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True),
         server_default=func.now()
@@ -109,8 +116,208 @@ class BotHistory(Base):
     user: Mapped["TelegramUser"] = relationship(back_populates='history')
 
     @classmethod
-    def new_from_message_obj(cls, message: telebot.types.Message):
-        return BotHistory(
+    def new_from_message_obj(cls, message: telebot.types.Message, source_key: Optional[str] = None):
+        history = BotHistory(
             msg_text=message.text,
-            user_id=message.from_user.id
+            user_id=message.from_user.id,
+            source_key=source_key
+        )
+        if source_key is not None:
+            # A repeated media (answered from the caches, without a probe) takes the title of the previous request
+            for field in ('title', 'uploader'):
+                column = getattr(BotHistory, field)
+                setattr(history, field, select(column).where(BotHistory.source_key == source_key, column.isnot(None))
+                        .order_by(BotHistory.id.desc()).limit(1).scalar_subquery())
+        return history
+
+
+class JobStatus(str):
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class DownloadJob(Base):
+    """Job store entry, the frontend puts links here and worker processes claim them"""
+    __tablename__ = 'download_job'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement='auto')
+    status: Mapped[str] = mapped_column(nullable=False, default=JobStatus.queued, index=True)
+    link: Mapped[str] = mapped_column(nullable=False)
+    # Canonical key of the media (link_router.RoutedLink.key)
+    source_key: Mapped[str] = mapped_column(nullable=False, index=True)
+    # Concurrent jobs of a user are counted by it (quota)
+    user_id: Mapped[Optional[int]] = mapped_column(nullable=True, index=True)
+    # Time range of a clip in seconds (link_router.TimeRange), clip_end None means up to the end
+    clip_start: Mapped[Optional[int]] = mapped_column(nullable=True)
+    clip_end: Mapped[Optional[int]] = mapped_column(nullable=True)
+    # Raw telegram objects, workers restore Message objects from them
+    message_json: Mapped[str] = mapped_column(Text, nullable=False)
+    bot_msg_json: Mapped[str] = mapped_column(Text, nullable=False)
+    worker_id: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # A running job whose lease has expired belongs to a dead worker and can be claimed again
+    lease_until: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    progress_text: Mapped[Optional[str]] = mapped_column(nullable=True)
+    created_date: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+    @classmethod
+    def new_from_message_obj(cls, message: telebot.types.Message, bot_msg: telebot.types.Message, link: str,
+                             source_key: str):
+        return DownloadJob(
+            status=JobStatus.queued,
+            link=link,
+            source_key=source_key,
+            user_id=message.from_user.id,
+            message_json=json.dumps(message.json),
+            bot_msg_json=json.dumps(bot_msg.json)
         )
+
+    def __repr__(self) -> str:
+        return f'DownloadJob(id: {self.id}, status: {self.status}, worker_id: {self.worker_id}, link: {self.link})'
+
+
+class AudioCache(Base):
+    """file_id of already sent audio files, shared by all workers"""
+    __tablename__ = 'audio_cache'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement='auto')
+    source_key: Mapped[str] = mapped_column(nullable=False, index=True)
+    file_id: Mapped[str] = mapped_column(nullable=False)
+    title: Mapped[Optional[str]] = mapped_column(nullable=True)
+    created_date: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+    def __repr__(self) -> str:
+        return f'AudioCache(source_key: {self.source_key}, file_id: {self.file_id})'
+
+
+class StoredFile(Base):
+    """Converted file kept in mp3_dir of a host, storage_manager evicts the least recently used ones"""
+    __tablename__ = 'stored_file'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement='auto')
+    host: Mapped[str] = mapped_column(nullable=False, index=True)
+    source_key: Mapped[str] = mapped_column(nullable=False, index=True)
+    file_path: Mapped[str] = mapped_column(nullable=False)
+    size: Mapped[int] = mapped_column(nullable=False, default=0)
+    bitrate: Mapped[int] = mapped_column(nullable=False, default=0)
+    title: Mapped[Optional[str]] = mapped_column(nullable=True)
+    last_access: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+    created_date: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+    def __repr__(self) -> str:
+        return f'StoredFile(host: {self.host}, source_key: {self.source_key}, file_path: {self.file_path})'
+
+
+class UserQuota(Base):
+    """Per-user override of the role quota (config "quota" section), None - the role value is used, 0 - unlimited"""
+    __tablename__ = 'user_quota'
+    user_id: Mapped[int] = mapped_column(ForeignKey('telegram_user.id'), primary_key=True)
+    concurrent_jobs: Mapped[Optional[int]] = mapped_column(nullable=True)
+    jobs_per_hour: Mapped[Optional[int]] = mapped_column(nullable=True)
+    source_minutes_per_day: Mapped[Optional[int]] = mapped_column(nullable=True)
+    mb_per_day: Mapped[Optional[int]] = mapped_column(nullable=True)
+
+    def __repr__(self) -> str:
+        return f'UserQuota(user_id: {self.user_id})'
+
+
+class UserPreferences(Base):
+    """Settings a user has chosen, a missing row means the defaults"""
+    __tablename__ = 'user_preferences'
+    user_id: Mapped[int] = mapped_column(ForeignKey('telegram_user.id'), primary_key=True)
+    # auto, mp3, opus, aac (output_profile.PROFILE_PREFERENCES)
+    output_profile: Mapped[str] = mapped_column(nullable=False, default='auto')
+    # auto, on, off (output_profile.SPEECH_MODES)
+    speech_mode: Mapped[str] = mapped_column(nullable=False, default='off')
+
+    def __repr__(self) -> str:
+        return f'UserPreferences(user_id: {self.user_id}, output_profile: {self.output_profile})'
+
+
+class QuotaUsage(Base):
+    """Persisted quota counters, the current hour and day of every user"""
+    __tablename__ = 'quota_usage'
+    user_id: Mapped[int] = mapped_column(primary_key=True)
+    # UTC, YYYY-MM-DD
+    day: Mapped[str] = mapped_column(nullable=False)
+    # UTC hours since epoch
+    hour: Mapped[int] = mapped_column(nullable=False)
+    jobs_in_hour: Mapped[int] = mapped_column(nullable=False, default=0)
+    source_seconds: Mapped[int] = mapped_column(nullable=False, default=0)
+    bytes_sent: Mapped[int] = mapped_column(nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f'QuotaUsage(user_id: {self.user_id}, day: {self.day})'
+
+
+class JobMetrics(Base):
+    """One finished job (job_metrics.record_job), the statistics screen reads only the rollups below"""
+    __tablename__ = 'job_metrics'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement='auto')
+    user_id: Mapped[int] = mapped_column(nullable=False, index=True)
+    source_key: Mapped[str] = mapped_column(nullable=False)
+    # sent, cached (audio cache), storage (converted file on the disk), failed
+    outcome: Mapped[str] = mapped_column(nullable=False)
+    # Seconds of media which have been downloaded (the clip if there is a time range)
+    duration: Mapped[Optional[float]] = mapped_column(nullable=True)
+    bytes_in: Mapped[int] = mapped_column(nullable=False, default=0)
+    bytes_out: Mapped[int] = mapped_column(nullable=False, default=0)
+    bitrate: Mapped[int] = mapped_column(nullable=False, default=0)
+    profile: Mapped[Optional[str]] = mapped_column(nullable=True)
+    probe_sec: Mapped[float] = mapped_column(nullable=False, default=0)
+    download_sec: Mapped[float] = mapped_column(nullable=False, default=0)
+    transcode_sec: Mapped[float] = mapped_column(nullable=False, default=0)
+    upload_sec: Mapped[float] = mapped_column(nullable=False, default=0)
+    # From the submit to the end, with the waiting in the stage queues
+    total_sec: Mapped[float] = mapped_column(nullable=False, default=0)
+    created_date: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+    def __repr__(self) -> str:
+        return f'JobMetrics(user_id: {self.user_id}, source_key: {self.source_key}, outcome: {self.outcome})'
+
+
+class UserDailyStats(Base):
+    """Rollup of job_metrics per user per UTC day, updated in the same transaction as the metrics row"""
+    __tablename__ = 'user_daily_stats'
+    user_id: Mapped[int] = mapped_column(primary_key=True)
+    # UTC, YYYY-MM-DD
+    day: Mapped[str] = mapped_column(primary_key=True)
+    jobs: Mapped[int] = mapped_column(nullable=False, default=0)
+    failed: Mapped[int] = mapped_column(nullable=False, default=0)
+    # Answered from the audio cache or the storage
+    cache_hits: Mapped[int] = mapped_column(nullable=False, default=0)
+    source_seconds: Mapped[float] = mapped_column(nullable=False, default=0)
+    bytes_in: Mapped[int] = mapped_column(nullable=False, default=0)
+    bytes_out: Mapped[int] = mapped_column(nullable=False, default=0)
+    # Time of the stages, the capacity the jobs have used
+    work_seconds: Mapped[float] = mapped_column(nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f'UserDailyStats(user_id: {self.user_id}, day: {self.day}, jobs: {self.jobs})'
+
+
+class DailyStats(Base):
+    """Rollup of job_metrics per UTC day, the same counters as UserDailyStats"""
+    __tablename__ = 'daily_stats'
+    day: Mapped[str] = mapped_column(primary_key=True)
+    jobs: Mapped[int] = mapped_column(nullable=False, default=0)
+    failed: Mapped[int] = mapped_column(nullable=False, default=0)
+    cache_hits: Mapped[int] = mapped_column(nullable=False, default=0)
+    source_seconds: Mapped[float] = mapped_column(nullable=False, default=0)
+    bytes_in: Mapped[int] = mapped_column(nullable=False, default=0)
+    bytes_out: Mapped[int] = mapped_column(nullable=False, default=0)
+    work_seconds: Mapped[float] = mapped_column(nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f'DailyStats(day: {self.day}, jobs: {self.jobs})'
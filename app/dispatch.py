@@ -0,0 +1,151 @@
+import queue
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set, Tuple
+
+from telebot import TeleBot, logger as log
+from telebot.types import Message
+
+from batch import BatchJob, expand_links
+from downloader import DownloadTask
+from lang_support import BOT_MSG
+from job_store import enqueue_job, is_job_in_flight, count_active_jobs
+from link_router import RoutedLink
+from pipeline import Pipeline
+from quota import QuotaManager
+from storage_manager import StorageManager
+from utils import choose_language as lang, retry, retry_in_background
+
+
+class JobDispatcher(ABC):
+    """Decides where a link from download_file_from_link is processed"""
+
+    @abstractmethod
+    def is_in_flight(self, message: Message, routed: RoutedLink) -> bool:
+        """The same media has already been requested from this chat and is not finished yet"""
+
+    @abstractmethod
+    def active_jobs(self, user_id: int) -> int:
+        """Jobs of the user which are not finished yet (concurrent_jobs quota)"""
+
+    @abstractmethod
+    def dispatch(self, message: Message, bot_msg: Message, routed: RoutedLink) -> bool:
+        """False if the job couldn't be handed over"""
+
+    @abstractmethod
+    def dispatch_batch(self, message: Message, bot_msg: Message, routed_links: List[RoutedLink]) -> bool:
+        """Playlist or several links of one message"""
+
+
+class LocalDispatcher(JobDispatcher):
+    """Standalone mode, the link goes to the download pipeline of this process"""
+
+    def __init__(self, bot: TeleBot, pipeline: Pipeline, msg_queue: queue.Queue, db_request_queue: queue.Queue,
+                 storage: StorageManager, quota: QuotaManager = None):
+        self.bot = bot
+        self.pipeline = pipeline
+        self.msg_queue = msg_queue
+        self.db_request_queue = db_request_queue
+        self.storage = storage
+        self.quota = quota
+        self._lock = threading.Lock()
+        self._in_flight: Set[Tuple[int, str]] = set()
+        self._active_per_user: Dict[int, int] = {}
+
+    def is_in_flight(self, message: Message, routed: RoutedLink) -> bool:
+        with self._lock:
+            return (message.chat.id, routed.key) in self._in_flight
+
+    def active_jobs(self, user_id: int) -> int:
+        with self._lock:
+            return self._active_per_user.get(user_id, 0)
+
+    def _release_user(self, user_id: int):
+        count = self._active_per_user.get(user_id, 0) - 1
+        if count > 0:
+            self._active_per_user[user_id] = count
+        else:
+            self._active_per_user.pop(user_id, None)
+
+    def dispatch(self, message: Message, bot_msg: Message, routed: RoutedLink) -> bool:
+        in_flight_key = (message.chat.id, routed.key)
+        user_id = message.from_user.id
+        with self._lock:
+            self._in_flight.add(in_flight_key)
+            self._active_per_user[user_id] = self._active_per_user.get(user_id, 0) + 1
+
+        def on_done(success: bool):
+            with self._lock:
+                self._in_flight.discard(in_flight_key)
+                self._release_user(user_id)
+
+        task = DownloadTask(message, bot_msg, routed.url, routed.key, msg_queue=self.msg_queue, on_done=on_done,
+                            time_range=routed.time_range)
+        if self.quota is not None:
+            task.on_finish(lambda: self.quota.charge_task(task))
+        self.pipeline.submit(task)
+        return True
+
+    def dispatch_batch(self, message: Message, bot_msg: Message, routed_links: List[RoutedLink]) -> bool:
+        # The whole batch is one job of the user
+        user_id = message.from_user.id
+        with self._lock:
+            self._active_per_user[user_id] = self._active_per_user.get(user_id, 0) + 1
+
+        def on_done():
+            with self._lock:
+                self._release_user(user_id)
+
+        BatchJob(self.bot, message, bot_msg, routed_links, self.pipeline.submit, self.msg_queue,
+                 self.db_request_queue, self.storage,
+                 on_finish=self.quota.charge_task if self.quota is not None else None, on_done=on_done,
+                 charge_bytes=(lambda uid, size: self.quota.charge(uid, bytes_sent=size))
+                 if self.quota is not None else None).start()
+        return True
+
+
+class JobStoreDispatcher(JobDispatcher):
+    """Frontend mode, the link goes to the job store and any worker on any host takes it"""
+
+    def __init__(self, bot: TeleBot, db_request_queue: queue.Queue):
+        self.bot = bot
+        self.db_request_queue = db_request_queue
+
+    def is_in_flight(self, message: Message, routed: RoutedLink) -> bool:
+        return is_job_in_flight(self.db_request_queue, message.chat.id, routed.key)
+
+    def active_jobs(self, user_id: int) -> int:
+        return count_active_jobs(self.db_request_queue, user_id)
+
+    def dispatch(self, message: Message, bot_msg: Message, routed: RoutedLink) -> bool:
+        return enqueue_job(self.db_request_queue, message, bot_msg, routed.url, routed.key, routed.time_range)
+
+    def dispatch_batch(self, message: Message, bot_msg: Message, routed_links: List[RoutedLink]) -> bool:
+        """Every item is a separate job with its own status message, workers don't know about each other,
+        so the results come in the order they are ready"""
+
+        def run():
+            try:
+                for routed in expand_links(self.bot, message, routed_links):
+                    item_msg = retry(self.bot.send_message)(message.chat.id,
+                                                            BOT_MSG[lang(message)]['prepare_download'],
+                                                            reply_to_message_id=message.message_id,
+                                                            endpoint='telegram')
+                    if item_msg is not None:
+                        self.dispatch(message, item_msg, routed)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                retry_in_background(self.bot.delete_message)(bot_msg.chat.id, bot_msg.message_id, endpoint='telegram')
+
+        threading.Thread(target=run, name=f'batch-{message.chat.id}-{message.message_id}').start()
+        return True
+
+
+def make_dispatcher(run_mode: str, bot: TeleBot, pipeline: Optional[Pipeline], msg_queue: queue.Queue,
+                    db_request_queue: queue.Queue, storage: Optional[StorageManager] = None,
+                    quota: QuotaManager = None) -> JobDispatcher:
+    if run_mode == 'frontend':
+        # Workers charge the usage of the jobs they make
+        return JobStoreDispatcher(bot, db_request_queue)
+    return LocalDispatcher(bot, pipeline, msg_queue, db_request_queue, storage, quota)
@@ -0,0 +1,151 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+
+cfg: BotConfig = Config()
+
+# Limits of the running downloads are recalculated at most this often
+REBALANCE_SEC = 2.0
+# One HTTP range request takes about this long at the learned speed, a throttled stream gets short ranges
+CHUNK_SECONDS = 10
+MIN_CHUNK_SIZE = 2 ** 20
+# yt-dlp treats ratelimit 0 as no limit
+MIN_RATELIMIT = 16 * 1024
+# Weight of a new observation in the learned speed of an extractor
+RATE_SMOOTHING = 0.3
+# A download slower than this part of its limit is held back by its source, not by the budget ...
+SATISFIED_RATIO = 0.9
+# ... it keeps this much over its speed, the rest of the budget goes to the others
+HEADROOM = 1.25
+
+
+class DownloadJob(object):
+    """Throughput options of one download and its observed speed"""
+
+    def __init__(self, extractor: str, params: dict):
+        self.extractor = extractor
+        # Params of the YoutubeDL instance. yt-dlp reads ratelimit from them at every block (and every new
+        # fragment), a new limit is applied to the running download at once
+        self.params = params
+        self.speed: Optional[float] = None
+
+    @property
+    def connections(self) -> int:
+        return max(1, self.params.get('concurrent_fragment_downloads') or 1)
+
+    def set_ratelimit(self, limit: Optional[float]):
+        if limit is None or math.isinf(limit):
+            self.params.pop('ratelimit', None)
+        else:
+            self.params['ratelimit'] = max(MIN_RATELIMIT, int(limit))
+
+
+class DownloadTuner(object):
+    """Concurrent fragments, HTTP chunk size and rate limits of the downloads.
+
+    The speed of one connection is learned per extractor from the progress hooks. A new download gets as many
+    fragments as its share of the bandwidth budget needs at that speed and HTTP ranges of about CHUNK_SECONDS.
+    The budget of the host is shared between the running downloads (max-min fairness), the limits follow the
+    observed speeds every REBALANCE_SEC"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs: List[DownloadJob] = []
+        # extractor -> learned speed of one connection, bytes/s
+        self.rates: Dict[str, float] = {}
+        self._rebalanced = 0.0
+
+    @staticmethod
+    def _job_cap() -> Optional[float]:
+        return cfg.advanced.download_rate_limit_kb * 1024 or None
+
+    @staticmethod
+    def _budget() -> Optional[float]:
+        return cfg.advanced.download_bandwidth_kb * 1024 or None
+
+    def _job_params(self, extractor: str) -> dict:
+        fragments = max(1, cfg.advanced.concurrent_fragment_downloads)
+        chunk_size = cfg.advanced.http_chunk_size_mb * 2 ** 20
+        budget = self._budget()
+        share = budget / (len(self.jobs) + 1) if budget else None
+        target = min(filter(None, (share, self._job_cap())), default=None)
+        rate = self.rates.get(extractor)
+        if cfg.advanced.adaptive_download and rate:
+            if target:
+                fragments = min(fragments, max(1, math.ceil(target / rate)))
+            if chunk_size:
+                chunk_size = min(chunk_size, max(MIN_CHUNK_SIZE, int(rate * CHUNK_SECONDS)))
+        params = {'concurrent_fragment_downloads': fragments}
+        if chunk_size:
+            params['http_chunk_size'] = chunk_size
+        return params
+
+    def _rebalance(self):
+        """Water-filling: downloads which need less than an equal share get their need, the others split the rest.
+        Without a budget only the cap of a single download is applied"""
+        self._rebalanced = time.monotonic()
+        cap = self._job_cap() or math.inf
+        budget = self._budget()
+        if not budget:
+            for job in self.jobs:
+                job.set_ratelimit(cap)
+            return
+        demands = []
+        for job in self.jobs:
+            demand = cap
+            limit = job.params.get('ratelimit')
+            if cfg.advanced.adaptive_download and job.speed and limit and job.speed < limit * SATISFIED_RATIO:
+                demand = min(demand, job.speed * HEADROOM)
+            demands.append((demand, job))
+        demands.sort(key=lambda item: item[0])
+        remaining = budget
+        for position, (demand, job) in enumerate(demands):
+            limit = min(demand, remaining / (len(demands) - position))
+            remaining -= limit
+            job.set_ratelimit(limit)
+        log.debug(f'Download limits: {[job.params.get("ratelimit") for _, job in demands]} of {budget:.0f} B/s')
+
+    def _on_progress(self, job: DownloadJob, ydl_status: dict):
+        if ydl_status.get('status') != 'downloading' or not ydl_status.get('speed'):
+            return
+        with self.lock:
+            job.speed = ydl_status['speed']
+            limit = job.params.get('ratelimit')
+            # A download at its limit shows the limit, not what the source can give
+            if limit is None or job.speed < limit * SATISFIED_RATIO:
+                # Only DASH/HLS downloads use several connections
+                connections = job.connections if 'fragment_index' in ydl_status else 1
+                per_connection = job.speed / connections
+                rate = self.rates.get(job.extractor)
+                self.rates[job.extractor] = per_connection if rate is None else \
+                    rate + RATE_SMOOTHING * (per_connection - rate)
+            if time.monotonic() - self._rebalanced >= REBALANCE_SEC:
+                self._rebalance()
+
+    @contextmanager
+    def job(self, extractor: str, ydl) -> Iterator[DownloadJob]:
+        """Adds the throughput options and a progress hook to the YoutubeDL instance taken from the pool. It has to
+        be left before the instance goes back to the pool, the limits of the other jobs are not written into it then"""
+        job = DownloadJob(extractor, ydl.params)
+        with self.lock:
+            ydl.params.update(self._job_params(extractor))
+            self.jobs.append(job)
+            self._rebalance()
+        ydl.add_progress_hook(lambda ydl_status: self._on_progress(job, ydl_status))
+        log.debug(f'Download options of {extractor}: fragments {ydl.params["concurrent_fragment_downloads"]}, '
+                  f'chunk {ydl.params.get("http_chunk_size")}, limit {ydl.params.get("ratelimit")}')
+        try:
+            yield job
+        finally:
+            with self.lock:
+                self.jobs.remove(job)
+                self._rebalance()
+
+
+download_tuner = DownloadTuner()
@@ -0,0 +1,391 @@
+import os
+import queue
+import time
+from typing import Callable, Dict, List, Optional
+
+from telebot import TeleBot, logger as log
+from telebot.types import Message
+
+from audio_cache import get_cached_file_id, store_file_id
+from config_parse import Config, BotConfig
+from download_tuning import download_tuner
+from history_search import enrich_history
+from job_metrics import record_job
+from lang_support import BOT_MSG
+from link_router import TimeRange, link_router
+from msg_editor import get_download_progress_hook
+from output_profile import PROFILES, choose_profile, profile_of_file, variant_key, is_speech, speech_ffmpeg_args
+from pipeline import Pipeline, make_pipeline
+from preferences import get_preferences
+from ram_workdir import get_ram_work_dir, estimate_job_size
+from retry_policy import RetryLater, extractor_endpoint
+from scheduler import JobScheduler
+from storage_manager import StorageManager
+from stream_transcode import is_streamable, stream_transcode, get_stream_progress_callback
+from utils import choose_language as lang
+from utils import retry_later, retry_in_background, bot_answer_with_error, log_debug, \
+    file_name_manipulate, send_audio_file, delete_file_from_server
+from ydl_pool import ydl_pool
+
+cfg: BotConfig = Config()
+
+
+class DownloadTask(object):
+    """One link to process. bot_msg is the status message which shows the progress of the task,
+    msg_queue receives its edits. on_done(success) is called once, when the task leaves the pipeline"""
+
+    def __init__(self, message: Message, bot_msg: Message, link: str, source_key: str, job_id: int = None,
+                 msg_queue: queue.Queue = None, on_done: Callable[[bool], None] = None,
+                 time_range: TimeRange = None):
+        self.message = message
+        self.bot_msg = bot_msg
+        self.link = link
+        self.source_key = source_key
+        # Only this part of the media is downloaded and converted
+        self.time_range = time_range
+        self.job_id = job_id
+        self.msg_queue = msg_queue
+        self.on_done = on_done
+        # Filled by the stages
+        self.info: Optional[dict] = None
+        # Seconds to download and convert: the clip if there is a time range, else the whole media
+        self.duration: Optional[float] = None
+        self.profile = PROFILES['mp3']
+        # Speech profile: mono, resampled, optionally without long silences
+        self.speech = False
+        self.bitrate = 0
+        self.file_path: Optional[str] = None
+        # The converted file is already on the disk (storage_manager), download and transcode are skipped
+        self.from_storage = False
+        # Bytes reserved in the RAM work dir and the path prefix of the job files there
+        self.ram_reserved = 0
+        self.ram_base_path: Optional[str] = None
+        self.sent_bytes = 0
+        # Metrics of the job (job_metrics): size of the downloaded source, seconds spent in every stage
+        self.source_bytes = 0
+        self.stage_seconds: Dict[str, float] = {}
+        self.created = time.monotonic()
+        # Item of batch.BatchJob: the batch owns the status message and sends the results in order
+        self.batch = None
+        self.batch_index = 0
+        self.cached_file_id: Optional[str] = None
+        self.success = False
+        # Attempts of the calls which the stages retry later (utils.retry_later), the stage runs again then
+        self.attempts: Dict[str, int] = {}
+        # source_key before the output profile is added, None until the probe stage has run
+        self.history_key: Optional[str] = None
+        self._finish_callbacks: List[Callable[[], None]] = []
+        self._file_callbacks: List[Callable[[], None]] = []
+
+    def on_finish(self, callback: Callable[[], None]):
+        """Run callback when the task leaves the pipeline, before on_done"""
+        self._finish_callbacks.append(callback)
+
+    def on_file_release(self, callback: Callable[[], None]):
+        """Run callback when file_path isn't needed any more: the task has left the pipeline, or the batch has sent
+        the item or given up"""
+        self._file_callbacks.append(callback)
+
+    def release_file(self):
+        callbacks, self._file_callbacks = self._file_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                log.exception(e)
+
+    def finish(self):
+        if self.batch is None:
+            self.release_file()
+        if self.ram_reserved:
+            get_ram_work_dir().release(self.ram_reserved, self.ram_base_path)
+            self.ram_reserved = 0
+        for callback in self._finish_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                log.exception(e)
+        self._finish_callbacks = []
+        if self.on_done is not None:
+            try:
+                self.on_done(self.success)
+            except Exception as e:
+                log.exception(e)
+
+    @property
+    def outcome(self) -> str:
+        if not self.success:
+            return 'failed'
+        if self.from_storage:
+            return 'storage'
+        if self.file_path is None:
+            return 'cached'
+        return 'sent'
+
+    def __repr__(self) -> str:
+        return f'DownloadTask(job_id: {self.job_id}, user.id: {self.message.from_user.id}, link: {self.link})'
+
+
+def delete_status_message(bot: TeleBot, task: DownloadTask):
+    """The status message of a batch item is shared by the whole batch, the batch deletes it"""
+    if task.batch is None:
+        retry_in_background(bot.delete_message)(chat_id=task.bot_msg.chat.id, message_id=task.bot_msg.message_id)
+
+
+def send_cached_audio(bot: TeleBot, task: DownloadTask, file_id: str) -> bool:
+    """Resend the file which has already been uploaded (by this or another worker)"""
+    if task.batch is not None:
+        task.cached_file_id = file_id
+        return True
+    msg = retry_later(bot.send_audio)(chat_id=task.message.chat.id, audio=file_id, attempts=task.attempts,
+                                      key='send_cached')
+    if msg is None:
+        return False
+    delete_status_message(bot, task)
+    return True
+
+
+def probe_stage(bot: TeleBot, db_request_queue: queue.Queue, storage: StorageManager, task: DownloadTask) -> bool:
+    """Answer from the caches or get info and choose bitrate. The duration is the cost of the job for the scheduler"""
+
+    message = task.message
+    preferences = get_preferences(db_request_queue, message.from_user.id)
+    # A retried probe runs the stage again, the task is already set up then
+    if task.history_key is None:
+        if task.batch is None:
+            # Items of a batch are recorded when the batch has sent them
+            task.on_finish(lambda: record_job(db_request_queue, task))
+        # The same media converted for another output profile is another file
+        task.history_key = task.source_key
+        task.source_key = variant_key(task.source_key, preferences['output_profile'], preferences['speech_mode'])
+    cached_file_id = get_cached_file_id(db_request_queue, task.source_key)
+    if cached_file_id is not None and send_cached_audio(bot, task, cached_file_id):
+        log.info(f'{task} has been answered from the audio cache')
+        task.success = True
+        return False
+    stored = storage.lookup(task.source_key)
+    if stored is not None:
+        log.info(f'{task} is sent from the local storage')
+        task.file_path, task.bitrate = stored
+        # The file is pinned by the lookup until the task doesn't need it, even if it is dropped before the upload
+        task.on_file_release(lambda file_path=task.file_path: storage.unpin(file_path))
+        task.profile = profile_of_file(task.file_path)
+        task.from_storage = True
+        return True
+
+    routed = link_router.route(task.link)
+    with ydl_pool.acquire({}) as ydl:
+        try:
+            info = retry_later(ydl.extract_info)(task.link, attempts=task.attempts, key='extract_info',
+                                                 endpoint=extractor_endpoint(routed and routed.extractor),
+                                                 gen_answer=True, bot_obj=bot, download=False, tg_message_obj=message,
+                                                 tg_error_msg=BOT_MSG[lang(message)]["error_getting_ydl_info"])
+        except RetryLater:
+            raise
+        except Exception as e:
+            bot_answer_with_error(bot, message, str(e))
+            log.exception(e)
+            return False
+    if info is None:
+        return False
+    log.info(f"Title of downloaded file: {info.get('title')}")
+    log_debug(info)
+    if task.batch is None:
+        enrich_history(db_request_queue, task.history_key, info)
+
+    # Calculate bitrate based on duration (Telegram has max transfer size 50 MB), a clip needs only its own length
+    task.duration = info.get('duration')
+    if task.time_range is not None:
+        task.duration = task.time_range.clip_duration(task.duration)
+        if task.duration == 0:
+            delete_status_message(bot, task)
+            retry_in_background(bot.send_message)(message.chat.id, BOT_MSG[lang(message)]["time_range_out_of_media"])
+            return False
+    task.speech = is_speech(preferences['speech_mode'], info, task.duration)
+    task.profile, task.bitrate = choose_profile(preferences['output_profile'], task.duration, task.speech)
+    if task.speech:
+        log.info(f'{task} is encoded with the speech profile')
+
+    if task.bitrate == 0:
+        delete_status_message(bot, task)
+        retry_in_background(bot.send_message)(message.chat.id, BOT_MSG[lang(message)]["file_too_long"])
+        return False
+    task.info = info
+    return True
+
+
+def download_stage(bot: TeleBot, task: DownloadTask) -> bool:
+    """Download the source file of the probed task"""
+    if task.file_path is not None:
+        return True
+
+    message = task.message
+    bot_msg = task.bot_msg
+    info = task.info
+    downloading_hook = get_download_progress_hook(bot_msg, task.msg_queue)
+    # Download file options, do not change tmpl without testing
+    ydl_opts = {
+        'outtmpl': {
+            'default': '%(title)s.%(ext)s',
+        },
+        'progress_hooks': [downloading_hook],
+    }
+    if task.time_range is not None:
+        ydl_opts.update(task.time_range.ydl_params())
+
+    # Fragments, HTTP ranges and the rate limit follow the observed speeds and the bandwidth budget,
+    # the tuner job is left before the instance goes back to the pool
+    with ydl_pool.acquire(ydl_opts) as ydl, download_tuner.job(info.get('extractor_key') or '', ydl):
+        file_name = os.path.join(cfg.main.mp3_dir, file_name_manipulate(ydl.prepare_filename(info)))
+        if task.time_range is not None:
+            file_name = task.time_range.file_name(file_name)
+
+        # Short clips are downloaded, converted and sent from RAM, the others (and unknown sizes) use the disk.
+        # Batch items wait for their turn to be sent, they don't hold RAM
+        job_size = estimate_job_size(info, task.bitrate, task.duration)
+        ram_work_dir = get_ram_work_dir()
+        # A retried download keeps its reservation and goes on from its partial files
+        if not task.ram_reserved and task.batch is None and ram_work_dir.reserve(job_size):
+            task.ram_reserved = job_size
+        if task.ram_reserved:
+            file_name = os.path.join(ram_work_dir.path, os.path.basename(file_name))
+            task.ram_base_path = os.path.splitext(file_name)[0]
+        # Prepare output filename
+        ydl.params.update({'outtmpl': {'default': file_name}})
+
+        # A progressive stream is converted while it is being downloaded, the transcode stage is skipped then.
+        # Clips are cut by yt-dlp's ffmpeg downloader
+        if task.time_range is None and is_streamable(info):
+            target = os.path.splitext(file_name)[0] + '.' + task.profile.ext
+            on_progress = get_stream_progress_callback(bot_msg, task.msg_queue, target)
+            if stream_transcode(ydl, info, target, task.bitrate, on_progress, task.profile,
+                                extra_args=speech_ffmpeg_args() if task.speech else None):
+                task.info = dict(info, filepath=target)
+                task.file_path = target
+                task.source_bytes = info.get('filesize') or info.get('filesize_approx') or 0
+                return True
+            log.info(f'{task} streaming has failed, the file will be downloaded first')
+
+        # Conversion is the next stage, here only remember where the downloaded file is
+        from youtube_dl_modified_objects import DownloadedInfoPP
+        downloaded_info_pp = DownloadedInfoPP(ydl)
+        ydl.add_post_processor(downloaded_info_pp, when='after_move')
+        # The info has already been extracted, download it without a second extraction
+        retry_later(ydl.process_ie_result)(info, attempts=task.attempts, key='download',
+                                           endpoint=extractor_endpoint(info.get('extractor_key')), gen_answer=True,
+                                           bot_obj=bot, download=True, tg_message_obj=message,
+                                           tg_error_msg='Problem with downloading')
+    if downloaded_info_pp.info is None:
+        return False
+    task.info = downloaded_info_pp.info
+    if os.path.isfile(task.info.get('filepath') or ''):
+        task.source_bytes = os.path.getsize(task.info['filepath'])
+    return True
+
+
+def transcode_stage(bot: TeleBot, task: DownloadTask) -> bool:
+    """Convert the downloaded file with the chosen bitrate"""
+    # Already converted: sent from the storage or converted while downloading
+    if task.file_path is not None:
+        return True
+    from youtube_dl_modified_objects import ControlledPostProcessor
+    post_processor = ControlledPostProcessor(message=task.bot_msg,
+                                             user_lang_code=task.message.from_user.language_code,
+                                             preferredcodec=task.profile.codec, preferredquality=str(task.bitrate),
+                                             extra_args=speech_ffmpeg_args() if task.speech else None,
+                                             msg_queue=task.msg_queue)
+    try:
+        files_to_delete, info = post_processor.run(task.info)
+    except Exception as e:
+        log.exception(e)
+        delete_status_message(bot, task)
+        bot_answer_with_error(bot, task.message, 'Problem with postprocessing')
+        return False
+    # The source file isn't needed anymore
+    for file_path in files_to_delete:
+        if file_path != info['filepath']:
+            delete_file_from_server(file_path)
+    task.info = info
+    task.file_path = info['filepath']
+    return True
+
+
+def after_upload(db_request_queue: queue.Queue, storage: StorageManager, task: DownloadTask,
+                 sent_message: Optional[Message], file_size: int):
+    """Keep the file in the storage and remember its file_id"""
+    if not task.from_storage:
+        # Even if sending has failed, the converted file is good for the next request
+        ram_work_dir = get_ram_work_dir()
+        if storage.enabled and ram_work_dir.contains(task.file_path):
+            # The user already has the file, now it can go to the disk for the next requests
+            task.file_path = ram_work_dir.spill(task.file_path, cfg.main.mp3_dir)
+        storage.register(task.source_key, task.file_path, task.bitrate, task.info.get('title'))
+    if sent_message is not None and sent_message.audio is not None:
+        title = sent_message.audio.title if task.info is None else task.info.get('title')
+        store_file_id(db_request_queue, task.source_key, sent_message.audio.file_id, title)
+        task.sent_bytes = file_size
+        task.success = True
+
+
+def upload_stage(bot: TeleBot, db_request_queue: queue.Queue, storage: StorageManager, task: DownloadTask) -> bool:
+    """Send the converted file, remember its file_id and keep the file in the storage"""
+    if task.batch is not None:
+        # Sent by the batch together with the other items, in order
+        task.success = True
+        return False
+    message = task.message
+    file_size = os.path.getsize(task.file_path) if os.path.isfile(task.file_path) else 0
+    sent_message = None
+    retried = False
+    try:
+        sent_message = retry_later(send_audio_file)(bot, task.file_path, task.bot_msg, attempts=task.attempts,
+                                                    key='send_audio', endpoint='telegram', gen_answer=True,
+                                                    bot_obj=bot, tg_message_obj=task.bot_msg,
+                                                    tg_error_msg=BOT_MSG[lang(message)]['file_sending_error'])
+    except RetryLater:
+        # The status message and the file stay for the next attempt
+        retried = True
+        raise
+    finally:
+        if not retried:
+            # Delete inform message
+            delete_status_message(bot, task)
+            after_upload(db_request_queue, storage, task, sent_message, file_size)
+    return False
+
+
+def timed_stage(name: str, stage_func: Callable[[DownloadTask], bool]) -> Callable[[DownloadTask], bool]:
+    """Seconds the task has spent in the stage go to its metrics"""
+    def run(task: DownloadTask) -> bool:
+        started = time.monotonic()
+        try:
+            return stage_func(task)
+        finally:
+            task.stage_seconds[name] = task.stage_seconds.get(name, 0.0) + time.monotonic() - started
+    return run
+
+
+def make_download_pipeline(bot: TeleBot, db_request_queue: queue.Queue, storage: StorageManager,
+                           is_admin: Callable[[Message], bool] = None) -> Pipeline:
+    """probe -> download -> transcode -> upload, so uploading one job overlaps with converting the next one.
+    Probed tasks wait for the download stage in the JobScheduler, not in FIFO order.
+    The workers of the stages and the scheduler size follow the config when it is reloaded"""
+    scheduler = JobScheduler(cfg.advanced.scheduler_queue_size, is_admin)
+    pipeline = make_pipeline([
+        ('probe', timed_stage('probe', lambda task: probe_stage(bot, db_request_queue, storage, task)),
+         cfg.advanced.probe_workers),
+        ('download', timed_stage('download', lambda task: download_stage(bot, task)), cfg.advanced.download_workers,
+         scheduler),
+        ('transcode', timed_stage('transcode', lambda task: transcode_stage(bot, task)),
+         cfg.advanced.transcode_workers),
+        ('upload', timed_stage('upload', lambda task: upload_stage(bot, db_request_queue, storage, task)),
+         cfg.advanced.upload_workers),
+    ], cfg.advanced.stage_queue_size)
+
+    def on_reload(new_cfg: BotConfig):
+        pipeline.resize({stage: getattr(new_cfg.advanced, f'{stage}_workers')
+                         for stage in ('probe', 'download', 'transcode', 'upload')})
+        scheduler.resize(new_cfg.advanced.scheduler_queue_size)
+
+    Config.on_reload(on_reload)
+    return pipeline
@@ -47,6 +47,13 @@ class IsUser(custom_filters.SimpleCustomFilter):
         with self.lock:
             return message.from_user.id in self.USER_ID_LIST
 
+    def contains(self, user_id: int) -> bool:
+        """check() by user id, for the places without a message"""
+        if user_id in cfg.main.super_admin_list:
+            return True
+        with self.lock:
+            return user_id in self.USER_ID_LIST
+
     def update_users(self):
         """Concurrently safe Update list of users from user_permissions table"""
 
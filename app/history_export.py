@@ -0,0 +1,123 @@
+import csv
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import threading
+from typing import Iterator, Optional, Sequence
+
+from sqlalchemy import select
+from telebot import TeleBot, logger as log
+from telebot.types import Message
+
+from config_parse import Config, BotConfig
+from database import get_engine
+from database.schema import BotHistory, TelegramUser
+from history_search import HistoryQuery, search_conditions
+from utils import retry, retry_in_background
+
+cfg: BotConfig = Config()
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_COLUMNS = ('id', 'created_date', 'user_id', 'first_name', 'user_name', 'msg_text', 'source_key', 'title',
+                  'uploader')
+# Telegram bots can't upload bigger documents
+MAX_DOCUMENT_BYTES = 50 * 2 ** 20
+
+_export_lock = threading.Lock()
+
+
+def _history_query(history_query: HistoryQuery):
+    return (select(BotHistory.id, BotHistory.created_date, BotHistory.user_id, TelegramUser.first_name,
+                   TelegramUser.user_name, BotHistory.msg_text, BotHistory.source_key, BotHistory.title,
+                   BotHistory.uploader)
+            .join(TelegramUser).where(*search_conditions(history_query)).order_by(BotHistory.id))
+
+
+def iter_history_batches(history_query: HistoryQuery, batch_size: int) -> Iterator[Sequence]:
+    """Rows in batches of batch_size, at most one batch is in memory.
+
+    It doesn't go through db_consumer (its Select buffers the whole result), the export has its own connection.
+    PostgreSQL streams the result through a server-side cursor. SQLite would keep its read lock for the whole cursor and
+    stop the writes of the bot, so every batch there is a short query continuing after the last id (keyset)"""
+    query = _history_query(history_query)
+    engine = get_engine()
+    if engine.dialect.name != 'sqlite':
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+            yield from result.partitions()
+        return
+    last_id = 0
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(query.where(BotHistory.id > last_id).limit(batch_size)).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _jsonable(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def write_history_export(file_path: str, export_format: str, history_query: HistoryQuery, batch_size: int) -> int:
+    """gzip CSV or NDJSON written batch by batch, returns the number of rows"""
+    count = 0
+    with gzip.open(file_path, 'wt', encoding='utf-8', newline='') as file_object:
+        writer = csv.writer(file_object)
+        if export_format == 'csv':
+            writer.writerow(EXPORT_COLUMNS)
+        for rows in iter_history_batches(history_query, batch_size):
+            if export_format == 'csv':
+                writer.writerows(rows)
+            else:
+                file_object.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, map(_jsonable, row))),
+                                                  ensure_ascii=False) + '\n' for row in rows)
+            count += len(rows)
+    return count
+
+
+def _export_and_send(bot: TeleBot, message: Message, export_format: str, history_query: HistoryQuery):
+    file_path = None
+    try:
+        file_descriptor, file_path = tempfile.mkstemp(prefix='history-', suffix=f'.{export_format}.gz',
+                                                      dir=cfg.main.mp3_dir)
+        os.close(file_descriptor)
+        count = write_history_export(file_path, export_format, history_query, cfg.advanced.export_batch_size)
+        size = os.path.getsize(file_path)
+        log.info(f'History export: {count} row(s), {size} bytes of {export_format}.gz')
+        if size > MAX_DOCUMENT_BYTES:
+            retry_in_background(bot.send_message)(message.chat.id, f'The export is {size / 2 ** 20:.1f} MB, Telegram '
+                                                                   f'accepts {MAX_DOCUMENT_BYTES // 2 ** 20} MB, '
+                                                                   f'narrow it with filters', endpoint='telegram')
+            return
+        name = f'history-{datetime.date.today().isoformat()}.{export_format}.gz'
+
+        def send():
+            # Every attempt reads the file from the start
+            with open(file_path, 'rb') as file_object:
+                return bot.send_document(message.chat.id, file_object, visible_file_name=name,
+                                         caption=f'{count} entries', timeout=cfg.advanced.send_timeout)
+
+        retry(send)(endpoint='telegram')
+    except Exception as e:
+        log.exception(e)
+        retry_in_background(bot.send_message)(message.chat.id, 'History export has failed', endpoint='telegram')
+    finally:
+        if file_path is not None and os.path.isfile(file_path):
+            os.remove(file_path)
+        _export_lock.release()
+
+
+def start_history_export(bot: TeleBot, message: Message, export_format: str,
+                         history_query: HistoryQuery) -> Optional[threading.Thread]:
+    """The export runs in its own thread, one at a time. None if another export is running"""
+    if not _export_lock.acquire(blocking=False):
+        retry_in_background(bot.send_message)(message.chat.id, 'Another export is running, try later')
+        return None
+    thread = threading.Thread(target=_export_and_send, args=(bot, message, export_format, history_query),
+                              name='history-export')
+    thread.start()
+    return thread
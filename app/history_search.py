@@ -0,0 +1,114 @@
+import datetime
+import html
+import queue
+from typing import List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import ColumnElement, Select, Update, column, literal_column, or_, select, table, update
+from telebot import logger as log
+from telebot.types import Message
+
+from database import is_history_fts_ready
+from database.async_db_access import DBMessage, DBCommand, execute_with_result
+from database.history_fts import FTS_TABLE
+from database.schema import BotHistory, TelegramUser
+from lang_support import BOT_MSG
+from utils import choose_language
+
+SEARCH_USAGE = ('<b>Search History</b>\n'
+                '/search &lt;words&gt; [user=&lt;user_id&gt;] [from=YYYY-MM-DD] [to=YYYY-MM-DD]\n\n'
+                'Words are matched by prefix in titles, uploaders, media ids and links, the latest entries first.\n\n'
+                '/export [csv|ndjson] [&lt;words&gt;] [user=&lt;user_id&gt;] [from=YYYY-MM-DD] [to=YYYY-MM-DD]\n'
+                'The whole history (or the found entries) as a gzip file.')
+
+_fts = table(FTS_TABLE, column('rowid'))
+
+
+class HistoryQuery(NamedTuple):
+    words: List[str]
+    user_id: Optional[int] = None
+    date_from: Optional[datetime.date] = None
+    # Inclusive
+    date_to: Optional[datetime.date] = None
+
+
+def parse_search_args(args: List[str]) -> Optional[HistoryQuery]:
+    """['never', 'gonna', 'user=42', 'from=2024-01-31'] -> HistoryQuery, None if something is wrong or empty"""
+    words = []
+    filters = {}
+    for arg in args:
+        field, sep, value = arg.partition('=')
+        if not sep or field not in ('user', 'from', 'to'):
+            words.append(arg)
+            continue
+        try:
+            filters[field] = int(value) if field == 'user' else datetime.date.fromisoformat(value)
+        except ValueError:
+            return None
+    if not words and not filters:
+        return None
+    return HistoryQuery(words, filters.get('user'), filters.get('from'), filters.get('to'))
+
+
+def fts_match_expression(words: List[str]) -> str:
+    """Every word as a quoted prefix phrase, so the FTS5 query syntax of the input (AND, NEAR, -, :) means nothing"""
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+
+
+def search_conditions(history_query: HistoryQuery) -> List[ColumnElement]:
+    conditions = []
+    if history_query.words:
+        if is_history_fts_ready():
+            match = literal_column(FTS_TABLE).op('MATCH')(fts_match_expression(history_query.words))
+            conditions.append(BotHistory.id.in_(select(_fts.c.rowid).where(match)))
+        else:
+            fields = (BotHistory.title, BotHistory.uploader, BotHistory.source_key, BotHistory.msg_text)
+            conditions += [or_(*(field.ilike(f'%{word}%') for field in fields)) for word in history_query.words]
+    if history_query.user_id is not None:
+        conditions.append(BotHistory.user_id == history_query.user_id)
+    if history_query.date_from is not None:
+        conditions.append(BotHistory.created_date >= datetime.datetime.combine(history_query.date_from,
+                                                                               datetime.time()))
+    if history_query.date_to is not None:
+        conditions.append(BotHistory.created_date < datetime.datetime.combine(
+            history_query.date_to + datetime.timedelta(days=1), datetime.time()))
+    return conditions
+
+
+def build_search_query(history_query: HistoryQuery, limit: int) -> Select:
+    return (select(TelegramUser.id, TelegramUser.first_name, BotHistory.msg_text, BotHistory.created_date,
+                   BotHistory.title, BotHistory.uploader)
+            .join(BotHistory).where(*search_conditions(history_query)).order_by(BotHistory.id.desc()).limit(limit))
+
+
+def search_history(db_request_queue: queue.Queue, history_query: HistoryQuery, limit: int) -> Optional[Sequence]:
+    """At most limit + 1 entries, the extra one only tells that there are more"""
+    return execute_with_result(db_request_queue, build_search_query(history_query, limit + 1))
+
+
+def enrich_history_query(source_key: str, info: dict) -> Optional[Update]:
+    """Title and uploader of the probed media for the history entries of its key which don't have them yet.
+    The update trigger of bot_history puts them into the full-text index"""
+    if not info.get('title'):
+        return None
+    return (update(BotHistory).where(BotHistory.source_key == source_key, BotHistory.title.is_(None))
+            .values(title=info['title'], uploader=info.get('uploader') or info.get('channel')))
+
+
+def enrich_history(db_request_queue: queue.Queue, source_key: str, info: dict):
+    query = enrich_history_query(source_key, info)
+    if query is not None:
+        db_request_queue.put(DBMessage(command=DBCommand.Execute, execute_obj=query), block=False)
+        log.debug(f'History of {source_key} has been enriched')
+
+
+def prepare_search_result(message: Message, entries: Sequence, limit: int) -> str:
+    if not entries:
+        return BOT_MSG[choose_language(message)]['no_history_answer']
+    more = ' (the latest ones, narrow the search to see the others)' if len(entries) > limit else ''
+    m = f'Found {min(len(entries), limit)}{more}:\n'
+    for number, res in enumerate(entries[:limit], start=1):
+        title = ' - '.join(html.escape(field) for field in (res[4], res[5]) if field)
+        title = f'{title}\n' if title else ''
+        m += (f'#{number} <b>{html.escape(res[1])}</b> [{res[0]}] {res[3].strftime("%d.%m.%Y, %H:%M:%S")}\n'
+              f'{title}{html.escape(res[2])}\n\n')
+    return m
@@ -0,0 +1,149 @@
+import bisect
+import queue
+import re
+import secrets
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from sqlalchemy import select
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+from database.async_db_access import DBMessage, DBCommand
+from database.schema import AudioCache
+
+cfg: BotConfig = Config()
+
+WORD_RE = re.compile(r'\w+')
+
+
+class IndexedAudio(NamedTuple):
+    # id of the audio_cache row, it is also the id of the inline result
+    row_id: int
+    source_key: str
+    file_id: str
+    title: str
+
+
+def media_id_of(source_key: str) -> str:
+    """Youtube:dQw4w9WgXcQ#opus -> dQw4w9WgXcQ"""
+    return source_key.split(':', 1)[-1].split('@', 1)[0].split('#', 1)[0]
+
+
+class AudioIndex(object):
+    """Local index over audio_cache for inline queries: words of titles and canonical video ids -> file_id.
+
+    The query path never touches the DB, new rows (from this process and from workers) are read by the refresh
+    thread every inline_refresh_sec"""
+
+    def __init__(self, db_request_queue: queue.Queue):
+        self.db_request_queue = db_request_queue
+        self.lock = threading.Lock()
+        self.last_row_id = 0
+        # source_key -> the latest upload of it
+        self.by_key: Dict[str, IndexedAudio] = {}
+        self.by_word: Dict[str, Set[str]] = {}
+        # Sorted words of by_word, prefix search with bisect
+        self.words: List[str] = []
+
+    def add(self, audio: IndexedAudio):
+        with self.lock:
+            self.last_row_id = max(self.last_row_id, audio.row_id)
+            self.by_key[audio.source_key] = audio
+            words = set(WORD_RE.findall((audio.title or '').lower()))
+            words.add(media_id_of(audio.source_key).lower())
+            for word in words:
+                keys = self.by_word.get(word)
+                if keys is None:
+                    keys = self.by_word[word] = set()
+                    bisect.insort(self.words, word)
+                keys.add(audio.source_key)
+
+    def refresh(self):
+        query = (select(AudioCache.id, AudioCache.source_key, AudioCache.file_id, AudioCache.title)
+                 .where(AudioCache.id > self.last_row_id).order_by(AudioCache.id))
+        result_queue = queue.Queue(maxsize=1)
+        self.db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                                  block=False)
+        try:
+            rows = result_queue.get(block=True, timeout=10)
+        except queue.Empty as e:
+            log.exception(e)
+            return
+        for row in rows or []:
+            self.add(IndexedAudio(*row))
+        if rows:
+            log.info(f'Inline index: {len(rows)} new audio file(s), {len(self.by_key)} in total')
+
+    def find_media(self, source_key: str) -> List[IndexedAudio]:
+        """Uploads of the media: the plain key and its variants (output profiles, speech)"""
+        with self.lock:
+            return [audio for key, audio in self.by_key.items()
+                    if key == source_key or key.startswith(source_key + '#')]
+
+    def _keys_with_prefix(self, prefix: str) -> Set[str]:
+        keys = set()
+        position = bisect.bisect_left(self.words, prefix)
+        while position < len(self.words) and self.words[position].startswith(prefix):
+            keys |= self.by_word[self.words[position]]
+            position += 1
+        return keys
+
+    def search(self, text: str, limit: int) -> List[IndexedAudio]:
+        """Files whose title (or video id) has every word of the text as a word prefix, the latest first"""
+        words = WORD_RE.findall(text.lower())
+        with self.lock:
+            if not words:
+                found = list(self.by_key.values())
+            else:
+                keys = self._keys_with_prefix(words[0])
+                for word in words[1:]:
+                    if not keys:
+                        break
+                    keys &= self._keys_with_prefix(word)
+                found = [self.by_key[key] for key in keys]
+        found.sort(key=lambda audio: audio.row_id, reverse=True)
+        return found[:limit]
+
+    def refresh_loop(self, exit_s: threading.Event):
+        log.info('Inline index thread has started')
+        while not exit_s.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                log.exception(e)
+            exit_s.wait(cfg.advanced.inline_refresh_sec)
+        log.info('Inline index thread has finished')
+
+    def run_refresh_thread(self, exit_s: threading.Event) -> threading.Thread:
+        thread = threading.Thread(target=self.refresh_loop, args=(exit_s,), name='inline-index')
+        thread.start()
+        return thread
+
+
+class DeepLinks(object):
+    """Links of inline queries which are not in the cache yet. The deep link /start dl-<token> queues a normal job,
+    the start parameter can't hold the link itself (64 chars of [A-Za-z0-9_-])"""
+
+    PREFIX = 'dl-'
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.links: 'OrderedDict[str, str]' = OrderedDict()
+
+    def remember(self, link: str) -> str:
+        """Start parameter for the link"""
+        token = secrets.token_urlsafe(8)
+        with self.lock:
+            self.links[token] = link
+            while len(self.links) > self.max_size:
+                self.links.popitem(last=False)
+        return self.PREFIX + token
+
+    def resolve(self, start_parameter: str) -> Optional[str]:
+        if not start_parameter.startswith(self.PREFIX):
+            return None
+        with self.lock:
+            return self.links.get(start_parameter[len(self.PREFIX):])
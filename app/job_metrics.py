@@ -0,0 +1,96 @@
+import datetime
+import html
+import queue
+import time
+from typing import Dict, Optional, Sequence
+
+from sqlalchemy import Insert, desc, func, insert, select
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+from database import dialect_insert
+from database.async_db_access import DBMessage, DBCommand
+from database.schema import DailyStats, JobMetrics, TelegramUser, UserDailyStats
+
+cfg: BotConfig = Config()
+
+STAGES = ('probe', 'download', 'transcode', 'upload')
+
+
+def _upsert(model, keys: Dict, counters: Dict) -> Insert:
+    """INSERT ... ON CONFLICT DO UPDATE adding the counters, atomic for the bot and its workers (SQLite, PostgreSQL)"""
+    statement = dialect_insert(model).values(**keys, **counters)
+    return statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={field: getattr(model, field) + statement.excluded[field] for field in counters})
+
+
+def record_job(db_request_queue: queue.Queue, task):
+    """The metrics row and both rollups go to the DB in one transaction, so the rollups always match the metrics"""
+    stage_seconds = {stage: round(task.stage_seconds.get(stage, 0.0), 3) for stage in STAGES}
+    outcome = task.outcome
+    source_seconds = (task.duration or 0) if outcome == 'sent' else 0
+    counters = {
+        'jobs': 1,
+        'failed': int(outcome == 'failed'),
+        'cache_hits': int(outcome in ('cached', 'storage')),
+        'source_seconds': source_seconds,
+        'bytes_in': task.source_bytes,
+        'bytes_out': task.sent_bytes,
+        'work_seconds': sum(stage_seconds.values()),
+    }
+    day = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+    user_id = task.message.from_user.id
+    metrics = insert(JobMetrics).values(user_id=user_id, source_key=task.source_key, outcome=outcome,
+                                        duration=task.duration, bytes_in=task.source_bytes,
+                                        bytes_out=task.sent_bytes, bitrate=task.bitrate,
+                                        profile=task.profile.name if task.file_path is not None else None,
+                                        total_sec=round(time.monotonic() - task.created, 3),
+                                        **{f'{stage}_sec': seconds for stage, seconds in stage_seconds.items()})
+    db_request_queue.put(DBMessage(command=DBCommand.Transaction, execute_objs=[
+        metrics,
+        _upsert(UserDailyStats, {'user_id': user_id, 'day': day}, counters),
+        _upsert(DailyStats, {'day': day}, counters),
+    ]), block=False)
+    log.debug(f'{task} metrics: {outcome}, {stage_seconds}')
+
+
+def _select(db_request_queue: queue.Queue, query) -> Optional[Sequence]:
+    result_queue = queue.Queue(maxsize=1)
+    db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                         block=False)
+    try:
+        return result_queue.get(block=True, timeout=10)
+    except queue.Empty as e:
+        log.exception(e)
+        return None
+
+
+def prepare_statistics_report(db_request_queue: queue.Queue, days: int) -> Optional[str]:
+    """Admin menu: totals per day and the users who have used the most capacity, only the rollups are read"""
+    since = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    daily = _select(db_request_queue,
+                    select(DailyStats.day, DailyStats.jobs, DailyStats.failed, DailyStats.cache_hits,
+                           DailyStats.source_seconds, DailyStats.bytes_out)
+                    .where(DailyStats.day >= since).order_by(DailyStats.day.desc()))
+    work_seconds = func.sum(UserDailyStats.work_seconds).label('work_seconds')
+    top_users = _select(db_request_queue,
+                        select(UserDailyStats.user_id, TelegramUser.first_name, func.sum(UserDailyStats.jobs),
+                               func.sum(UserDailyStats.source_seconds), func.sum(UserDailyStats.bytes_out),
+                               work_seconds)
+                        .outerjoin(TelegramUser, TelegramUser.id == UserDailyStats.user_id)
+                        .where(UserDailyStats.day >= since).group_by(UserDailyStats.user_id, TelegramUser.first_name)
+                        .order_by(desc(work_seconds)).limit(cfg.advanced.stats_top_users))
+    if daily is None or top_users is None:
+        return None
+    m = f'<b>Statistics for {days} day(s)</b>\n'
+    if not daily:
+        return m + 'No jobs yet.\n'
+    m += 'Day: jobs (failed, from cache), hours of media, MB sent\n'
+    for day, jobs, failed, cache_hits, source_seconds, bytes_out in daily:
+        m += f'{day}: {jobs} ({failed}, {cache_hits}), {source_seconds / 3600:.1f} h, {bytes_out / 2 ** 20:.0f} MB\n'
+    m += '\n<b>Top users by capacity</b>\nUser: jobs, hours of media, MB sent, minutes of work\n'
+    for user_id, first_name, jobs, source_seconds, bytes_out, seconds in top_users:
+        m += (f'<b>{html.escape(first_name or "")}</b> [{user_id}]: {jobs}, {source_seconds / 3600:.1f} h, '
+              f'{bytes_out / 2 ** 20:.0f} MB, {seconds / 60:.1f} min\n')
+    return m
@@ -0,0 +1,218 @@
+import datetime
+import json
+import queue
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from sqlalchemy import select, update, or_, and_, func
+from telebot import logger as log
+from telebot.types import Message
+
+from config_parse import Config, BotConfig
+from database.async_db_access import DBMessage, DBCommand, execute_with_result
+from database.schema import DownloadJob, JobStatus
+from downloader import DownloadTask
+from link_router import TimeRange
+from msg_editor import MSGMessage, MSGCommand
+
+cfg: BotConfig = Config()
+
+
+def enqueue_job(db_request_queue: queue.Queue, message: Message, bot_msg: Message, link: str,
+                source_key: str, time_range: TimeRange = None) -> bool:
+    """Frontend side, put a new link into the job store"""
+    result_queue = queue.Queue(maxsize=1)
+    db_obj = DownloadJob.new_from_message_obj(message, bot_msg, link, source_key)
+    if time_range is not None:
+        db_obj.clip_start, db_obj.clip_end = time_range
+    db_request_queue.put(DBMessage(command=DBCommand.AddNew, result_queue=result_queue, db_obj=db_obj),
+                         block=False)
+    try:
+        return bool(result_queue.get(block=True, timeout=10))
+    except queue.Empty as e:
+        log.exception(e)
+        return False
+
+
+def is_job_in_flight(db_request_queue: queue.Queue, chat_id: int, source_key: str) -> bool:
+    """The same media is already queued or running for this chat"""
+    query = (select(DownloadJob.id, DownloadJob.message_json)
+             .where(DownloadJob.source_key == source_key,
+                    DownloadJob.status.in_((JobStatus.queued, JobStatus.running))))
+    result_queue = queue.Queue(maxsize=1)
+    db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                         block=False)
+    try:
+        rows = result_queue.get(block=True, timeout=10)
+    except queue.Empty as e:
+        log.exception(e)
+        return False
+    return any(json.loads(message_json)['chat']['id'] == chat_id for _, message_json in rows or [])
+
+
+def count_active_jobs(db_request_queue: queue.Queue, user_id: int) -> int:
+    """Queued and running jobs of the user"""
+    query = (select(func.count(DownloadJob.id))
+             .where(DownloadJob.user_id == user_id, DownloadJob.status.in_((JobStatus.queued, JobStatus.running))))
+    result_queue = queue.Queue(maxsize=1)
+    db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                         block=False)
+    try:
+        rows = result_queue.get(block=True, timeout=10)
+    except queue.Empty as e:
+        log.exception(e)
+        return 0
+    return rows[0][0] if rows else 0
+
+
+def _utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def claim_job(db_request_queue: queue.Queue, worker_id: str) -> Optional[DownloadTask]:
+    """Worker side, atomically take the oldest queued job (or a job with expired lease) and return it as a task"""
+    now = _utc_now()
+    claimable = or_(DownloadJob.status == JobStatus.queued,
+                    and_(DownloadJob.status == JobStatus.running, DownloadJob.lease_until < now))
+    # SKIP LOCKED lets several hosts claim from PostgreSQL concurrently, SQLite ignores it (single writer)
+    candidate = (select(DownloadJob.id)
+                 .where(claimable, DownloadJob.attempts < cfg.advanced.job_max_attempts)
+                 .order_by(DownloadJob.id).limit(1).with_for_update(skip_locked=True).scalar_subquery())
+    query = (update(DownloadJob).where(DownloadJob.id == candidate, claimable)
+             .values(status=JobStatus.running, worker_id=worker_id, attempts=DownloadJob.attempts + 1,
+                     lease_until=now + datetime.timedelta(seconds=cfg.advanced.job_lease_sec))
+             .returning(DownloadJob.id, DownloadJob.link, DownloadJob.source_key, DownloadJob.message_json,
+                        DownloadJob.bot_msg_json, DownloadJob.clip_start, DownloadJob.clip_end))
+    rows = execute_with_result(db_request_queue, query)
+    if not rows:
+        return None
+    job_id, link, source_key, message_json, bot_msg_json, clip_start, clip_end = rows[0]
+    return DownloadTask(message=Message.de_json(json.loads(message_json)),
+                        bot_msg=Message.de_json(json.loads(bot_msg_json)), link=link, source_key=source_key,
+                        job_id=job_id, time_range=TimeRange(clip_start, clip_end) if clip_start is not None else None)
+
+
+def renew_leases(db_request_queue: queue.Queue, worker_id: str, job_ids: Set[int]):
+    """Heartbeat, a worker keeps the jobs it is still processing"""
+    if not job_ids:
+        return
+    query = (update(DownloadJob)
+             .where(DownloadJob.id.in_(job_ids), DownloadJob.worker_id == worker_id,
+                    DownloadJob.status == JobStatus.running)
+             .values(lease_until=_utc_now() + datetime.timedelta(seconds=cfg.advanced.job_lease_sec)))
+    db_request_queue.put(DBMessage(command=DBCommand.Execute, execute_obj=query), block=False)
+
+
+def fail_abandoned_jobs(db_request_queue: queue.Queue):
+    """Jobs which have killed their workers too many times are not claimed again"""
+    query = (update(DownloadJob)
+             .where(DownloadJob.status == JobStatus.running, DownloadJob.lease_until < _utc_now(),
+                    DownloadJob.attempts >= cfg.advanced.job_max_attempts)
+             .values(status=JobStatus.failed))
+    db_request_queue.put(DBMessage(command=DBCommand.Execute, execute_obj=query), block=False)
+
+
+def finish_job(db_request_queue: queue.Queue, job_id: int, worker_id: str, success: bool):
+    status = JobStatus.done if success else JobStatus.failed
+    query = (update(DownloadJob).where(DownloadJob.id == job_id, DownloadJob.worker_id == worker_id)
+             .values(status=status, lease_until=None))
+    db_request_queue.put(DBMessage(command=DBCommand.Execute, execute_obj=query), block=False)
+
+
+class JobProgressQueue(object):
+    """Looks like the msg_edit_queue for progress hooks, but stores the progress text in the job store.
+    The frontend picks it up and edits the message through its own queue"""
+
+    def __init__(self, db_request_queue: queue.Queue, job_id: int):
+        self.db_request_queue = db_request_queue
+        self.job_id = job_id
+
+    def put(self, message: MSGMessage, block=True, timeout=None):
+        if message.command != MSGCommand.Edit or message.message_str is None:
+            return
+        query = update(DownloadJob).where(DownloadJob.id == self.job_id).values(progress_text=message.message_str)
+        self.db_request_queue.put(DBMessage(command=DBCommand.Execute, execute_obj=query), block=block,
+                                  timeout=timeout)
+
+
+def job_progress_consumer(db_request_queue: queue.Queue, msg_queue: queue.Queue, exit_s: threading.Event,
+                          interval=1.0):
+    """Frontend thread, forwards progress of running jobs to the msg_edit_queue"""
+    log.info('Job progress thread has started')
+    forwarded: Dict[int, str] = {}
+    query = select(DownloadJob.id, DownloadJob.bot_msg_json, DownloadJob.progress_text).where(
+        DownloadJob.status == JobStatus.running, DownloadJob.progress_text.is_not(None))
+    while not exit_s.wait(interval):
+        result_queue = queue.Queue(maxsize=1)
+        db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                             block=False)
+        try:
+            rows = result_queue.get(block=True, timeout=10)
+        except queue.Empty:
+            log.error('Job progress: DB result queue timeout')
+            continue
+        if rows is None:
+            continue
+        running = set()
+        for job_id, bot_msg_json, progress_text in rows:
+            running.add(job_id)
+            if forwarded.get(job_id) == progress_text:
+                continue
+            forwarded[job_id] = progress_text
+            msg_queue.put(MSGMessage(command=MSGCommand.Edit, message_object=Message.de_json(json.loads(bot_msg_json)),
+                                     message_str=progress_text, with_retry=False), block=False)
+        for job_id in set(forwarded) - running:
+            del forwarded[job_id]
+    log.info('Job progress thread quit')
+
+
+def run_job_progress_thread(db_request_queue: queue.Queue, msg_queue: queue.Queue) -> threading.Event:
+    exit_event = threading.Event()
+    thread = threading.Thread(target=job_progress_consumer, args=(db_request_queue, msg_queue, exit_event))
+    thread.start()
+    return exit_event
+
+
+def wait_for_job(db_request_queue: queue.Queue, worker_id: str, exit_s: threading.Event,
+                 poll_interval: float) -> Optional[DownloadTask]:
+    """Poll the job store until a job is claimed or exit is requested"""
+    while not exit_s.is_set():
+        started = time.time()
+        task = claim_job(db_request_queue, worker_id)
+        if task is not None:
+            return task
+        exit_s.wait(max(0.0, poll_interval - (time.time() - started)))
+    return None
+
+
+class LeaseKeeper(object):
+    """Worker process side. Remembers the claimed jobs and renews their leases from a heartbeat thread"""
+
+    def __init__(self, db_request_queue: queue.Queue, worker_id: str):
+        self.db_request_queue = db_request_queue
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.job_ids: Set[int] = set()
+
+    def add(self, job_id: int):
+        with self.lock:
+            self.job_ids.add(job_id)
+
+    def remove(self, job_id: int):
+        with self.lock:
+            self.job_ids.discard(job_id)
+
+    def heartbeat(self, exit_s: threading.Event):
+        log.info('Job heartbeat thread has started')
+        while not exit_s.wait(cfg.advanced.job_heartbeat_sec):
+            with self.lock:
+                job_ids = set(self.job_ids)
+            renew_leases(self.db_request_queue, self.worker_id, job_ids)
+            fail_abandoned_jobs(self.db_request_queue)
+        log.info('Job heartbeat thread quit')
+
+    def run_heartbeat_thread(self, exit_s: threading.Event) -> threading.Thread:
+        thread = threading.Thread(target=self.heartbeat, args=(exit_s,))
+        thread.start()
+        return thread
@@ -1,6 +1,13 @@
 BOT_MSG = {
     "EN": {
         "prepare_download": "Downloading will start in a few seconds... or not...",
+        "batch_progress": "Batch, files ready:",
+        "time_range_out_of_media": "The time range starts after the end of the video",
+        "format_current": "Audio format: {}. Change it with /format <name>, one of: {}",
+        "format_unknown": "Unknown format, use one of: {}",
+        "inline_download": "Not converted yet, download it in the bot",
+        "inline_link_expired": "The link from the inline query has expired, send it to me as a message",
+        "speech_current": "Speech profile (mono, for talks and lectures): {}. Change it with /speech <mode>, one of: {}",
         "error_getting_ydl_info": "Cannot get preliminary information about the video.",
         "get_id": "Your ID is:",
         "not_authorized": "You are not authorized.",
@@ -8,6 +15,7 @@ BOT_MSG = {
         "file_sending_started": "File sending has begun.",
         "downloading_file": "Downloading file:",
         "converting_file": "Converting file:",
+        "streaming_file": "Downloading and converting file:",
         "db_answer_fail": "Something went wrong with the answer from the database.",
         "no_history_answer": "There are no history messages found.",
         "admin_granted": "Your privileges have been changed to administrative. You can access the admin menu using "
@@ -21,11 +29,24 @@ BOT_MSG = {
         "yes": "Yes",
         "no": "No",
         "file_too_long": "Sorry, the video is too long and cannot be sent.",
-        "start_unauth": "Hi {}, please contact the person who has given you the bot name to grant you user privileges."
+        "start_unauth": "Hi {}, please contact the person who has given you the bot name to grant you user privileges.",
+        "unsupported_link": "Sorry, this link is not supported.",
+        "already_in_progress": "This video is already being processed for you.",
+        "quota_concurrent_jobs": "Please wait until your previous videos are ready.",
+        "quota_jobs_per_hour": "You have sent too many links this hour, please try again later.",
+        "quota_source_minutes": "You have reached today's limit of video minutes, please try again tomorrow.",
+        "quota_mb_per_day": "You have reached today's download limit, please try again tomorrow."
     }
     ,
     "RU": {
         "prepare_download": "Сейчас пойдет загрузка....или нет...",
+        "batch_progress": "Пакет, готово файлов:",
+        "time_range_out_of_media": "Отрезок начинается после конца видео",
+        "format_current": "Формат аудио: {}. Сменить: /format <название>, варианты: {}",
+        "format_unknown": "Неизвестный формат, варианты: {}",
+        "inline_download": "Ещё не сконвертировано, скачать в боте",
+        "inline_link_expired": "Ссылка из инлайн-запроса устарела, пришлите её сообщением",
+        "speech_current": "Профиль для речи (моно, для лекций и интервью): {}. Сменить: /speech <режим>, варианты: {}",
         "error_getting_ydl_info": "Не получается получить предварительную информацию по видео",
         "get_id": "Ваш Id:",
         "not_authorized": "Вы не авторизованы",
@@ -33,6 +54,7 @@ BOT_MSG = {
         "file_sending_started": "Отправка файла",
         "downloading_file": "Загрузка файла:",
         "converting_file": "Конвертация файла:",
+        "streaming_file": "Загрузка и конвертация файла:",
         "db_answer_fail": "Проблема с получением ответа из базы данных",
         "no_history_answer": "Истории скачиваний не найдено",
         "admin_granted": "ваши права были повышены до административных, у вас есть доступ в меню администратора "
@@ -47,5 +69,11 @@ BOT_MSG = {
         "file_to_long": "Файл слишком длинный и не может быть отправлен",
         "start_unauth": "Добрый день {}, свяжитесь с тем, кто дал вам имя этого бота и попросите у него права "
                         "пользователя",
+        "unsupported_link": "Эта ссылка не поддерживается",
+        "already_in_progress": "Это видео уже обрабатывается",
+        "quota_concurrent_jobs": "Дождитесь, пожалуйста, готовности предыдущих видео",
+        "quota_jobs_per_hour": "Слишком много ссылок за этот час, попробуйте позже",
+        "quota_source_minutes": "Дневной лимит минут видео исчерпан, попробуйте завтра",
+        "quota_mb_per_day": "Дневной лимит загрузки исчерпан, попробуйте завтра",
     },
 }
@@ -0,0 +1,214 @@
+import os
+import re
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from telebot import logger as log
+from validators import url
+
+# Query params which don't change the media (position, tracking, share links)
+DROP_QUERY_PARAMS = {'t', 'start', 'index', 'si', 'feature', 'pp', 'start_radio', 'ab_channel', 'fbclid', 'gclid'}
+DROP_QUERY_PREFIXES = ('utm_',)
+# Host-like literals in _VALID_URL patterns: youtube\.com, youtu\.be, ...
+HOST_LITERAL_RE = re.compile(r'([a-z0-9][a-z0-9-]*(?:\\\.[a-z0-9-]+)+)')
+# Clip after a link: 1:02:10-1:07:45, 62:10-67:45, 3730-4065, 1:02:10- (up to the end)
+TIME_RANGE_RE = re.compile(r'^(\d+(?::\d{1,2}){0,2})-(\d+(?::\d{1,2}){0,2})?$')
+# Start position of a link: t=3730, t=3730s, t=1h2m10s
+START_PARAM_RE = re.compile(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?$')
+START_PARAMS = ('t', 'start')
+
+
+def parse_clock(text: str) -> int:
+    """1:02:10 -> 3730"""
+    seconds = 0
+    for part in text.split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def format_clock(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}.{minutes:02d}.{seconds:02d}' if hours else f'{minutes}.{seconds:02d}'
+
+
+class TimeRange(NamedTuple):
+    """Part of the media to download, in seconds. end None means up to the end"""
+    start: int
+    end: Optional[int] = None
+
+    @classmethod
+    def parse(cls, text: str) -> Optional['TimeRange']:
+        match = TIME_RANGE_RE.match(text)
+        if match is None:
+            return None
+        start = parse_clock(match.group(1))
+        end = parse_clock(match.group(2)) if match.group(2) else None
+        if end is not None and end <= start:
+            return None
+        return cls(start, end)
+
+    @classmethod
+    def from_link(cls, text: str) -> Optional['TimeRange']:
+        """&t= (or start=) of a link, the clip goes up to the end"""
+        for key, value in parse_qsl(urlsplit(text.strip()).query):
+            match = START_PARAM_RE.match(value) if key in START_PARAMS else None
+            if match is not None and any(match.groups()):
+                hours, minutes, seconds = (int(g or 0) for g in match.groups())
+                start = hours * 3600 + minutes * 60 + seconds
+                return cls(start) if start else None
+        return None
+
+    @property
+    def label(self) -> str:
+        return f'{format_clock(self.start)}-{format_clock(self.end) if self.end is not None else ""}'
+
+    def clip_duration(self, duration: Optional[float]) -> Optional[float]:
+        """Duration of the clip, 0 if it starts after the end of the media. None if unknown"""
+        end = self.end if self.end is not None else duration
+        if end is None:
+            return None
+        if duration:
+            end = min(end, duration)
+        return max(0, end - self.start)
+
+    def ydl_params(self) -> dict:
+        """yt-dlp downloads only this section (ffmpeg seeks in the source, the rest is not transferred)"""
+        from yt_dlp.utils import download_range_func
+        return {'download_ranges': download_range_func(None, [(self.start, self.end or float('inf'))])}
+
+    def file_name(self, file_name: str) -> str:
+        """Clips of the same media don't overwrite each other"""
+        base, ext = os.path.splitext(file_name)
+        return f'{base} [{self.label}]{ext}'
+
+
+class RoutedLink(NamedTuple):
+    url: str
+    extractor: str
+    video_id: Optional[str]
+    # The link is a playlist/channel/album, it is expanded into a batch. None - the extractor can't tell
+    # (a channel tab, a post with one or several videos), a flat probe of the batch resolves it
+    is_playlist: Optional[bool] = False
+    time_range: Optional[TimeRange] = None
+
+    @property
+    def key(self) -> str:
+        """Canonical key for caching, dedup and history: the same media gives the same key for any link form.
+        A clip is a different file, its range is a part of the key"""
+        key = f'{self.extractor}:{self.video_id or self.url}'
+        if self.time_range is not None:
+            key += f'@{self.time_range.start}-{self.time_range.end or ""}'
+        return key
+
+
+def extract_links(text: str) -> List[Tuple[str, Optional[TimeRange]]]:
+    """Links of a message, one per line or separated by spaces, each one may be followed by its time range"""
+    links: List[Tuple[str, Optional[TimeRange]]] = []
+    for token in (text or '').split():
+        if url(token):
+            links.append((token, None))
+            continue
+        time_range = TimeRange.parse(token)
+        if time_range is not None and links and links[-1][1] is None:
+            links[-1] = (links[-1][0], time_range)
+    return links
+
+
+def normalize_link(text: str) -> str:
+    """Clean a link without network access: scheme, host case, fragment and position/tracking params"""
+    text = text.strip()
+    if '://' not in text:
+        text = 'https://' + text
+    parts = urlsplit(text)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k not in DROP_QUERY_PARAMS and not k.startswith(DROP_QUERY_PREFIXES)]
+    # A link to a video opened from a playlist means the video itself
+    if any(k == 'v' for k, _ in query):
+        query = [(k, v) for k, v in query if k != 'list']
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+
+class LinkRouter(object):
+    """Offline index over yt-dlp extractors: link -> (extractor, video id) using only _VALID_URL patterns.
+
+    Extractors are bucketed by the host literals of their patterns, so a link is matched against a few candidates.
+    Links which no extractor except the generic one can handle are rejected without starting a download."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._extractors: List[type] = []
+        self._by_host: Dict[str, List[int]] = {}
+        self._wildcard: List[int] = []
+
+    def build(self):
+        with self._lock:
+            if self._extractors:
+                return
+            from yt_dlp.extractor import gen_extractor_classes
+            for ie in gen_extractor_classes():
+                if ie.ie_key() == 'Generic':
+                    continue
+                position = len(self._extractors)
+                self._extractors.append(ie)
+                patterns = getattr(ie, '_VALID_URL', None)
+                if isinstance(patterns, str):
+                    patterns = [patterns]
+                hosts = set()
+                for pattern in patterns or []:
+                    hosts.update(h.replace('\\.', '.') for h in HOST_LITERAL_RE.findall(pattern.lower()))
+                if not hosts:
+                    self._wildcard.append(position)
+                for host in hosts:
+                    self._by_host.setdefault(host, []).append(position)
+                # yt-dlp compiles _VALID_URL at the first suitable(). Here it is done by the startup task, not by
+                # the first unsupported link which checks every extractor on a handler thread
+                try:
+                    ie.suitable('')
+                except Exception as e:
+                    log.debug(f'{ie.ie_key()}: {e}')
+            log.info(f'Link router has indexed {len(self._extractors)} extractors, {len(self._by_host)} hosts')
+
+    def _candidates(self, host: str) -> List[int]:
+        """Positions of extractors for the host and its parent domains, in yt-dlp priority order"""
+        positions = set(self._wildcard)
+        labels = host.split('.')
+        for i in range(len(labels) - 1):
+            positions.update(self._by_host.get('.'.join(labels[i:]), ()))
+        return sorted(positions)
+
+    def _match(self, url: str, positions) -> Optional[RoutedLink]:
+        for position in positions:
+            ie = self._extractors[position]
+            try:
+                if not ie.suitable(url):
+                    continue
+                video_id = ie.get_temp_id(url)
+                is_single_video = ie.is_single_video(url) if hasattr(ie, 'is_single_video') else None
+            except Exception as e:
+                log.exception(e)
+                continue
+            if is_single_video is None:
+                # normalize_link has dropped list= of a video link, the one which is left is a playlist
+                is_playlist = True if any(k == 'list' for k, _ in parse_qsl(urlsplit(url).query)) else None
+            else:
+                is_playlist = not is_single_video
+            return RoutedLink(url=url, extractor=ie.ie_key(), video_id=video_id, is_playlist=is_playlist)
+        return None
+
+    def route(self, text: str, time_range: Optional[TimeRange] = None) -> Optional[RoutedLink]:
+        """None means that the link is not supported. Without an explicit time range the &t= of the link is used"""
+        self.build()
+        url = normalize_link(text)
+        host = (urlsplit(url).hostname or '').lower()
+        routed = self._match(url, self._candidates(host))
+        if routed is None:
+            # Patterns without a plain host literal (youtube\.(?:com|de)) can still match, check all of them
+            routed = self._match(url, range(len(self._extractors)))
+        if routed is None or routed.is_playlist is True:
+            return routed
+        return routed._replace(time_range=time_range or TimeRange.from_link(text))
+
+
+link_router = LinkRouter()
@@ -0,0 +1,46 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class MenuSession(object):
+    """State of one menu message (page offset, ids of the shown entries ...), kept on the server side"""
+
+    def __init__(self, token: str, **state):
+        self.token = token
+        self.state = state
+        self.touched = time.monotonic()
+
+
+class MenuSessions(object):
+    """Menu sessions by a short token, callback_data carries only the token and the action instead of the whole state
+    (it is limited to 64 bytes). Old sessions expire after ttl_sec, at most max_size are kept"""
+
+    def __init__(self, ttl_sec: float = 3600, max_size: int = 200):
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.sessions: 'OrderedDict[str, MenuSession]' = OrderedDict()
+
+    def create(self, **state) -> MenuSession:
+        session = MenuSession(secrets.token_urlsafe(6), **state)
+        with self.lock:
+            self.sessions[session.token] = session
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+        return session
+
+    def get(self, token: str) -> Optional[MenuSession]:
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            if now - session.touched > self.ttl_sec:
+                del self.sessions[token]
+                return None
+            session.touched = now
+            self.sessions.move_to_end(token)
+            return session
@@ -9,7 +9,7 @@ from telebot.types import Message
 
 from config_parse import Config, BotConfig
 from lang_support import BOT_MSG
-from utils import retry, choose_language as lang, draw_progress_bar, ydl_percent_str_to_int, log_debug
+from utils import retry_in_background, choose_language as lang, draw_progress_bar, ydl_percent_str_to_int, log_debug
 
 cfg: BotConfig = Config()
 
@@ -55,19 +55,25 @@ def msg_editing_consumer(incoming_queue: queue.Queue, bot_obj: TeleBot):
             if message.message_str is None:
                 continue
             if message.with_retry:
-                retry(bot_obj.edit_message_text)(text=message.message_str, chat_id=message.message_obj.chat.id,
-                                                 message_id=message.message_obj.message_id, **message.kwargs)
+                # A failed edit is retried later by the timer thread, the next edits are not delayed
+                retry_in_background(bot_obj.edit_message_text)(text=message.message_str,
+                                                               chat_id=message.message_obj.chat.id,
+                                                               message_id=message.message_obj.message_id,
+                                                               **message.kwargs)
             else:
-                bot_obj.edit_message_text(text=message.message_str, chat_id=message.message_obj.chat.id,
-                                          message_id=message.message_obj.message_id, **message.kwargs)
+                try:
+                    bot_obj.edit_message_text(text=message.message_str, chat_id=message.message_obj.chat.id,
+                                              message_id=message.message_obj.message_id, **message.kwargs)
+                except Exception as e:
+                    log.debug(f'Progress edit is skipped: {e}')
     log.info("MSG consumer thread quit")
 
 
 def size_analyse_thread(file_name: str, duration: int, bitrate: int, message: Message, msg_queue: queue.Queue,
-                        exit_s: threading.Event):
+                        exit_s: threading.Event, ext: str = 'mp3'):
     """The thread which look up the size of file during converting and draw the status bar"""
     previous_message = ''
-    file_name = file_name + '.mp3'
+    file_name = file_name + '.' + ext
     predicted_size = duration * bitrate // 8 * 1000
     actual_size = 0
     last_call = 0.0
@@ -96,19 +102,36 @@ def size_analyse_thread(file_name: str, duration: int, bitrate: int, message: Me
                       block=False)
 
 
+_msg_threads_lock = threading.Lock()
+_msg_thread_count = 0
+
+
 def run_msg_threads(func, msg_queue: queue.Queue, bot: TeleBot):
-    for _ in range(cfg.advanced.msg_thread_count):
-        thread = threading.Thread(target=func, args=(msg_queue, bot))
-        thread.start()
+    """Start or stop consumers to have msg_thread_count of them, it is called again on a config reload"""
+    global _msg_thread_count
+    with _msg_threads_lock:
+        target = max(1, cfg.advanced.msg_thread_count)
+        for _ in range(target - _msg_thread_count):
+            thread = threading.Thread(target=func, args=(msg_queue, bot))
+            thread.start()
+        # A consumer quits when it gets Quit, the edits queued before it are still made
+        for _ in range(_msg_thread_count - target):
+            msg_queue.put(MSGMessage(command=MSGCommand.Quit))
+        if target != _msg_thread_count:
+            log.info(f'MSG consumers: {_msg_thread_count} -> {target}')
+        _msg_thread_count = target
 
 
 def close_msg_edit_thread(q: queue.Queue):
-    for _ in range(cfg.advanced.msg_thread_count):
-        q.put(MSGMessage(command=MSGCommand.Quit))
+    global _msg_thread_count
+    with _msg_threads_lock:
+        for _ in range(_msg_thread_count):
+            q.put(MSGMessage(command=MSGCommand.Quit))
+        _msg_thread_count = 0
 
 
-def get_download_progress_hook(bot_obj: TeleBot, message: Message, msg_queue: queue.Queue):
-    """Make a progress hook func"""
+def get_download_progress_hook(message: Message, msg_queue: queue.Queue):
+    """Make a progress hook func, every edit goes through msg_queue (the status message of a batch is shared)"""
 
     previous_call = 0.0
 
@@ -122,7 +145,7 @@ def get_download_progress_hook(bot_obj: TeleBot, message: Message, msg_queue: qu
             if now - previous_call > 1.0:
                 previous_call = now
                 msg_message = (BOT_MSG[lang(message)]['downloading_file'] +
-                               f" {str(ydl_status['filename']).lstrip(cfg.main.mp3_dir + os.path.sep)}\n")
+                               f" {os.path.basename(str(ydl_status['filename']))}\n")
                 status_bar = draw_progress_bar(ydl_percent_str_to_int(ydl_status['_percent_str']))
                 # Send info to MSG_Thread
                 message_to_edit = msg_message + status_bar
@@ -132,8 +155,8 @@ def get_download_progress_hook(bot_obj: TeleBot, message: Message, msg_queue: qu
             file_tuple = os.path.split(os.path.abspath(ydl_status['filename']))
             log.info(f'Done downloading {file_tuple[1]}')
             log_debug('ydl_status: ', ydl_status)
-            retry(bot_obj.edit_message_text)(chat_id=message.chat.id,
-                                             text=f'{BOT_MSG[lang(message)]["downloading_done"]} {file_tuple[1]}',
-                                             message_id=message.message_id)
+            done_text = f'{BOT_MSG[lang(message)]["downloading_done"]} {file_tuple[1]}'
+            msg_queue.put(MSGMessage(command=MSGCommand.Edit, message_object=message, message_str=done_text),
+                          block=False)
 
     return download_processing_hook
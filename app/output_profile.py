@@ -0,0 +1,105 @@
+import os
+from typing import List, NamedTuple, Optional, Tuple
+
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+from utils import calculate_mp3_bitrate
+
+cfg: BotConfig = Config()
+
+
+class OutputProfile(NamedTuple):
+    name: str
+    # preferredcodec of FFmpegExtractAudioPP, it is also the extension of the converted file
+    codec: str
+    # ffmpeg encoder and muxer for streaming transcode
+    encoder: str
+    muxer: str
+
+    @property
+    def ext(self) -> str:
+        return self.codec
+
+
+PROFILES = {
+    'mp3': OutputProfile('mp3', 'mp3', 'libmp3lame', 'mp3'),
+    'opus': OutputProfile('opus', 'opus', 'libopus', 'ogg'),
+    'aac': OutputProfile('aac', 'm4a', 'aac', 'ipod'),
+}
+# auto - mp3 while its bitrate is not under mp3_quality_floor, auto_codec for longer media
+PROFILE_PREFERENCES = ('auto',) + tuple(PROFILES)
+DEFAULT_PREFERENCE = 'auto'
+# Speech profile: on, off or auto - chosen by the info of the media (is_speech). Users opt in, it downmixes to mono
+SPEECH_MODES = ('auto', 'on', 'off')
+DEFAULT_SPEECH_MODE = 'off'
+
+
+def bitrates_of(profile: OutputProfile) -> List[int]:
+    if profile.name == 'opus':
+        return cfg.advanced.opus_bitrate
+    if profile.name == 'aac':
+        return cfg.advanced.aac_bitrate
+    return cfg.advanced.use_bitrate
+
+
+def speech_bitrates(bitrates: List[int]) -> List[int]:
+    """Mono voice doesn't need more than speech_max_bitrate"""
+    return [b for b in bitrates if b <= cfg.advanced.speech_max_bitrate] or bitrates[-1:]
+
+
+def choose_profile(preference: str, duration: Optional[float], speech: bool = False) -> Tuple[OutputProfile, int]:
+    """Profile and bitrate for the 50 MB limit, the bitrate is 0 if even the lowest one doesn't fit"""
+    def bitrate_for(profile: OutputProfile) -> int:
+        bitrates = bitrates_of(profile)
+        return calculate_mp3_bitrate(duration, speech_bitrates(bitrates) if speech else bitrates)
+
+    if preference in PROFILES:
+        profile = PROFILES[preference]
+        return profile, bitrate_for(profile)
+    mp3_bitrate = bitrate_for(PROFILES['mp3'])
+    if mp3_bitrate >= (cfg.advanced.speech_quality_floor if speech else cfg.advanced.mp3_quality_floor):
+        return PROFILES['mp3'], mp3_bitrate
+    profile = PROFILES[cfg.advanced.auto_codec]
+    bitrate = bitrate_for(profile)
+    if bitrate == 0:
+        return PROFILES['mp3'], mp3_bitrate
+    log.info(f'mp3 would be {mp3_bitrate} kbps, {profile.name} {bitrate} kbps is used')
+    return profile, bitrate
+
+
+def profile_of_file(file_path: str) -> OutputProfile:
+    ext = os.path.splitext(file_path)[1].lstrip('.').lower()
+    for profile in PROFILES.values():
+        if profile.ext == ext:
+            return profile
+    return PROFILES['mp3']
+
+
+def is_speech(speech_mode: str, info: dict, duration: Optional[float]) -> bool:
+    """auto: lectures, news, talks (speech_categories) and long media which is not music"""
+    if speech_mode != 'auto':
+        return speech_mode == 'on'
+    categories = info.get('categories') or []
+    if any(category in cfg.advanced.speech_categories for category in categories):
+        return True
+    return (cfg.advanced.speech_min_duration_sec > 0 and bool(duration)
+            and duration >= cfg.advanced.speech_min_duration_sec and 'Music' not in categories)
+
+
+def speech_ffmpeg_args() -> List[str]:
+    """Mono downmix, resampling and (optionally) long silences cut out"""
+    args = ['-ac', '1', '-ar', str(cfg.advanced.speech_sample_rate)]
+    if cfg.advanced.speech_trim_silence:
+        args += ['-af', f'silenceremove=stop_periods=-1:stop_duration={cfg.advanced.speech_silence_sec}'
+                        f':stop_threshold={cfg.advanced.speech_silence_db}dB']
+    return args
+
+
+def variant_key(source_key: str, preference: str, speech_mode: str = DEFAULT_SPEECH_MODE) -> str:
+    """Cache and storage key of the media converted for the preferences, the defaults keep the plain key"""
+    if preference != DEFAULT_PREFERENCE:
+        source_key += f'#{preference}'
+    if speech_mode != DEFAULT_SPEECH_MODE:
+        source_key += f'#speech-{speech_mode}'
+    return source_key
@@ -0,0 +1,139 @@
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+
+from telebot import logger as log
+
+from retry_policy import RetryLater, retry_scheduler
+
+# A task which comes back from a retry to a full stage queue tries again after this delay
+REQUEUE_DELAY_SEC = 0.5
+
+
+class StageExecutor(object):
+    """Worker threads of one stage with a bounded hand-off queue.
+
+    stage_func(task) returns True when the task should go to the next stage. Otherwise (failed, answered from cache,
+    last stage) the task is finished with its current task.success. RetryLater puts the task back into the queue of
+    the stage after its delay, the worker doesn't wait for it. input_queue replaces the FIFO hand-off queue,
+    it needs put(task, block) and get(block) (e.g. scheduler.JobScheduler)"""
+
+    def __init__(self, name: str, stage_func: Callable, workers: int, queue_size: int,
+                 next_stage: 'StageExecutor' = None, input_queue=None):
+        self.name = name
+        self.stage_func = stage_func
+        self.next_stage = next_stage
+        self.queue = input_queue if input_queue is not None else queue.Queue(maxsize=max(1, queue_size))
+        self.threads: List[threading.Thread] = []
+        self.lock = threading.Lock()
+        self.workers = 0
+        # Workers which should quit after their current task (resize down)
+        self.retiring = 0
+        self._started = 0
+        self.resize(workers)
+        log.info(f'Stage {name} has started with {self.workers} worker(s)')
+
+    def resize(self, workers: int):
+        """Grow at once, shrink when the extra workers have finished their current tasks"""
+        workers = max(1, workers)
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            grow = workers - self.workers
+            if grow < 0:
+                self.retiring -= grow
+            else:
+                # Workers which are still retiring are kept instead of starting new ones
+                kept = min(grow, self.retiring)
+                self.retiring -= kept
+                for _ in range(grow - kept):
+                    thread = threading.Thread(target=self._consumer, name=f'{self.name}-stage-{self._started}')
+                    self._started += 1
+                    thread.start()
+                    self.threads.append(thread)
+            if self.workers and workers != self.workers:
+                log.info(f'Stage {self.name}: {self.workers} -> {workers} worker(s)')
+            self.workers = workers
+
+    def _retire(self) -> bool:
+        with self.lock:
+            if self.retiring > 0:
+                self.retiring -= 1
+                return True
+            return False
+
+    def submit(self, task):
+        """Blocks while the stage queue is full, so a fast stage can't run away from a slow one"""
+        self.queue.put(task, block=True)
+
+    def _requeue(self, task):
+        # Runs on the retry timer thread, which must not block on a full queue
+        try:
+            self.queue.put(task, block=False)
+        except queue.Full:
+            retry_scheduler.schedule(REQUEUE_DELAY_SEC, lambda: self._requeue(task))
+
+    def _consumer(self):
+        while not self._retire():
+            try:
+                # The timeout lets a worker notice that it is retiring while the stage is idle
+                task = self.queue.get(block=True, timeout=1)
+            except queue.Empty:
+                continue
+            if task is None:
+                break
+            proceed = False
+            try:
+                proceed = self.stage_func(task)
+            except RetryLater as e:
+                log.info(f'Stage {self.name}: {task} is retried in {e.delay:.1f} s')
+                retry_scheduler.schedule(e.delay, lambda task=task: self._requeue(task))
+                continue
+            except Exception as e:
+                log.exception(e)
+                task.success = False
+            if proceed and self.next_stage is not None:
+                self.next_stage.submit(task)
+            else:
+                task.finish()
+        log.info(f'Stage {self.name} worker quit')
+
+    def shutdown(self):
+        # Retiring workers quit by themselves, the others get None
+        with self.lock:
+            workers = self.workers
+        for _ in range(workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Pipeline(object):
+    """Chain of stages, e.g. download -> transcode -> upload. Every stage works on its own task"""
+
+    def __init__(self, stages: List[StageExecutor]):
+        self.stages = stages
+
+    def submit(self, task):
+        self.stages[0].submit(task)
+
+    def resize(self, workers: Dict[str, int]):
+        """{stage name: workers}, the stages which are not mentioned are kept"""
+        for stage in self.stages:
+            if stage.name in workers:
+                stage.resize(workers[stage.name])
+
+    def shutdown(self):
+        # First stages first, their workers may still hand tasks to the next ones
+        for stage in self.stages:
+            stage.shutdown()
+
+
+def make_pipeline(stage_specs: List[tuple], queue_size: int) -> Pipeline:
+    """stage_specs: [(name, stage_func, workers[, input_queue]), ...] in processing order"""
+    stages: List[StageExecutor] = []
+    next_stage: Optional[StageExecutor] = None
+    for name, stage_func, workers, *input_queue in reversed(stage_specs):
+        next_stage = StageExecutor(name, stage_func, workers, queue_size, next_stage=next_stage,
+                                   input_queue=input_queue[0] if input_queue else None)
+        stages.insert(0, next_stage)
+    return Pipeline(stages)
@@ -0,0 +1,51 @@
+import queue
+from typing import Dict
+
+from sqlalchemy import select, update
+from telebot import logger as log
+
+from database.async_db_access import DBMessage, DBCommand, execute_with_result
+from database.schema import UserPreferences
+from output_profile import DEFAULT_PREFERENCE, DEFAULT_SPEECH_MODE
+
+# Column -> value for a user without a row
+PREFERENCE_DEFAULTS = {
+    'output_profile': DEFAULT_PREFERENCE,
+    'speech_mode': DEFAULT_SPEECH_MODE,
+}
+
+
+def get_preferences(db_request_queue: queue.Queue, user_id: int) -> Dict[str, str]:
+    """All the preferences of the user, the defaults if nothing is set or the DB doesn't answer"""
+    preferences = dict(PREFERENCE_DEFAULTS)
+    query = (select(*(getattr(UserPreferences, field) for field in PREFERENCE_DEFAULTS))
+             .where(UserPreferences.user_id == user_id))
+    result_queue = queue.Queue(maxsize=1)
+    db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                         block=False)
+    try:
+        rows = result_queue.get(block=True, timeout=10)
+    except queue.Empty as e:
+        log.exception(e)
+        return preferences
+    if rows:
+        preferences.update({field: value for field, value in zip(PREFERENCE_DEFAULTS, rows[0]) if value is not None})
+    return preferences
+
+
+def set_preference(db_request_queue: queue.Queue, user_id: int, field: str, value: str) -> bool:
+    """Update the row of the user or create it"""
+    updated = execute_with_result(db_request_queue, update(UserPreferences)
+                                  .where(UserPreferences.user_id == user_id).values({field: value}))
+    if updated is None:
+        return False
+    if updated:
+        return True
+    result_queue = queue.Queue(maxsize=1)
+    db_request_queue.put(DBMessage(command=DBCommand.AddNew, result_queue=result_queue,
+                                   db_obj=UserPreferences(user_id=user_id, **{field: value})), block=False)
+    try:
+        return bool(result_queue.get(block=True, timeout=10))
+    except queue.Empty as e:
+        log.exception(e)
+        return False
@@ -0,0 +1,352 @@
+import datetime
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import select, delete, case
+from telebot import logger as log
+from telebot.types import Message
+
+from config_parse import Config, BotConfig, QuotaLimits
+from database import dialect_insert
+from database.async_db_access import DBMessage, DBCommand, delete_items_with_result
+from database.schema import UserQuota, QuotaUsage
+
+cfg: BotConfig = Config()
+
+QUOTA_FIELDS = ('concurrent_jobs', 'jobs_per_hour', 'source_minutes_per_day', 'mb_per_day')
+
+
+def _current_day_and_hour():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.strftime('%Y-%m-%d'), int(now.timestamp() // 3600)
+
+
+class UsageCounters(object):
+    """Usage of one user in the current hour/day. base_* - what the DB has, delta_* - not yet persisted"""
+    __slots__ = ('day', 'hour', 'base_jobs', 'base_seconds', 'base_bytes', 'delta_jobs', 'delta_seconds',
+                 'delta_bytes')
+
+    def __init__(self, day: str, hour: int):
+        self.day = day
+        self.hour = hour
+        self.base_jobs = self.base_seconds = self.base_bytes = 0
+        self.delta_jobs = self.delta_seconds = self.delta_bytes = 0
+
+    def roll(self, day: str, hour: int):
+        if hour != self.hour:
+            self.hour = hour
+            self.base_jobs = self.delta_jobs = 0
+        if day != self.day:
+            self.day = day
+            self.base_seconds = self.base_bytes = self.delta_seconds = self.delta_bytes = 0
+
+    @property
+    def jobs_in_hour(self) -> int:
+        return self.base_jobs + self.delta_jobs
+
+    @property
+    def source_seconds(self) -> int:
+        return self.base_seconds + self.delta_seconds
+
+    @property
+    def bytes_sent(self) -> int:
+        return self.base_bytes + self.delta_bytes
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.delta_jobs or self.delta_seconds or self.delta_bytes)
+
+
+class QuotaManager(object):
+    """Admission control by per-user quotas (role limits from the config, overrides from user_quota).
+
+    The frontend (or the standalone bot) checks the quota before a link is extracted and counts the job, the process
+    which has made the job charges its source minutes and sent bytes. Counters live in memory and are merged with
+    quota_usage every quota.persist_sec, so several processes see the usage of each other with that delay"""
+
+    def __init__(self, db_request_queue: queue.Queue, is_admin: Callable[[int], bool] = None):
+        self.db_request_queue = db_request_queue
+        self.is_admin = is_admin
+        self.lock = threading.Lock()
+        self.counters: Dict[int, UsageCounters] = {}
+        self.overrides: Dict[int, Dict[str, Optional[int]]] = {}
+        # Admitted jobs which the dispatcher doesn't count yet, one admission of a user at a time
+        self.reserved: Dict[int, int] = {}
+        self._admission_locks: Dict[int, threading.Lock] = {}
+
+    def role_of(self, user_id: int) -> str:
+        if user_id in cfg.main.super_admin_list:
+            return 'superadmin'
+        if self.is_admin is not None and self.is_admin(user_id):
+            return 'admin'
+        return 'user'
+
+    def limits_of(self, user_id: int, role: str = None) -> QuotaLimits:
+        role = role or self.role_of(user_id)
+        limits = getattr(cfg.quota, role).model_copy()
+        for field, value in self.overrides.get(user_id, {}).items():
+            if value is not None:
+                setattr(limits, field, value)
+        return limits
+
+    def _counters(self, user_id: int) -> UsageCounters:
+        day, hour = _current_day_and_hour()
+        counters = self.counters.get(user_id)
+        if counters is None:
+            counters = self.counters[user_id] = UsageCounters(day, hour)
+        counters.roll(day, hour)
+        return counters
+
+    def admit(self, message: Message, active_jobs: Callable[[], int]) -> Optional[str]:
+        """None if the job is accepted (counted and reserved until settle()), else the BOT_MSG key of the reason.
+        active_jobs() - jobs of the user the dispatcher has, it is read together with the reservations, so two
+        messages at the same moment can't both take the last place"""
+        user_id = message.from_user.id
+        with self.lock:
+            admission_lock = self._admission_locks.setdefault(user_id, threading.Lock())
+        with admission_lock:
+            running = active_jobs()
+            with self.lock:
+                return self._admit(user_id, running + self.reserved.get(user_id, 0))
+
+    def _admit(self, user_id: int, active_jobs: int) -> Optional[str]:
+        limits = self.limits_of(user_id, self.role_of(user_id))
+        counters = self._counters(user_id)
+        if limits.concurrent_jobs and active_jobs >= limits.concurrent_jobs:
+            return 'quota_concurrent_jobs'
+        if limits.jobs_per_hour and counters.jobs_in_hour >= limits.jobs_per_hour:
+            return 'quota_jobs_per_hour'
+        if limits.source_minutes_per_day and counters.source_seconds >= limits.source_minutes_per_day * 60:
+            return 'quota_source_minutes'
+        if limits.mb_per_day and counters.bytes_sent >= limits.mb_per_day * 1024 ** 2:
+            return 'quota_mb_per_day'
+        counters.delta_jobs += 1
+        self.reserved[user_id] = self.reserved.get(user_id, 0) + 1
+        return None
+
+    def settle(self, user_id: int, dispatched: bool):
+        """End of an admission: the dispatcher counts the job now, or it hasn't been dispatched and is refunded"""
+        with self.lock:
+            reserved = self.reserved.get(user_id, 0) - 1
+            if reserved > 0:
+                self.reserved[user_id] = reserved
+            else:
+                self.reserved.pop(user_id, None)
+            counters = self._counters(user_id)
+            if not dispatched and counters.jobs_in_hour > 0:
+                counters.delta_jobs -= 1
+
+    def charge(self, user_id: int, source_seconds: int = 0, bytes_sent: int = 0):
+        if not source_seconds and not bytes_sent:
+            return
+        with self.lock:
+            counters = self._counters(user_id)
+            counters.delta_seconds += int(source_seconds)
+            counters.delta_bytes += int(bytes_sent)
+
+    def charge_task(self, task):
+        """Minutes which have been downloaded and bytes which have been sent, cache and storage hits are free"""
+        source_seconds = 0
+        if not task.from_storage and task.info is not None and task.file_path is not None:
+            source_seconds = task.duration or 0
+        self.charge(task.message.from_user.id, source_seconds, task.sent_bytes)
+
+    def usage(self, user_id: int) -> UsageCounters:
+        with self.lock:
+            return self._counters(user_id)
+
+    def usage_snapshot(self) -> Dict[int, UsageCounters]:
+        """Counters of the users who have done something today"""
+        with self.lock:
+            for user_id in self.counters:
+                self._counters(user_id)
+            return {user_id: counters for user_id, counters in self.counters.items()
+                    if counters.jobs_in_hour or counters.source_seconds or counters.bytes_sent}
+
+    def load_overrides(self):
+        result_queue = queue.Queue(maxsize=1)
+        self.db_request_queue.put(DBMessage(command=DBCommand.Select, result_queue=result_queue,
+                                            execute_obj=select(UserQuota.user_id,
+                                                               *(getattr(UserQuota, f) for f in QUOTA_FIELDS))),
+                                  block=False)
+        try:
+            rows = result_queue.get(block=True, timeout=10)
+        except queue.Empty as e:
+            log.exception(e)
+            return
+        if rows is None:
+            return
+        overrides = {}
+        for user_id, *values in rows:
+            overrides[user_id] = dict(zip(QUOTA_FIELDS, values))
+        with self.lock:
+            self.overrides = overrides
+
+    def set_override(self, user_id: int, values: Dict[str, Optional[int]]) -> bool:
+        """values: {field: limit or None}, an empty dict removes the override"""
+        query = delete(UserQuota).where(UserQuota.user_id == user_id)
+        if not delete_items_with_result(self.db_request_queue, [query]):
+            return False
+        if values:
+            result_queue = queue.Queue(maxsize=1)
+            self.db_request_queue.put(DBMessage(command=DBCommand.AddNew, result_queue=result_queue,
+                                                db_obj=UserQuota(user_id=user_id, **values)), block=False)
+            try:
+                if not result_queue.get(block=True, timeout=10):
+                    return False
+            except queue.Empty as e:
+                log.exception(e)
+                return False
+        with self.lock:
+            if values:
+                self.overrides[user_id] = {field: values.get(field) for field in QUOTA_FIELDS}
+            else:
+                self.overrides.pop(user_id, None)
+        return True
+
+    def persist(self):
+        """Write the deltas into quota_usage, then take the totals of all processes from it"""
+        with self.lock:
+            dirty = {}
+            for user_id, counters in self.counters.items():
+                if counters.dirty:
+                    dirty[user_id] = (counters.day, counters.hour, counters.delta_jobs, counters.delta_seconds,
+                                      counters.delta_bytes)
+                    counters.base_jobs += counters.delta_jobs
+                    counters.base_seconds += counters.delta_seconds
+                    counters.base_bytes += counters.delta_bytes
+                    counters.delta_jobs = counters.delta_seconds = counters.delta_bytes = 0
+        if dirty and not self._write_usage(dirty):
+            # Not lost, the next persist writes them again
+            with self.lock:
+                for user_id, (day, hour, jobs, seconds, bytes_sent) in dirty.items():
+                    counters = self._counters(user_id)
+                    if counters.hour == hour:
+                        counters.base_jobs -= jobs
+                        counters.delta_jobs += jobs
+                    if counters.day == day:
+                        counters.base_seconds -= seconds
+                        counters.delta_seconds += seconds
+                        counters.base_bytes -= bytes_sent
+                        counters.delta_bytes += bytes_sent
+        self._load_usage()
+
+    def _write_usage(self, dirty: Dict[int, tuple]) -> bool:
+        """One upsert per user in one transaction: the row is created or its counters are added to (reset when the
+        hour/day of the row is over), atomic for the bot and its workers"""
+        statements = []
+        for user_id, (day, hour, jobs, seconds, bytes_sent) in dirty.items():
+            statement = dialect_insert(QuotaUsage).values(user_id=user_id, day=day, hour=hour, jobs_in_hour=jobs,
+                                                          source_seconds=seconds, bytes_sent=bytes_sent)
+            new = statement.excluded
+            statements.append(statement.on_conflict_do_update(index_elements=['user_id'], set_={
+                'jobs_in_hour': case((QuotaUsage.hour == new.hour, QuotaUsage.jobs_in_hour + new.jobs_in_hour),
+                                     else_=new.jobs_in_hour),
+                'source_seconds': case((QuotaUsage.day == new.day, QuotaUsage.source_seconds + new.source_seconds),
+                                       else_=new.source_seconds),
+                'bytes_sent': case((QuotaUsage.day == new.day, QuotaUsage.bytes_sent + new.bytes_sent),
+                                   else_=new.bytes_sent),
+                'day': new.day,
+                'hour': new.hour,
+            }))
+        result_queue = queue.Queue(maxsize=1)
+        self.db_request_queue.put(DBMessage(command=DBCommand.Transaction, execute_objs=statements,
+                                            result_queue=result_queue), block=False)
+        try:
+            return result_queue.get(block=True, timeout=10)
+        except queue.Empty as e:
+            log.exception(e)
+            return False
+
+    def _load_usage(self):
+        day, hour = _current_day_and_hour()
+        query = select(QuotaUsage.user_id, QuotaUsage.day, QuotaUsage.hour, QuotaUsage.jobs_in_hour,
+                       QuotaUsage.source_seconds, QuotaUsage.bytes_sent).where(QuotaUsage.day == day)
+        result_queue = queue.Queue(maxsize=1)
+        self.db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                                  block=False)
+        try:
+            rows = result_queue.get(block=True, timeout=10)
+        except queue.Empty as e:
+            log.exception(e)
+            return
+        with self.lock:
+            for user_id, row_day, row_hour, jobs, seconds, bytes_sent in rows or []:
+                counters = self._counters(user_id)
+                counters.base_jobs = jobs if row_hour == hour else 0
+                counters.base_seconds = seconds
+                counters.base_bytes = bytes_sent
+
+    def persist_loop(self, exit_s: threading.Event):
+        log.info('Quota persist thread has started')
+        self.load_overrides()
+        self._load_usage()
+        while not exit_s.wait(cfg.quota.persist_sec):
+            started = time.time()
+            try:
+                self.persist()
+            except Exception as e:
+                log.exception(e)
+            log.debug(f'Quota counters persisted in {time.time() - started:.3f} sec')
+        # The last deltas are not lost on exit
+        self.persist()
+        log.info('Quota persist thread quit')
+
+    def run_persist_thread(self, exit_s: threading.Event) -> threading.Thread:
+        thread = threading.Thread(target=self.persist_loop, args=(exit_s,))
+        thread.start()
+        return thread
+
+
+def prepare_quota_report(quota: QuotaManager) -> str:
+    """Admin menu: usage of today"""
+    m = '<b>Quota usage today</b>\n'
+    usage = quota.usage_snapshot()
+    if not usage:
+        m += 'Nobody has used the bot today.\n'
+    for user_id, counters in sorted(usage.items(), key=lambda item: -item[1].source_seconds):
+        limits = quota.limits_of(user_id)
+        m += (f'[{user_id}] jobs/h: {counters.jobs_in_hour}/{limits.jobs_per_hour or "∞"}, '
+              f'min: {counters.source_seconds // 60}/{limits.source_minutes_per_day or "∞"}, '
+              f'MB: {counters.bytes_sent // 1024 ** 2}/{limits.mb_per_day or "∞"}'
+              f'{" (override)" if user_id in quota.overrides else ""}\n')
+    m += ('\n/quota &lt;user_id&gt; - show limits of a user\n'
+          '/quota &lt;user_id&gt; jobs_per_hour=10 mb_per_day=default - override limits (0 - unlimited)\n'
+          '/quota &lt;user_id&gt; reset - back to the role limits\n'
+          f'Fields: {", ".join(QUOTA_FIELDS)}')
+    return m
+
+
+def prepare_user_quota(quota: QuotaManager, user_id: int) -> str:
+    role = quota.role_of(user_id)
+    limits = quota.limits_of(user_id, role)
+    counters = quota.usage(user_id)
+    override = quota.overrides.get(user_id, {})
+    lines = [f'<b>[{user_id}]</b> role: {role}']
+    for field in QUOTA_FIELDS:
+        value = getattr(limits, field) or '∞'
+        lines.append(f'{field}: {value}{" (override)" if override.get(field) is not None else ""}')
+    lines.append(f'Used: {counters.jobs_in_hour} job(s) this hour, {counters.source_seconds // 60} min and '
+                 f'{counters.bytes_sent // 1024 ** 2} MB today')
+    return '\n'.join(lines)
+
+
+def parse_quota_override(args: List[str]) -> Optional[Dict[str, Optional[int]]]:
+    """['jobs_per_hour=10', 'mb_per_day=default'] -> {field: value}, None if something is wrong"""
+    values = {}
+    for arg in args:
+        field, _, value = arg.partition('=')
+        if field not in QUOTA_FIELDS:
+            return None
+        if value == 'default':
+            values[field] = None
+            continue
+        try:
+            values[field] = int(value)
+        except ValueError:
+            return None
+        if values[field] < 0:
+            return None
+    return values
@@ -0,0 +1,130 @@
+import os
+import shutil
+import threading
+from typing import Optional
+
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+from utils import potential_file_size, is_job_file
+
+cfg: BotConfig = Config()
+
+
+def estimate_job_size(info: dict, bitrate: int, clip_duration: float = None) -> Optional[int]:
+    """Bytes a job needs in its work dir: the selected source stream plus the converted file. None if unknown.
+    For a clip both are scaled to its duration"""
+    duration = info.get('duration')
+    source_size = info.get('filesize') or info.get('filesize_approx')
+    if not source_size and info.get('requested_formats'):
+        sizes = [f.get('filesize') or f.get('filesize_approx') for f in info['requested_formats']]
+        source_size = sum(sizes) if all(sizes) else None
+    if not source_size and duration and info.get('abr'):
+        source_size = duration * info['abr'] * 1000 / 8
+    if not source_size or not duration:
+        return None
+    if clip_duration is not None and clip_duration < duration:
+        source_size = source_size * clip_duration / duration
+        duration = clip_duration
+    return int(source_size + potential_file_size(duration, bitrate) * 1024 ** 2)
+
+
+class RamWorkDir(object):
+    """tmpfs directory for short clips. Source, converted file and upload never touch the disk; jobs which are too
+    big for it (or of unknown size) spill to mp3_dir"""
+
+    def __init__(self, path: str, max_file_mb: int, max_total_mb: int):
+        self.path = path
+        self.max_file = max_file_mb * 1024 ** 2
+        self.max_total = max_total_mb * 1024 ** 2
+        self.lock = threading.Lock()
+        self.used = 0
+        self._ready: Optional[bool] = None
+
+    def set_limits(self, max_file_mb: int, max_total_mb: int):
+        """Config reload, the reserved bytes of running jobs are kept"""
+        with self.lock:
+            self.max_file = max_file_mb * 1024 ** 2
+            self.max_total = max_total_mb * 1024 ** 2
+            self._ready = None
+
+    def _is_ready(self) -> bool:
+        if self._ready is None:
+            self._ready = False
+            if self.path and self.max_file > 0 and self.max_total > 0:
+                try:
+                    os.makedirs(self.path, exist_ok=True)
+                except Exception as e:
+                    log.exception(e)
+                else:
+                    self._ready = os.access(self.path, os.W_OK)
+            if not self._ready:
+                log.info('RAM work dir is disabled, all the jobs use mp3_dir')
+        return self._ready
+
+    def reserve(self, size: Optional[int]) -> bool:
+        """True if the job fits, it has to release() the same size when it is finished"""
+        if size is None or size > self.max_file:
+            return False
+        with self.lock:
+            if not self._is_ready() or self.used + size > self.max_total:
+                return False
+            self.used += size
+        return True
+
+    def release(self, size: int, base_path: str = None):
+        """Give back the reserved size and delete what the job has left in the dir"""
+        if base_path is not None:
+            self.discard(base_path)
+        with self.lock:
+            self.used = max(0, self.used - size)
+
+    def discard(self, base_path: str):
+        """Delete the files of the job with this base path, the files of other jobs in the dir are kept"""
+        stem = os.path.basename(base_path)
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if is_job_file(name, stem):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    log.exception(e)
+
+    def spill(self, file_path: str, target_dir: str) -> str:
+        """Move the file to the disk, the old path is returned if it has failed"""
+        target_path = os.path.join(target_dir, os.path.basename(file_path))
+        try:
+            shutil.move(file_path, target_path)
+        except Exception as e:
+            log.exception(e)
+            return file_path
+        return target_path
+
+    def contains(self, file_path: Optional[str]) -> bool:
+        return bool(file_path) and os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(self.path)
+
+
+_ram_work_dir: Optional[RamWorkDir] = None
+_ram_work_dir_lock = threading.Lock()
+
+
+def get_ram_work_dir() -> RamWorkDir:
+    """The RAM work dir of the config, created at the first use"""
+    global _ram_work_dir
+    with _ram_work_dir_lock:
+        if _ram_work_dir is None:
+            _ram_work_dir = RamWorkDir(cfg.advanced.ram_dir, cfg.advanced.ram_max_file_mb, cfg.advanced.ram_dir_max_mb)
+        return _ram_work_dir
+
+
+def _apply_limits(new_cfg: BotConfig):
+    if _ram_work_dir is not None:
+        _ram_work_dir.set_limits(new_cfg.advanced.ram_max_file_mb, new_cfg.advanced.ram_dir_max_mb)
+
+
+Config.on_reload(_apply_limits)
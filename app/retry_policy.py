@@ -0,0 +1,220 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+
+cfg: BotConfig = Config()
+
+# Errors of yt-dlp (by message) which will not go away on the next attempt
+PERMANENT_EXTRACTOR_MESSAGES = (
+    'video unavailable', 'private video', 'this video is not available', 'unsupported url', 'has been removed',
+    'copyright', 'members-only', 'join this channel', 'sign in to confirm your age', 'not available in your country',
+    'this live event will begin', 'premieres in', 'requested format is not available', 'no video formats found',
+)
+PERMANENT_EXCEPTIONS = {'UnsupportedError', 'GeoRestrictedError', 'FileNotFoundError', 'ValueError', 'TypeError',
+                        'KeyError'}
+# While the trial call of a half-open breaker runs, the rejected calls look again after this
+TRIAL_RETRY_SEC = 1.0
+
+
+class CircuitOpenError(Exception):
+    """The endpoint has failed too many times in a row, calls are rejected until the breaker cools down.
+    retry_after - seconds until the breaker is half-open"""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f'Circuit of {endpoint} is open, retry in {retry_after:.1f} s')
+        self.retry_after = retry_after
+
+
+class RetryLater(Exception):
+    """A pipeline stage gives its task back, the stage gets it again after delay seconds (utils.retry_later)"""
+
+    def __init__(self, delay: float):
+        super().__init__(f'retry in {delay:.1f} s')
+        self.delay = delay
+
+
+def _exception_names(e: BaseException) -> set:
+    return {cls.__name__ for cls in type(e).__mro__}
+
+
+def classify_error(e: BaseException) -> Tuple[bool, Optional[float]]:
+    """(is_transient, retry_after). Unknown errors are transient like before"""
+    if isinstance(e, CircuitOpenError):
+        # The endpoint is down for now, the call is made again when the breaker lets a trial through
+        return True, e.retry_after
+    names = _exception_names(e)
+    if names & PERMANENT_EXCEPTIONS:
+        return False, None
+    if 'ApiTelegramException' in names:
+        error_code = getattr(e, 'error_code', None)
+        if error_code == 429:
+            retry_after = None
+            try:
+                retry_after = float(e.result_json['parameters']['retry_after'])
+            except Exception:
+                pass
+            return True, retry_after
+        # 400 bad request, 403 blocked by user, 404 ... are the same on every attempt
+        return error_code is None or error_code >= 500, None
+    if 'DownloadError' in names or 'ExtractorError' in names:
+        message = str(e).lower()
+        if any(marker in message for marker in PERMANENT_EXTRACTOR_MESSAGES):
+            return False, None
+        exc_info = getattr(e, 'exc_info', None)
+        cause = exc_info[1] if exc_info else None
+        if cause is not None and cause is not e:
+            return classify_error(cause)
+        # ExtractorError(expected=True) is an error for the user, not a network problem
+        if getattr(e, 'expected', False):
+            return False, None
+    return True, None
+
+
+def backoff_delay(attempt: int, base: float = None, cap: float = None) -> float:
+    """Exponential backoff with full jitter"""
+    base = cfg.advanced.retry_base_delay if base is None else base
+    cap = cfg.advanced.retry_max_delay if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """closed -> open after failure_threshold transient failures in a row -> half-open after reset_sec (one trial call)
+    -> closed on success or open again on failure"""
+
+    def __init__(self, endpoint: str, failure_threshold: int, reset_sec: float):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_sec = reset_sec
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            cooling = self.reset_sec - (time.monotonic() - self.opened_at)
+            if cooling > 0 or self.trial_in_progress:
+                # Jitter: the waiting calls don't all come back at the same moment
+                retry_after = (cooling if cooling > 0 else TRIAL_RETRY_SEC) + random.uniform(0, TRIAL_RETRY_SEC)
+                raise CircuitOpenError(self.endpoint, retry_after)
+            self.trial_in_progress = True
+
+    def on_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log.info(f'Circuit of {self.endpoint} is closed')
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def on_failure(self, transient: bool):
+        with self.lock:
+            self.trial_in_progress = False
+            if not transient:
+                # Permanent errors are about the request, not about the endpoint
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    log.warning(f'Circuit of {self.endpoint} is open after {self.failures} failures')
+                self.opened_at = time.monotonic()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint, cfg.advanced.breaker_failure_threshold,
+                                                 cfg.advanced.breaker_reset_sec)
+        return _breakers[endpoint]
+
+
+def _apply_breaker_config(new_cfg: BotConfig):
+    """Config reload, the state of the breakers (failures, open) is kept"""
+    with _breakers_lock:
+        for breaker in _breakers.values():
+            with breaker.lock:
+                breaker.failure_threshold = new_cfg.advanced.breaker_failure_threshold
+                breaker.reset_sec = new_cfg.advanced.breaker_reset_sec
+
+
+Config.on_reload(_apply_breaker_config)
+
+
+def extractor_endpoint(ie_key: Optional[str]) -> str:
+    """Breaker of one extractor (extractor:Youtube), a failing site doesn't stop the others"""
+    return f'extractor:{ie_key}' if ie_key else 'extractor'
+
+
+def endpoint_of(fn: Callable) -> str:
+    """telegram for TeleBot methods, extractor for YoutubeDL methods (callers which know the extractor pass
+    extractor_endpoint()), the function name for the rest"""
+    owner = getattr(fn, '__self__', None)
+    if owner is not None:
+        names = {cls.__name__ for cls in type(owner).__mro__}
+        if 'TeleBot' in names:
+            return 'telegram'
+        if 'YoutubeDL' in names:
+            return 'extractor'
+    return getattr(fn, '__qualname__', str(fn))
+
+
+def call_with_breaker(fn: Callable, endpoint: str, *args, **kwargs):
+    breaker = get_breaker(endpoint)
+    breaker.before_call()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        breaker.on_failure(classify_error(e)[0])
+        raise
+    breaker.on_success()
+    return result
+
+
+class RetryScheduler(object):
+    """One timer thread for background retries, nobody sleeps in handler threads"""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, delay: float, callback: Callable):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='retry-scheduler', daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), callback))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                when, _, callback = self._heap[0]
+                now = time.monotonic()
+                if when > now:
+                    self._condition.wait(when - now)
+                    continue
+                heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception as e:
+                log.exception(e)
+
+
+retry_scheduler = RetryScheduler()
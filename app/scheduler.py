@@ -0,0 +1,100 @@
+import itertools
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from telebot.types import Message
+
+from config_parse import Config, BotConfig
+
+cfg: BotConfig = Config()
+
+
+class JobScheduler(object):
+    """Queue in front of the download stage. get() returns the task with the lowest score instead of the oldest one:
+
+    score = source (or clip) duration - lane bonus (admins, superadmins) - aging_factor * seconds in queue
+            + share penalty * jobs of the same user which are already downloading/converting/uploading
+
+    so short files go first, a long one can't wait forever and one user can't take all the workers"""
+
+    def __init__(self, maxsize: int, is_admin: Callable[[Message], bool] = None):
+        self.maxsize = max(1, maxsize)
+        self.is_admin = is_admin
+        self.condition = threading.Condition()
+        # (enqueued_at, sequence number, cost - lane bonus, task). The lane is found once at put(), get() doesn't
+        # ask is_admin for every pending task under the lock
+        self.pending: List[Tuple[float, int, float, object]] = []
+        self.counter = itertools.count()
+        self.quit_requests = 0
+        self.active_per_user: Dict[int, int] = {}
+
+    def resize(self, maxsize: int):
+        with self.condition:
+            self.maxsize = max(1, maxsize)
+            self.condition.notify_all()
+
+    def lane_bonus(self, message: Message) -> float:
+        if message.from_user.id in cfg.main.super_admin_list:
+            return cfg.advanced.sched_superadmin_bonus_sec
+        if self.is_admin is not None and self.is_admin(message):
+            return cfg.advanced.sched_admin_bonus_sec
+        return 0
+
+    @staticmethod
+    def cost(task) -> float:
+        """Seconds of media to download and convert, a file from the storage costs nothing"""
+        if task.file_path is not None:
+            return 0
+        return task.duration if task.duration else cfg.advanced.sched_unknown_duration_sec
+
+    def score(self, entry: Tuple[float, int, float, object], now: float) -> float:
+        enqueued_at, _, base_score, task = entry
+        user_id = task.message.from_user.id
+        return (base_score - cfg.advanced.sched_aging_factor * (now - enqueued_at)
+                + cfg.advanced.sched_user_share_penalty_sec * self.active_per_user.get(user_id, 0))
+
+    def put(self, task, block=True, timeout=None):
+        base_score = self.cost(task) - self.lane_bonus(task.message) if task is not None else 0
+        with self.condition:
+            if task is None:
+                # Quit request of a stage worker, returned only when nothing else is pending
+                self.quit_requests += 1
+                self.condition.notify_all()
+                return
+            if not self.condition.wait_for(lambda: len(self.pending) < self.maxsize,
+                                           timeout=timeout if block else 0):
+                raise queue.Full
+            self.pending.append((time.monotonic(), next(self.counter), base_score, task))
+            self.condition.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending or self.quit_requests,
+                                           timeout=timeout if block else 0):
+                raise queue.Empty
+            if not self.pending:
+                self.quit_requests -= 1
+                return None
+            now = time.monotonic()
+            entry = min(self.pending, key=lambda e: (self.score(e, now), e[1]))
+            self.pending.remove(entry)
+            task = entry[3]
+            user_id = task.message.from_user.id
+            self.active_per_user[user_id] = self.active_per_user.get(user_id, 0) + 1
+            self.condition.notify_all()
+        task.on_finish(lambda: self._release(user_id))
+        return task
+
+    def _release(self, user_id: int):
+        with self.condition:
+            count = self.active_per_user.get(user_id, 0) - 1
+            if count > 0:
+                self.active_per_user[user_id] = count
+            else:
+                self.active_per_user.pop(user_id, None)
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.pending)
@@ -0,0 +1,65 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from telebot import logger as log
+
+
+class StartupTimer(object):
+    """Durations of the startup steps, logged against the startup budget when the bot is ready"""
+
+    def __init__(self, budget_sec: float):
+        self.budget_sec = budget_sec
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.steps: Dict[str, float] = {}
+
+    def timed(self, name: str, fn: Callable[[], Any]) -> Callable[[], Any]:
+        def wrap():
+            started = time.monotonic()
+            try:
+                return fn()
+            finally:
+                with self.lock:
+                    self.steps[name] = time.monotonic() - started
+        return wrap
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def report(self) -> float:
+        elapsed = self.elapsed()
+        with self.lock:
+            steps = ', '.join(f'{name} {seconds:.2f}' for name, seconds in self.steps.items())
+        message = f'Startup has taken {elapsed:.2f} s of {self.budget_sec:.2f} s ({steps})'
+        if elapsed > self.budget_sec:
+            log.warning(message)
+        else:
+            log.info(message)
+        return elapsed
+
+
+def _log_background(timer: StartupTimer, name: str, future: Future):
+    if future.exception() is not None:
+        log.error(f'Startup task {name} has failed: {future.exception()}')
+    else:
+        log.info(f'Startup task {name} has finished in {timer.steps.get(name, 0):.2f} s')
+
+
+def run_startup_tasks(timer: StartupTimer, required: Dict[str, Callable[[], Any]],
+                      background: Dict[str, Callable[[], Any]] = None) -> Dict[str, Any]:
+    """Run the tasks concurrently, each in its own thread. Returns the results of the required ones when all of them
+    are done, an exception of a required task is raised. Background tasks (warm-ups, network calls which the first
+    updates don't need) go on after that, their errors are only logged"""
+    background = background or {}
+    executor = ThreadPoolExecutor(max_workers=max(1, len(required) + len(background)), thread_name_prefix='startup')
+    for name, fn in background.items():
+        executor.submit(timer.timed(name, fn)).add_done_callback(
+            lambda future, name=name: _log_background(timer, name, future))
+    futures = {name: executor.submit(timer.timed(name, fn)) for name, fn in required.items()}
+    try:
+        return {name: future.result() for name, future in futures.items()}
+    finally:
+        # Background tasks keep running, the executor threads quit after them
+        executor.shutdown(wait=False)
@@ -0,0 +1,216 @@
+import datetime
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select, update, delete, or_
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+from database.async_db_access import DBMessage, DBCommand, delete_items_with_result
+from database.schema import StoredFile
+from utils import TEMP_FILE_SUFFIXES, FRAGMENT_SUFFIX_RE, is_job_file
+
+cfg: BotConfig = Config()
+
+
+def _utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class StorageManager(object):
+    """Keeps converted files of this host in mp3_dir instead of deleting them after sending.
+
+    Every file has a StoredFile entry with its last access time. The total size is kept under mp3_dir_quota_mb and
+    the free space of the disk above mp3_dir_min_free_mb by deleting the least recently used files. Files which are
+    being sent right now are pinned and never deleted"""
+
+    def __init__(self, mp3_dir: str, db_request_queue: queue.Queue, host: str = None):
+        self.mp3_dir = mp3_dir
+        self.db_request_queue = db_request_queue
+        self.host = host or socket.gethostname()
+        self.lock = threading.Lock()
+        self.pinned: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return not cfg.advanced.auto_delete_files
+
+    def _select(self, query):
+        result_queue = queue.Queue(maxsize=1)
+        self.db_request_queue.put(DBMessage(command=DBCommand.Select, execute_obj=query, result_queue=result_queue),
+                                  block=False)
+        try:
+            return result_queue.get(block=True, timeout=10)
+        except queue.Empty as e:
+            log.exception(e)
+            return None
+
+    def pin(self, file_path: str):
+        with self.lock:
+            self.pinned[file_path] = self.pinned.get(file_path, 0) + 1
+
+    def unpin(self, file_path: str):
+        with self.lock:
+            count = self.pinned.get(file_path, 0) - 1
+            if count > 0:
+                self.pinned[file_path] = count
+            else:
+                self.pinned.pop(file_path, None)
+
+    def _is_pinned(self, file_path: str) -> bool:
+        with self.lock:
+            return file_path in self.pinned
+
+    def lookup(self, source_key: str) -> Optional[Tuple[str, int]]:
+        """(file_path, bitrate) of the already converted file, the file is pinned until unpin()"""
+        if not self.enabled:
+            return None
+        query = (select(StoredFile.id, StoredFile.file_path, StoredFile.bitrate)
+                 .where(StoredFile.host == self.host, StoredFile.source_key == source_key)
+                 .order_by(StoredFile.id.desc()).limit(1))
+        result = self._select(query)
+        if not result:
+            return None
+        stored_id, file_path, bitrate = result[0]
+        self.pin(file_path)
+        if not os.path.isfile(file_path):
+            # Removed by hand or by somebody else
+            self.unpin(file_path)
+            self.db_request_queue.put(DBMessage(command=DBCommand.Delete,
+                                                execute_objs=[delete(StoredFile).where(StoredFile.id == stored_id)]),
+                                      block=False)
+            return None
+        self.db_request_queue.put(DBMessage(command=DBCommand.Update,
+                                            execute_obj=update(StoredFile).where(StoredFile.id == stored_id)
+                                            .values(last_access=_utc_now())),
+                                  block=False)
+        return file_path, bitrate
+
+    def register(self, source_key: str, file_path: str, bitrate: int, title: str = None):
+        """Remember the file which has just been sent, then make room for the next ones"""
+        if not self.enabled or not os.path.isfile(file_path):
+            return
+        previous = self._select(select(StoredFile.file_path)
+                                .where(StoredFile.host == self.host, StoredFile.source_key == source_key)) or []
+        for (previous_path,) in previous:
+            if previous_path != file_path and not self._is_pinned(previous_path):
+                self._remove_file(previous_path)
+        stored_file = StoredFile(host=self.host, source_key=source_key, file_path=file_path,
+                                 size=os.path.getsize(file_path), bitrate=bitrate, title=title,
+                                 last_access=_utc_now())
+        delete_items_with_result(self.db_request_queue,
+                                 [delete(StoredFile).where(StoredFile.host == self.host,
+                                                           or_(StoredFile.source_key == source_key,
+                                                               StoredFile.file_path == file_path))])
+        self.db_request_queue.put(DBMessage(command=DBCommand.AddNew, db_obj=stored_file), block=False)
+        self.enforce()
+
+    @staticmethod
+    def _remove_file(file_path: str) -> bool:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.exception(e)
+            return False
+        return True
+
+    def _free_bytes(self) -> int:
+        try:
+            return shutil.disk_usage(self.mp3_dir).free
+        except Exception as e:
+            log.exception(e)
+            return 0
+
+    def enforce(self):
+        """Delete the least recently used files while the quota is exceeded or the disk is too full"""
+        if not self.enabled:
+            return
+        quota = cfg.advanced.mp3_dir_quota_mb * 1024 ** 2
+        min_free = cfg.advanced.mp3_dir_min_free_mb * 1024 ** 2
+        entries = self._select(select(StoredFile.id, StoredFile.file_path, StoredFile.size)
+                               .where(StoredFile.host == self.host)
+                               .order_by(StoredFile.last_access.asc()))
+        if entries is None:
+            return
+        total = sum(size for _, _, size in entries)
+        free = self._free_bytes()
+        evicted_ids = []
+        for stored_id, file_path, size in entries:
+            if total <= quota and free >= min_free:
+                break
+            if self._is_pinned(file_path):
+                continue
+            if self._remove_file(file_path):
+                evicted_ids.append(stored_id)
+                total -= size
+                free += size
+        if evicted_ids:
+            log.info(f'Storage: {len(evicted_ids)} file(s) evicted, {total / 1024 ** 2:.1f} MB is used')
+            delete_items_with_result(self.db_request_queue,
+                                     [delete(StoredFile).where(StoredFile.id.in_(evicted_ids))])
+        if free < min_free:
+            log.warning(f'Storage: only {free / 1024 ** 2:.1f} MB is free in {self.mp3_dir}')
+
+    @staticmethod
+    def _is_leftover(name: str, known_stems: set) -> bool:
+        """Unfinished files (.part, .ytdl, .temp.mp3, fragments ...) and sources of the stored files (Song.webm of Song.mp3).
+        Other files can be outputs (.m4a, .webm of opus) which are not registered yet, they are kept"""
+        if name.endswith(TEMP_FILE_SUFFIXES) or FRAGMENT_SUFFIX_RE.search(name):
+            return True
+        # Song.temp.mp3 of ffmpeg
+        if os.path.splitext(os.path.splitext(name)[0])[1] in TEMP_FILE_SUFFIXES:
+            return True
+        # The stem of a stored file can contain dots, every prefix before a dot is a candidate
+        return any(name[:position] in known_stems and is_job_file(name, name[:position])
+                   for position, char in enumerate(name) if char == '.')
+
+    def sweep_orphans(self):
+        """Delete leftovers of failed jobs which nobody has touched for orphan_max_age_sec"""
+        try:
+            names = os.listdir(self.mp3_dir)
+        except FileNotFoundError:
+            return
+        known = self._select(select(StoredFile.file_path).where(StoredFile.host == self.host)) or []
+        known_paths = {os.path.abspath(file_path) for (file_path,) in known}
+        known_stems = {os.path.splitext(os.path.basename(file_path))[0] for file_path in known_paths}
+        deadline = time.time() - cfg.advanced.orphan_max_age_sec
+        removed = 0
+        for name in names:
+            if not self._is_leftover(name, known_stems):
+                continue
+            file_path = os.path.join(self.mp3_dir, name)
+            if os.path.abspath(file_path) in known_paths or self._is_pinned(file_path):
+                continue
+            try:
+                if not os.path.isfile(file_path) or os.path.getmtime(file_path) > deadline:
+                    continue
+            except OSError:
+                continue
+            if self._remove_file(file_path):
+                removed += 1
+        if removed:
+            log.info(f'Storage: {removed} orphaned file(s) removed from {self.mp3_dir}')
+
+    def sweep(self, exit_s: threading.Event):
+        log.info('Storage sweep thread has started')
+        while True:
+            try:
+                self.sweep_orphans()
+                self.enforce()
+            except Exception as e:
+                log.exception(e)
+            if exit_s.wait(cfg.advanced.storage_sweep_sec):
+                break
+        log.info('Storage sweep thread quit')
+
+    def run_sweep_thread(self, exit_s: threading.Event) -> threading.Thread:
+        thread = threading.Thread(target=self.sweep, args=(exit_s,))
+        thread.start()
+        return thread
@@ -0,0 +1,115 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import Callable, Iterator, List, Optional
+
+from telebot import logger as log
+from telebot.types import Message
+
+from config_parse import Config, BotConfig
+from lang_support import BOT_MSG
+from msg_editor import MSGMessage, MSGCommand
+from output_profile import OutputProfile, PROFILES
+from utils import choose_language as lang, draw_progress_bar, delete_file_from_server
+
+cfg: BotConfig = Config()
+
+# Single progressive files only, fragmented formats (dash, m3u8) go through the usual download
+STREAMABLE_PROTOCOLS = ('http', 'https')
+# YouTube throttles a connection which reads a big file in one request
+RANGE_CHUNK_SIZE = 10 * 1024 ** 2
+READ_SIZE = 64 * 1024
+
+
+def is_streamable(info: dict) -> bool:
+    return (cfg.advanced.stream_transcode and bool(info.get('url')) and not info.get('requested_formats')
+            and info.get('protocol') in STREAMABLE_PROTOCOLS and not info.get('is_live'))
+
+
+def iter_source(ydl, info: dict) -> Iterator[bytes]:
+    """Bytes of the selected format, in Range requests of RANGE_CHUNK_SIZE when the size is known"""
+    from yt_dlp.networking import Request
+    headers = dict(info.get('http_headers') or {})
+    total = info.get('filesize')
+    if not total:
+        with ydl.urlopen(Request(info['url'], headers=headers)) as response:
+            while True:
+                data = response.read(READ_SIZE)
+                if not data:
+                    return
+                yield data
+    start = 0
+    while start < total:
+        end = min(start + RANGE_CHUNK_SIZE, total) - 1
+        with ydl.urlopen(Request(info['url'], headers={**headers, 'Range': f'bytes={start}-{end}'})) as response:
+            while True:
+                data = response.read(READ_SIZE)
+                if not data:
+                    break
+                start += len(data)
+                yield data
+        if start <= end:
+            raise IOError(f'Source stream ended at {start} of {total} bytes')
+
+
+def stream_transcode(ydl, info: dict, output_path: str, bitrate: int,
+                     on_progress: Callable[[int], None] = None, profile: OutputProfile = PROFILES['mp3'],
+                     extra_args: List[str] = None) -> bool:
+    """Pipe the source into ffmpeg while it is being downloaded, so converting runs together with the transfer.
+    extra_args are output options (channels, sample rate, filters)"""
+    from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+    ffmpeg = FFmpegPostProcessor(ydl).executable or 'ffmpeg'
+    part_path = output_path + '.part'
+    process = subprocess.Popen([ffmpeg, '-y', '-loglevel', 'error', '-i', 'pipe:0', '-vn', '-codec:a', profile.encoder,
+                                '-b:a', f'{bitrate}k', *(extra_args or []), '-f', profile.muxer, part_path],
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # stderr is read by its own thread, a chatty ffmpeg can't block the pipe
+    stderr_chunks = []
+    stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()))
+    stderr_thread.start()
+    total = info.get('filesize') or info.get('filesize_approx')
+    received = 0
+    try:
+        for data in iter_source(ydl, info):
+            process.stdin.write(data)
+            received += len(data)
+            if on_progress is not None and total:
+                on_progress(min(99, received * 100 // total))
+        process.stdin.close()
+    except Exception as e:
+        log.exception(e)
+        process.kill()
+        process.wait()
+        stderr_thread.join()
+        delete_file_from_server(part_path)
+        return False
+    process.wait()
+    stderr_thread.join()
+    if process.returncode != 0:
+        log.error(f'ffmpeg has failed: {b"".join(stderr_chunks).decode(errors="replace")}')
+        delete_file_from_server(part_path)
+        return False
+    os.replace(part_path, output_path)
+    if on_progress is not None:
+        on_progress(100)
+    return True
+
+
+def get_stream_progress_callback(message: Message, msg_queue: Optional[queue.Queue],
+                                 file_name: str) -> Callable[[int], None]:
+    """One status bar for downloading and converting"""
+    previous_call = 0.0
+    message_str = BOT_MSG[lang(message)]['streaming_file'] + ' ' + os.path.basename(file_name) + '\n'
+
+    def on_progress(p: int):
+        nonlocal previous_call
+        now = time.time()
+        if msg_queue is None or (now - previous_call < 1.0 and p != 100):
+            return
+        previous_call = now
+        msg_queue.put(MSGMessage(command=MSGCommand.Edit, message_object=message,
+                                 message_str=message_str + draw_progress_bar(p), with_retry=False), block=False)
+
+    return on_progress
@@ -1,3 +1,4 @@
+import html
 import os
 import re
 import time
@@ -9,26 +10,44 @@ from telebot.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, C
 
 from config_parse import Config, BotConfig
 from lang_support import BOT_MSG
+from retry_policy import classify_error, backoff_delay, call_with_breaker, endpoint_of, retry_scheduler, \
+    RetryLater
 
 cfg: BotConfig = Config()
 
+# Unfinished files of yt-dlp and ffmpeg: Song.webm.part, Song.webm.ytdl, Song.temp.mp3 ...
+TEMP_FILE_SUFFIXES = ('.part', '.ytdl', '.temp', '.tmp')
+# Fragments of DASH/HLS (Song.webm.part-Frag12) and format ids of merged formats (Song.f251.webm)
+FRAGMENT_SUFFIX_RE = re.compile(r'-Frag\d+(?:\.part)?$')
+FORMAT_ID_RE = re.compile(r'^\.f[\w-]+$')
 
-def retry(fn):
-    """Decorator for making separate attempts of using func. If somthing goes wrong, lets try again :)"""
 
-    def wrap(*args, gen_answer=None, bot_obj=None, tg_message_obj=None, tg_error_msg=None, retry_delay=1.0,
-             max_attempt=cfg.advanced.max_attempt,
+def retry(fn):
+    """Decorator for making separate attempts of using func. If somthing goes wrong, lets try again :)
+    Permanent errors are not retried, transient ones wait for exponential backoff with jitter (or Telegram's
+    retry_after). Every endpoint (telegram, extractor) has a circuit breaker.
+    The calling thread sleeps between the attempts, so it is only for threads which run one job of their own
+    (batch, history export). Pipeline stages use retry_later, calls without a needed result retry_in_background"""
+
+    def wrap(*args, gen_answer=None, bot_obj=None, tg_message_obj=None, tg_error_msg=None, retry_delay=None,
+             max_attempt=None, endpoint=None,
              **kwargs):
+        endpoint = endpoint or endpoint_of(fn)
+        # Read at the call, not captured at import: the config can be reloaded
+        max_attempt = max_attempt or cfg.advanced.max_attempt
         attempt = 0
         while attempt < max_attempt:
             attempt += 1
             log_debug(f'Starting wrap with fn:{str(fn)}, attempt {attempt}')
             try:
-                result = fn(*args, **kwargs)
+                result = call_with_breaker(fn, endpoint, *args, **kwargs)
             except Exception as e:
-                log.info(f'Attempt: {attempt} unsuccessful')
+                transient, retry_after = classify_error(e)
+                log.info(f'Attempt: {attempt} unsuccessful, {"transient" if transient else "permanent"} error')
                 log.exception(e)
-                time.sleep(retry_delay)
+                if not transient or attempt >= max_attempt:
+                    break
+                time.sleep(retry_after if retry_after is not None else backoff_delay(attempt, base=retry_delay))
                 continue
             else:
                 return result
@@ -38,6 +57,56 @@ def retry(fn):
     return wrap
 
 
+def retry_in_background(fn):
+    """retry for calls whose result is not needed (edits, deletes, notices). The first attempt is made at once,
+    the next ones are scheduled on the retry timer thread, so the calling thread never sleeps"""
+
+    def wrap(*args, max_attempt=None, endpoint=None, **kwargs):
+        endpoint = endpoint or endpoint_of(fn)
+        max_attempt = max_attempt or cfg.advanced.max_attempt
+
+        def attempt_call(attempt: int):
+            try:
+                call_with_breaker(fn, endpoint, *args, **kwargs)
+            except Exception as e:
+                transient, retry_after = classify_error(e)
+                log.info(f'Background attempt: {attempt} of {str(fn)} unsuccessful')
+                log.exception(e)
+                if transient and attempt < max_attempt:
+                    delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                    retry_scheduler.schedule(delay, lambda: attempt_call(attempt + 1))
+
+        attempt_call(1)
+
+    return wrap
+
+
+def retry_later(fn):
+    """retry for pipeline stages: one attempt per call. A transient error raises RetryLater, the stage worker
+    takes the next task and the task comes back to the stage after the backoff. attempts ({key: attempts made})
+    is kept by the task, so the stage function has to be safe to run again up to the retried call"""
+
+    def wrap(*args, attempts: dict, key: str, gen_answer=None, bot_obj=None, tg_message_obj=None,
+             tg_error_msg=None, max_attempt=None, endpoint=None, **kwargs):
+        endpoint = endpoint or endpoint_of(fn)
+        max_attempt = max_attempt or cfg.advanced.max_attempt
+        attempt = attempts.get(key, 0) + 1
+        attempts[key] = attempt
+        log_debug(f'Starting wrap with fn:{str(fn)}, attempt {attempt}')
+        try:
+            return call_with_breaker(fn, endpoint, *args, **kwargs)
+        except Exception as e:
+            transient, retry_after = classify_error(e)
+            log.info(f'Attempt: {attempt} unsuccessful, {"transient" if transient else "permanent"} error')
+            log.exception(e)
+            if transient and attempt < max_attempt:
+                raise RetryLater(retry_after if retry_after is not None else backoff_delay(attempt))
+        if gen_answer:
+            bot_answer_with_error(bot_obj, tg_message_obj, tg_error_msg)
+
+    return wrap
+
+
 def bot_answer_with_error(bot_obj: TeleBot, message: Message, msg: str) -> None:
     """Send 'bad news' to telegram user"""
     log.error(msg)
@@ -67,12 +136,12 @@ def choose_language(*messages: Message) -> str:
     return 'EN'
 
 
-def calculate_mp3_bitrate(video_duration: int) -> int:
-    """Calculate a bitrate for telegram_API-50MB sending limit"""
+def calculate_mp3_bitrate(video_duration: int, bitrates: List[int] = None) -> int:
+    """Calculate a bitrate for telegram_API-50MB sending limit, bitrates (best first) of another codec can be given"""
 
     log.info(f'Video duration is: {video_duration} sec')
     bitrate_to_set = 0
-    for bitrate in cfg.advanced.use_bitrate:
+    for bitrate in bitrates or cfg.advanced.use_bitrate:
         if potential_file_size(video_duration, bitrate) < 50:
             bitrate_to_set = bitrate
             break
@@ -123,10 +192,13 @@ def ydl_percent_str_to_int(ydl_status_str: str) -> int:
         return p
 
 
-def send_audio_file(bot: TeleBot, file_path: str, message: Message, delete_file=cfg.advanced.auto_delete_files,
-                    send_timeout=cfg.advanced.send_timeout):
+def send_audio_file(bot: TeleBot, file_path: str, message: Message, delete_file: bool = None,
+                    send_timeout: int = None) -> Message:
+    """None - the current value of the config (auto_delete_files, send_timeout)"""
     if not os.path.exists(file_path):
         raise FileNotFoundError
+    delete_file = cfg.advanced.auto_delete_files if delete_file is None else delete_file
+    send_timeout = send_timeout or cfg.advanced.send_timeout
     file_size = os.path.getsize(file_path) / 1024 ** 2
     msg_to_delete = bot.send_message(message.chat.id,
                                      f'{BOT_MSG[choose_language(message)]["file_sending_started"]}:'
@@ -138,6 +210,25 @@ def send_audio_file(bot: TeleBot, file_path: str, message: Message, delete_file=
             delete_file_from_server(file_path)
     finally:
         bot.delete_message(message.chat.id, msg_to_delete.message_id)
+    return msg
+
+
+def is_job_file(name: str, stem: str) -> bool:
+    """The file of a job with this stem: Song, Song.webm, Song.mp3, Song.webm.part, Song.f251.webm.part-Frag3.
+    The stem is compared exactly, "Song (Live).webm" of another job is not a file of Song"""
+    name = FRAGMENT_SUFFIX_RE.sub('', name)
+    while name != stem and name.endswith(TEMP_FILE_SUFFIXES):
+        name = name[:name.rindex('.')]
+    if name == stem:
+        return True
+    base, ext = os.path.splitext(name)
+    if not ext:
+        return False
+    if base == stem:
+        return True
+    # Song.f251.webm, Song.temp.mp3
+    head, middle = os.path.splitext(base)
+    return head == stem and bool(FORMAT_ID_RE.match(middle) or middle in TEMP_FILE_SUFFIXES)
 
 
 def delete_file_from_server(file_path: str) -> None:
@@ -174,8 +265,10 @@ class AdmMenuState(str):
     delete_all_users = 'admin-menu-delete-all-users'
     edit_users = 'admin-menu-edit-users'
     back_to_main = 'admin-menu-back-to-main'
-    edit_user_privilege = 'admin-menu-edit-user-privilege'
     accept_or_decline = 'admin-menu-accept-decline'
+    quotas = 'admin-menu-quotas'
+    search_history = 'admin-menu-search-history'
+    statistics = 'admin-menu-statistics'
 
     @staticmethod
     def delete_callback_data_prefix(prefix, callback_data) -> str:
@@ -188,24 +281,60 @@ def get_main_admin_menu() -> InlineKeyboardMarkup:
     button_exit = InlineKeyboardButton('Exit', callback_data=AdmMenuState.exit)
     button_users_ad = InlineKeyboardButton('Show History', callback_data=AdmMenuState.show_history)
     button_admin_ad = InlineKeyboardButton('Add / Delete User', callback_data=AdmMenuState.user_control)
-    menu.add(button_users_ad, button_admin_ad, button_exit)
+    button_quotas = InlineKeyboardButton('Quotas', callback_data=AdmMenuState.quotas)
+    button_search = InlineKeyboardButton('Search History', callback_data=AdmMenuState.search_history)
+    button_statistics = InlineKeyboardButton('Statistics', callback_data=AdmMenuState.statistics)
+    menu.add(button_users_ad, button_admin_ad, button_quotas, button_search, button_statistics, button_exit)
     return menu
 
 
-def make_user_edit_buttons(user_id: int, is_admin: Optional[bool], is_user: Optional[bool]) -> (
-        Tuple)[InlineKeyboardButton, InlineKeyboardButton]:
-    if is_admin:
-        is_admin_label = 'Withdraw Admin'
-    else:
-        is_admin_label = 'Grant Admin'
-    if is_user:
-        is_user_label = 'Withdraw User'
-    else:
-        is_user_label = 'Grant User'
-    return (InlineKeyboardButton(text=is_admin_label, callback_data=AdmMenuState.edit_user_privilege +
-                                                                    f'{user_id}-{is_admin_label.replace(" ", "")}'),
-            InlineKeyboardButton(text=is_user_label, callback_data=AdmMenuState.edit_user_privilege +
-                                                                   f'{user_id}-{is_user_label.replace(" ", "")}'))
+# Privilege action -> (is_admin, is_user)
+USER_PRIVILEGE_ACTIONS = {'WithdrawAdmin': (False, True), 'GrantAdmin': (True, True),
+                          'WithdrawUser': (False, False), 'GrantUser': (False, True)}
+USER_PRIVILEGE_LABELS = {'WithdrawAdmin': 'Withdraw Admin', 'GrantAdmin': 'Grant Admin',
+                         'WithdrawUser': 'Withdraw User', 'GrantUser': 'Grant User'}
+
+
+def privilege_action(role: str, is_admin: Optional[bool], is_user: Optional[bool]) -> str:
+    """Button of the user browser: role 'a' switches the admin privilege, 'u' the user one"""
+    if role == 'a':
+        return 'WithdrawAdmin' if is_admin else 'GrantAdmin'
+    return 'WithdrawUser' if is_user else 'GrantUser'
+
+
+def parse_menu_callback(callback_data: str, prefix: str) -> Tuple[str, str]:
+    """<prefix><session token>:<action> -> (token, action)"""
+    token, _, action = callback_data[len(prefix):].partition(':')
+    return token, action
+
+
+def make_user_browser(token: str, entries: Sequence, count: int, offset: int, per_page: int) -> (
+        Tuple)[str, InlineKeyboardMarkup]:
+    """One message with a page of users and buttons for each of them.
+    entries: (id, user_name, first_name, last_name, is_user, is_admin)"""
+    callback_prefix = AdmMenuState.edit_users + token + ':'
+    lines = [f'<b>Users</b> {offset + 1 if entries else 0}-{offset + len(entries)} of {count}\n']
+    menu = InlineKeyboardMarkup(row_width=2)
+    for index, entry in enumerate(entries):
+        user_id, user_name, first_name, _, is_user, is_admin = entry
+        roles = ', '.join(role for role, granted in (('admin', is_admin), ('user', is_user)) if granted) or '-'
+        name = html.escape(first_name or '') + (f' @{html.escape(user_name)}' if user_name else '')
+        lines.append(f'{index + 1}. <b>{name}</b> [{user_id}] {roles}')
+        buttons = []
+        for role in ('a', 'u'):
+            label = USER_PRIVILEGE_LABELS[privilege_action(role, is_admin, is_user)]
+            buttons.append(InlineKeyboardButton(f'{index + 1}. {label}',
+                                                callback_data=callback_prefix + f'{role}{index}'))
+        menu.add(*buttons)
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton('<<', callback_data=callback_prefix + 'prev'))
+    if count - (offset + per_page) > 0:
+        navigation.append(InlineKeyboardButton('>>', callback_data=callback_prefix + 'next'))
+    if navigation:
+        menu.add(*navigation, row_width=len(navigation))
+    menu.add(make_back_button(AdmMenuState.user_control))
+    return '\n'.join(lines), menu
 
 
 def prepare_user_history_str_message(message: Message, entries: Sequence, count: int, current_offset: int) -> str:
@@ -0,0 +1,114 @@
+import hmac
+import json
+import queue
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from telebot import TeleBot, logger as log
+from telebot.types import Update
+
+from config_parse import Config, BotConfig
+
+cfg: BotConfig = Config()
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Telegram updates are small, anything bigger is not an update
+MAX_BODY_SIZE = 1024 ** 2
+
+
+class UpdateIntake(object):
+    """Bounded queue between the HTTP server and the handler dispatch. When it is full the server answers 503 and
+    Telegram delivers the update again later"""
+
+    def __init__(self, bot: TeleBot, size: int, threads: int):
+        self.bot = bot
+        self.queue = queue.Queue(maxsize=max(1, size))
+        self.threads: List[threading.Thread] = []
+        for _ in range(max(1, threads)):
+            thread = threading.Thread(target=self._consumer)
+            thread.start()
+            self.threads.append(thread)
+
+    def offer(self, update: Update) -> bool:
+        try:
+            self.queue.put_nowait(update)
+        except queue.Full:
+            log.warning('Webhook intake queue is full, update is rejected')
+            return False
+        return True
+
+    def _consumer(self):
+        while True:
+            update = self.queue.get(block=True)
+            if update is None:
+                break
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                log.exception(e)
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def make_webhook_handler(intake: UpdateIntake, path: str, secret_token: str):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self._answer(404)
+                return
+            if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), secret_token):
+                log.warning(f'Webhook request with a wrong secret token from {self.client_address[0]}')
+                self._answer(403)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = 0
+            if not 0 < length <= MAX_BODY_SIZE:
+                self._answer(400)
+                return
+            try:
+                update = Update.de_json(json.loads(self.rfile.read(length)))
+            except Exception as e:
+                log.exception(e)
+                self._answer(400)
+                return
+            self._answer(200 if intake.offer(update) else 503)
+
+        def _answer(self, code: int):
+            self.send_response(code)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            log.debug('Webhook: ' + format % args)
+
+    return WebhookHandler
+
+
+def run_webhook(bot: TeleBot):
+    """Receive updates via a local HTTP server (behind a reverse proxy with TLS) until KeyboardInterrupt"""
+    webhook_cfg = cfg.webhook
+    if not webhook_cfg.public_url:
+        log.critical('Webhook mode requires "public_url" in the "webhook" config section')
+        raise Exception("Webhook public_url is not set")
+    secret_token = webhook_cfg.secret_token or secrets.token_urlsafe(32)
+    intake = UpdateIntake(bot, webhook_cfg.intake_queue_size, webhook_cfg.intake_threads)
+    server = ThreadingHTTPServer((webhook_cfg.listen_host, webhook_cfg.listen_port),
+                                 make_webhook_handler(intake, webhook_cfg.path, secret_token))
+    bot.remove_webhook()
+    bot.set_webhook(url=webhook_cfg.public_url.rstrip('/') + webhook_cfg.path, secret_token=secret_token,
+                    max_connections=webhook_cfg.max_connections)
+    log.info(f'Webhook server is listening on {webhook_cfg.listen_host}:{webhook_cfg.listen_port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        bot.remove_webhook()
+        intake.close()
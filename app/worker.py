@@ -0,0 +1,108 @@
+"""Media worker process. Claims jobs from the job store, downloads, converts and uploads files.
+
+Run it next to the bot started with "run_mode": "frontend":  python -m worker
+"""
+import logging
+import os
+import queue
+import signal
+import socket
+import threading
+
+from telebot import apihelper, logger, TeleBot
+
+from config_parse import Config, reload_on_sighup
+from database import get_engine
+from database.async_db_access import DBCommand, DBMessage, db_consumer, run_db_thread
+from downloader import make_download_pipeline
+from handler_filters import IsAdmin
+from job_store import JobProgressQueue, LeaseKeeper, wait_for_job, finish_job
+from pipeline import Pipeline
+from quota import QuotaManager
+from startup import StartupTimer, run_startup_tasks
+from storage_manager import StorageManager
+from ydl_pool import ydl_pool
+
+cfg = Config()
+apihelper.RETRY_ON_ERROR = True
+log = logger
+log.setLevel(logging.INFO)
+
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
+
+
+def job_consumer(pipeline: Pipeline, db_request_queue: queue.Queue, exit_s: threading.Event,
+                 lease_keeper: LeaseKeeper, quota: QuotaManager):
+    """Claims jobs and feeds the pipeline, blocks while the download stage is full"""
+    worker_id = lease_keeper.worker_id
+    while not exit_s.is_set():
+        task = wait_for_job(db_request_queue, worker_id, exit_s, cfg.advanced.worker_poll_interval)
+        if task is None:
+            break
+        log.info(f'{worker_id} has claimed {task}')
+        lease_keeper.add(task.job_id)
+        task.msg_queue = JobProgressQueue(db_request_queue, task.job_id)
+        task.on_done = lambda success, job_id=task.job_id: _on_job_done(db_request_queue, lease_keeper, job_id,
+                                                                        success)
+        task.on_finish(lambda t=task: quota.charge_task(t))
+        pipeline.submit(task)
+
+
+def _on_job_done(db_request_queue: queue.Queue, lease_keeper: LeaseKeeper, job_id: int, success: bool):
+    lease_keeper.remove(job_id)
+    finish_job(db_request_queue, job_id, lease_keeper.worker_id, success)
+
+
+def main():
+    timer = StartupTimer(Config.load().advanced.startup_budget_sec)
+    bot = TeleBot(cfg.main.telegram_token)
+    timer.timed('database', get_engine)()
+    db_request_queue = queue.Queue()
+    run_db_thread(db_consumer, db_request_queue)
+    storage = StorageManager(cfg.main.mp3_dir, db_request_queue)
+    # Admin jobs have their own lane in the scheduler. The first claimed jobs don't wait for the YoutubeDL warm-up
+    admin_filter = IsAdmin(db_request_queue)
+    run_startup_tasks(timer, required={'admins': admin_filter.update_users},
+                      background={'ydl pool': ydl_pool.warm_up})
+    pipeline = make_download_pipeline(bot, db_request_queue, storage, is_admin=admin_filter.check)
+
+    exit_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: exit_event.set())
+    reload_on_sighup()
+    lease_keeper = LeaseKeeper(db_request_queue, WORKER_ID)
+    heartbeat_exit = threading.Event()
+    heartbeat_thread = lease_keeper.run_heartbeat_thread(heartbeat_exit)
+    storage_thread = storage.run_sweep_thread(heartbeat_exit)
+    # Only charges the usage, admission is made by the frontend
+    quota = QuotaManager(db_request_queue)
+    quota_thread = quota.run_persist_thread(heartbeat_exit)
+    threads = []
+    for _ in range(cfg.advanced.worker_threads):
+        thread = threading.Thread(target=job_consumer, args=(pipeline, db_request_queue, exit_event, lease_keeper,
+                                                             quota))
+        thread.start()
+        threads.append(thread)
+    timer.report()
+    log.info(f'Worker {WORKER_ID} has started with {len(threads)} thread(s)')
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        exit_event.set()
+    finally:
+        # Claimed jobs are finished before quitting
+        for thread in threads:
+            thread.join()
+        pipeline.shutdown()
+        heartbeat_exit.set()
+        heartbeat_thread.join()
+        storage_thread.join()
+        quota_thread.join()
+        ydl_pool.close()
+        db_request_queue.put(DBMessage(command=DBCommand.Quit))
+        print('Worker quit')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+from telebot import logger as log
+
+from config_parse import Config, BotConfig
+
+cfg: BotConfig = Config()
+
+# Params shared by all jobs, job specific params (hooks, outtmpl, PPs) are set by MyYoutubeDL.prepare_for_job
+BASE_YDL_PARAMS = {
+    'format': 'bestaudio/best',
+    'no_color': True,
+    'logger': log,
+}
+# Extractors which are created during warm-up
+WARM_UP_EXTRACTORS = ('Youtube', 'YoutubeTab')
+
+
+class YoutubeDLPool(object):
+    """Long-lived MyYoutubeDL instances, one instance serves one job at a time"""
+
+    def __init__(self, size: int = None, base_params: dict = None):
+        # None - ydl_pool_size of the config, read at the first use
+        self._size = None if size is None else max(1, size)
+        self.base_params = base_params or BASE_YDL_PARAMS
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = max(1, cfg.advanced.ydl_pool_size)
+        return self._size
+
+    def _new_instance(self):
+        # yt-dlp is imported by the first instance, not at the start of the bot
+        from youtube_dl_modified_objects import MyYoutubeDL
+        ydl = MyYoutubeDL(params=dict(self.base_params))
+        for ie_key in WARM_UP_EXTRACTORS:
+            try:
+                ydl.get_info_extractor(ie_key)
+            except Exception as e:
+                log.exception(e)
+        return ydl
+
+    def warm_up(self):
+        """Create all instances at startup, so the first jobs don't pay for it"""
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            self._idle.put(self._new_instance())
+        log.info(f'YoutubeDL pool is ready with {self.size} instance(s)')
+
+    @contextmanager
+    def acquire(self, job_params: dict):
+        ydl = None
+        try:
+            ydl = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            ydl = self._new_instance() if create else self._idle.get(block=True)
+        ydl.prepare_for_job(job_params)
+        try:
+            yield ydl
+        finally:
+            # Drop references to the job objects (hooks with messages, PPs) before the instance waits for the next job
+            ydl.prepare_for_job({})
+            with self._lock:
+                # The pool has been resized down, the instance isn't needed anymore
+                surplus = self._created > self.size
+                if surplus:
+                    self._created -= 1
+            if surplus:
+                ydl.__exit__(None, None, None)
+            else:
+                self._idle.put(ydl)
+
+    def resize(self, size: int):
+        """New instances are created on demand, the extra ones are closed when they become idle"""
+        with self._lock:
+            if size == self.size:
+                return
+            log.info(f'YoutubeDL pool: {self.size} -> {max(1, size)} instance(s)')
+            self._size = max(1, size)
+        while True:
+            with self._lock:
+                if self._created <= self.size:
+                    break
+                try:
+                    ydl = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                self._created -= 1
+            ydl.__exit__(None, None, None)
+
+    def close(self):
+        while True:
+            try:
+                ydl = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            ydl.__exit__(None, None, None)
+
+
+ydl_pool = YoutubeDLPool()
+Config.on_reload(lambda new_cfg: ydl_pool.resize(new_cfg.advanced.ydl_pool_size))
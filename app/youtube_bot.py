@@ -1,84 +1,102 @@
 import logging
-import os
 import queue
+import threading
+from typing import Callable, List, Optional, Tuple
 
 from sqlalchemy import select, update, func, delete
 from telebot import apihelper, logger, TeleBot
 from telebot.types import Message, BotCommand, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from validators import url
+from telebot.types import InlineQuery, InlineQueryResultCachedAudio, InlineQueryResultsButton
 
-from config_parse import Config
+from config_parse import Config, reload_on_sighup
+from database import get_engine
 from database.async_db_access import DBCommand, DBMessage, db_consumer, delete_items_with_result
 from database.async_db_access import run_db_thread, select_entries_and_count
 from database.schema import TelegramUser, BotHistory, UserPermissions, Chat
 from handler_filters import IsUser, IsAdmin
+from history_export import EXPORT_FORMATS, start_history_export
+from history_search import SEARCH_USAGE, HistoryQuery, parse_search_args, search_history, prepare_search_result
+from inline_index import AudioIndex, DeepLinks
+from job_metrics import prepare_statistics_report
+from menu_sessions import MenuSessions
 from lang_support import BOT_MSG
+from dispatch import JobDispatcher, make_dispatcher
+from downloader import make_download_pipeline
+from job_store import run_job_progress_thread
+from link_router import link_router, extract_links
 from middlewares import UserCollectMiddleware
-from msg_editor import run_msg_threads, msg_editing_consumer, close_msg_edit_thread, get_download_progress_hook
+from output_profile import PROFILE_PREFERENCES, SPEECH_MODES
+from pipeline import Pipeline
+from preferences import get_preferences, set_preference
+from msg_editor import run_msg_threads, msg_editing_consumer, close_msg_edit_thread
+from quota import QuotaManager, prepare_quota_report, prepare_user_quota, parse_quota_override
+from startup import StartupTimer, run_startup_tasks
+from storage_manager import StorageManager
 from utils import choose_language as lang
-from utils import retry, bot_answer_with_error, log_debug, calculate_mp3_bitrate, file_name_manipulate, \
-    make_back_button, specify_user_privilege_msg, AdmMenuState, get_main_admin_menu, make_user_edit_buttons, \
-    prepare_user_history_str_message, normalize_count_result, get_offset_and_id_list
-from youtube_dl_modified_objects import MyYoutubeDL, ControlledPostProcessor
+from webhook_server import run_webhook
+from ydl_pool import ydl_pool
+from utils import retry_in_background, bot_answer_with_error, make_back_button, specify_user_privilege_msg, \
+    AdmMenuState, get_main_admin_menu, make_user_browser, prepare_user_history_str_message, \
+    normalize_count_result, get_offset_and_id_list, parse_menu_callback, privilege_action, USER_PRIVILEGE_ACTIONS
 
 ########################################################################################################################
 # Config Const
 BOT_VERSION = 0.1
 
 cfg = Config()
-MP3_DIR = cfg.main.mp3_dir
-MAX_ATTEMPT = cfg.advanced.max_attempt
-SEND_TIMEOUT = cfg.advanced.send_timeout
-AUTO_DELETE_FILE = cfg.advanced.auto_delete_files
-HISTORY_PER_PAGE = cfg.advanced.history_entries_on_page
-USER_PER_PAGE = cfg.advanced.users_on_page
-
-########################################################################################################################
-# Setup Bot
-apihelper.RETRY_ON_ERROR = True
-bot = TeleBot(cfg.main.telegram_token, num_threads=10, use_class_middlewares=True)
 log = logger
-log.setLevel(logging.INFO)
-
-########################################################################################################################
-# Run DB Thread
-
-db_request_queue = queue.Queue()
-run_db_thread(db_consumer, db_request_queue)
-########################################################################################################################
-# Run MSG edit threads
-msg_edit_queue = queue.Queue()
-run_msg_threads(msg_editing_consumer, msg_edit_queue, bot)
 
-########################################################################################################################
-
-command_id = BotCommand('id', 'Shows your telegram user ID')
-command_admin = BotCommand('admin', 'Shows admin menu')
-bot.set_my_commands(commands=[command_id, command_admin])
-
-########################################################################################################################
-# Create and install filters.
-
-user_filter = IsUser(db_request_queue)
-user_filter.update_users()
-admin_filter = IsAdmin(db_request_queue)
-admin_filter.update_users()
-bot.add_custom_filter(user_filter)
-bot.add_custom_filter(admin_filter)
+BOT_COMMANDS = [
+    BotCommand('id', 'Shows your telegram user ID'),
+    BotCommand('admin', 'Shows admin menu'),
+    BotCommand('format', 'Chooses the audio format: auto, mp3, opus, aac'),
+    BotCommand('speech', 'Mono speech encoding for talks and lectures: auto, on, off'),
+]
+# Threads which run the handlers, of TeleBot or of the executor of async_bot
+HANDLER_THREADS = 10
 
 ########################################################################################################################
-# Middleware
-
-bot.use_class_middlewares = True
-middleware = UserCollectMiddleware(db_request_queue)
-bot.setup_middleware(middleware)
+# Application state. Nothing is started at import, create_app() builds it and registers the handlers
+
+bot: Optional[TeleBot] = None
+db_request_queue: Optional[queue.Queue] = None
+msg_edit_queue: Optional[queue.Queue] = None
+job_progress_exit: Optional[threading.Event] = None
+user_filter: Optional[IsUser] = None
+admin_filter: Optional[IsAdmin] = None
+middleware: Optional[UserCollectMiddleware] = None
+quota: Optional[QuotaManager] = None
+quota_exit: Optional[threading.Event] = None
+quota_thread: Optional[threading.Thread] = None
+audio_index: Optional[AudioIndex] = None
+inline_exit: Optional[threading.Event] = None
+inline_thread: Optional[threading.Thread] = None
+deep_links: Optional[DeepLinks] = None
+menu_sessions: Optional[MenuSessions] = None
+download_pipeline: Optional[Pipeline] = None
+storage: Optional[StorageManager] = None
+storage_exit: Optional[threading.Event] = None
+dispatcher: Optional[JobDispatcher] = None
+
+# (kind, callback, filters) in the order of declaration, which is the order telebot checks them
+_handlers: List[Tuple[str, Callable, dict]] = []
+
+
+def handler(kind: str, **filters):
+    """Declares a handler at import, create_app() registers it on the bot: kind is message, callback_query or inline"""
+
+    def decorator(fn):
+        _handlers.append((kind, fn, filters))
+        return fn
+
+    return decorator
 
 
 ########################################################################################################################
 # Bot Functions
 
 
-@bot.callback_query_handler(is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.accept_or_decline))
+@handler('callback_query', is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.accept_or_decline))
 def admin_menu_accept_or_delcine(call: CallbackQuery):
     menu = InlineKeyboardMarkup(row_width=2)
     yes_button_suffix = 'yes'
@@ -92,7 +110,8 @@ def admin_menu_accept_or_delcine(call: CallbackQuery):
             if not delete_items_with_result(db_request_queue, queries):
                 delete_action_msg = delete_action_msg_err
             menu.add(make_back_button(AdmMenuState.back_to_main))
-            retry(bot.edit_message_text)(delete_action_msg, call.message.chat.id, call.message.id, reply_markup=menu)
+            retry_in_background(bot.edit_message_text)(delete_action_msg, call.message.chat.id, call.message.id,
+                                                       reply_markup=menu)
             return
         # Ask a question about history
         no_button_callback_data = AdmMenuState.show_history
@@ -100,8 +119,8 @@ def admin_menu_accept_or_delcine(call: CallbackQuery):
                                                                yes_button_suffix)
         no_button = InlineKeyboardButton('No', callback_data=no_button_callback_data)
         menu.add(yes_button, no_button)
-        retry(bot.edit_message_text)('Are you sure, you want to clear all the history?', call.message.chat.id,
-                                     call.message.id, reply_markup=menu)
+        retry_in_background(bot.edit_message_text)('Are you sure, you want to clear all the history?',
+                                                   call.message.chat.id, call.message.id, reply_markup=menu)
         return
     if callback_data_suffix.startswith('user-data'):
         if callback_data_suffix.endswith('yes'):
@@ -124,7 +143,8 @@ def admin_menu_accept_or_delcine(call: CallbackQuery):
                     if not delete_items_with_result(db_request_queue, queries):
                         delete_action_msg = delete_action_msg_err
             menu.add(make_back_button(AdmMenuState.back_to_main))
-            retry(bot.edit_message_text)(delete_action_msg, call.message.chat.id, call.message.id, reply_markup=menu)
+            retry_in_background(bot.edit_message_text)(delete_action_msg, call.message.chat.id, call.message.id,
+                                                       reply_markup=menu)
             middleware.update_known_list()
             return
         # Ask a question about deleting all unauthorised users
@@ -133,39 +153,13 @@ def admin_menu_accept_or_delcine(call: CallbackQuery):
                                                                yes_button_suffix)
         no_button = InlineKeyboardButton('No', callback_data=no_button_callback_data)
         menu.add(yes_button, no_button)
-        retry(bot.edit_message_text)('Are you sure, you want to delete all unauthorised users?', call.message.chat.id,
-                                     call.message.id, reply_markup=menu)
+        retry_in_background(bot.edit_message_text)('Are you sure, you want to delete all unauthorised users?',
+                                                   call.message.chat.id, call.message.id, reply_markup=menu)
         return
 
 
-@bot.callback_query_handler(is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.edit_user_privilege))
-def admin_menu_edit_user_privilege(call: CallbackQuery):
-    callback_data_suffix = AdmMenuState.delete_callback_data_prefix(AdmMenuState.edit_user_privilege, call.data)
-    if not callback_data_suffix:
-        log.error("Can't edit user, somthing wrong with callback bata: ", call.data)
-        return
-    callback_data_list = callback_data_suffix.split('-')
-    try:
-        user_id = int(callback_data_list[0])
-    except ValueError as exp:
-        log.exception(exp)
-        return
-    is_admin = None
-    is_user = None
-    action = callback_data_list[1]
-    if action == 'WithdrawAdmin':
-        is_admin = False
-        is_user = True
-    if action == 'GrantAdmin':
-        is_admin = True
-        is_user = True
-    if action == 'WithdrawUser':
-        is_user = False
-        is_admin = False
-    if action == 'GrantUser':
-        is_user = True
-        is_admin = False
-
+def change_user_privilege(user_id: int, role: str) -> bool:
+    """Switch the admin (role 'a') or user ('u') privilege of the user and tell him about it"""
     select_query = (select(TelegramUser.id, TelegramUser.user_name, TelegramUser.first_name, TelegramUser.last_name,
                            UserPermissions.is_user, UserPermissions.is_admin, Chat.id, TelegramUser.language_code)
                     .outerjoin(UserPermissions).join(Chat)).where(TelegramUser.id == user_id)
@@ -176,57 +170,48 @@ def admin_menu_edit_user_privilege(call: CallbackQuery):
         result = answer_queue.get(block=True, timeout=10)
     except Exception as exp:
         log.exception(exp)
-        return None
+        return False
+    if not result:
+        log.error('Db receive no result during edit user request ')
+        return False
+    entry = result[0]
+    is_admin, is_user = USER_PRIVILEGE_ACTIONS[privilege_action(role, entry[5], entry[4])]
+    result_queue = queue.Queue()
+    if entry[4] is None and entry[5] is None:
+        db_request_queue.put(DBMessage(command=DBCommand.AddNew, db_obj=UserPermissions(
+            user_id=user_id,
+            is_user=is_user,
+            is_admin=is_admin
+        ), result_queue=result_queue), block=False)
     else:
-        if not result:
-            log.error('Db receive no result during edit user request ')
-            return
-        entry = result[0]
-        result_queue = queue.Queue()
-        if entry[4] is None and entry[5] is None:
-            db_request_queue.put(DBMessage(command=DBCommand.AddNew, db_obj=UserPermissions(
-                user_id=user_id,
-                is_user=is_user,
-                is_admin=is_admin
-            ), result_queue=result_queue), block=False)
-
-        else:
-            query = update(UserPermissions)
-            db_request_queue.put(DBMessage(UserPermissions.get_update_data(user_id, is_admin, is_user),
-                                           command=DBCommand.Update, execute_obj=query, result_queue=result_queue),
-                                 block=False)
-
-        if not result_queue.get(block=True, timeout=10):
-            log.error('Db receive no result during create user_permission request ')
-            return
-        edit_menu = InlineKeyboardMarkup(row_width=2)
-        edit_menu.add(*make_user_edit_buttons(entry[0], is_admin=is_admin, is_user=is_user))
-        retry(bot.edit_message_text)(f'<b>{entry[2]}</b>[{entry[0]}]', call.message.chat.id, call.message.id,
-                                     reply_markup=edit_menu, parse_mode='HTML')
-        admin_filter.update_users()
-        user_filter.update_users()
-        retry(bot.send_message)(entry[6], specify_user_privilege_msg(entry[2], entry[7], is_admin, is_user))
-
-
-@bot.callback_query_handler(is_admin=True, func=lambda c: c.data == AdmMenuState.back_to_main)
+        query = update(UserPermissions)
+        db_request_queue.put(DBMessage(UserPermissions.get_update_data(user_id, is_admin, is_user),
+                                       command=DBCommand.Update, execute_obj=query, result_queue=result_queue),
+                             block=False)
+    if not result_queue.get(block=True, timeout=10):
+        log.error('Db receive no result during create user_permission request ')
+        return False
+    admin_filter.update_users()
+    user_filter.update_users()
+    retry_in_background(bot.send_message)(entry[6], specify_user_privilege_msg(entry[2], entry[7], is_admin, is_user))
+    return True
+
+
+@handler('callback_query', is_admin=True, func=lambda c: c.data == AdmMenuState.back_to_main)
 def admin_menu_back_to_main_menu(call: CallbackQuery):
     """Return to main Admin menu"""
-    retry(bot.edit_message_text)('Welcome to Admin menu!', call.message.chat.id, call.message.id,
-                                 reply_markup=get_main_admin_menu())
+    retry_in_background(bot.edit_message_text)('Welcome to Admin menu!', call.message.chat.id, call.message.id,
+                                               reply_markup=get_main_admin_menu())
 
 
-@bot.callback_query_handler(is_admin=True, func=lambda c: c.data == AdmMenuState.exit)
+@handler('callback_query', is_admin=True, func=lambda c: c.data == AdmMenuState.exit)
 def admin_menu_exit(call: CallbackQuery):
     """Close Admin Menu"""
     bot.delete_message(call.message.chat.id, call.message.id)
 
 
-@bot.callback_query_handler(is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.user_control))
+@handler('callback_query', is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.user_control))
 def admin_menu_edit_users_submenu(call: CallbackQuery):
-    suffix = call.data[len(AdmMenuState.user_control):]
-    if suffix:
-        for message in suffix.split('-'):
-            bot.delete_message(call.message.chat.id, int(message))
     menu = InlineKeyboardMarkup(row_width=2)
     clear_all_users = InlineKeyboardButton('Delete All Unauthorised',
                                            callback_data=AdmMenuState.accept_or_decline + 'user-data')
@@ -235,19 +220,19 @@ def admin_menu_edit_users_submenu(call: CallbackQuery):
     bot.edit_message_text('User Privilege menu', call.message.chat.id, call.message.id, reply_markup=menu)
 
 
-@bot.callback_query_handler(is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.show_history))
+@handler('callback_query', is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.show_history))
 def admin_menu_show_history(call: CallbackQuery):
     """Admin menu callback function, process buttons pushing and show and edit the message"""
 
     current_offset, _ = get_offset_and_id_list(call, prefix=AdmMenuState.show_history)
+    per_page = cfg.advanced.history_entries_on_page
     prev_offset = 0
-    next_offset = current_offset + HISTORY_PER_PAGE
+    next_offset = current_offset + per_page
     if current_offset:
-        prev_offset = current_offset - HISTORY_PER_PAGE
+        prev_offset = current_offset - per_page
 
     entries_query = (select(TelegramUser.id, TelegramUser.first_name, BotHistory.msg_text, BotHistory.created_date)
-    .join(BotHistory).order_by(BotHistory.created_date.desc()).offset(current_offset).limit(
-        HISTORY_PER_PAGE))
+    .join(BotHistory).order_by(BotHistory.created_date.desc()).offset(current_offset).limit(per_page))
     count_query = select(func.count('*')).select_from(BotHistory)
     result = select_entries_and_count(entries_query, count_query, db_request_queue)
     if result is None:
@@ -276,181 +261,429 @@ def admin_menu_show_history(call: CallbackQuery):
     menu.add(button_delete_all_history)
     menu.add(make_back_button(AdmMenuState.back_to_main))
 
-    retry(bot.edit_message_text)(str_answer, call.message.chat.id, call.message.id,
-                                 disable_web_page_preview=True, parse_mode='HTML', reply_markup=menu)
+    retry_in_background(bot.edit_message_text)(str_answer, call.message.chat.id, call.message.id,
+                                               disable_web_page_preview=True, parse_mode='HTML', reply_markup=menu)
 
 
-@bot.callback_query_handler(is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.edit_users))
-def admin_menu_edit_users_menu(call: CallbackQuery):
-    """Shows users as separated messages, incoming call.data can have a current offset and list of message_ids"""
+@handler('callback_query', is_admin=True, func=lambda c: c.data == AdmMenuState.quotas)
+def admin_menu_quotas(call: CallbackQuery):
+    """Usage of today, quotas are changed by the /quota command"""
+    menu = InlineKeyboardMarkup()
+    menu.add(make_back_button(AdmMenuState.back_to_main))
+    retry_in_background(bot.edit_message_text)(prepare_quota_report(quota), call.message.chat.id, call.message.id,
+                                               parse_mode='HTML', reply_markup=menu)
+
 
-    retry(bot.delete_message)(call.message.chat.id, call.message.id, max_attempt=2)
-    current_offset, message_list = get_offset_and_id_list(call, prefix=AdmMenuState.edit_users)
+@handler('message', is_admin=True, commands=['quota'])
+def admin_quota_command(message: Message):
+    """/quota <user_id> [field=value ... | reset] - show or override quotas of a user"""
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        retry_in_background(bot.send_message)(message.chat.id, prepare_quota_report(quota), parse_mode='HTML')
+        return
+    user_id = int(args[0])
+    if len(args) > 1:
+        values = {} if args[1:] == ['reset'] else parse_quota_override(args[1:])
+        if values is None:
+            retry_in_background(bot.send_message)(message.chat.id, 'Wrong quota fields or values')
+            return
+        if values:
+            # The fields which are not mentioned keep their override
+            values = {**quota.overrides.get(user_id, {}), **values}
+            values = values if any(v is not None for v in values.values()) else {}
+        if not quota.set_override(user_id, values):
+            bot_answer_with_error(bot, message, BOT_MSG[lang(message)]['db_answer_fail'])
+            return
+    retry_in_background(bot.send_message)(message.chat.id, prepare_user_quota(quota, user_id), parse_mode='HTML')
 
-    for message_id in message_list:
-        retry(bot.delete_message)(call.message.chat.id, message_id, max_attempt=2)
 
-    next_offset = current_offset + USER_PER_PAGE
-    prev_offset = 0
-    if current_offset:
-        prev_offset = current_offset - USER_PER_PAGE
+@handler('callback_query', is_admin=True, func=lambda c: c.data == AdmMenuState.search_history)
+def admin_menu_search_history(call: CallbackQuery):
+    """The history is searched by the /search command"""
+    menu = InlineKeyboardMarkup()
+    menu.add(make_back_button(AdmMenuState.back_to_main))
+    retry_in_background(bot.edit_message_text)(SEARCH_USAGE, call.message.chat.id, call.message.id,
+                                               parse_mode='HTML', reply_markup=menu)
+
+
+@handler('message', is_admin=True, commands=['reload'])
+def admin_reload_command(message: Message):
+    """/reload - apply the config file without a restart (the same as SIGHUP)"""
+    try:
+        changed = Config.reload()
+    except ValueError as e:
+        retry_in_background(bot.send_message)(message.chat.id, f'The config is kept: {e}')
+        return
+    retry_in_background(bot.send_message)(message.chat.id,
+                                          f'Config has been reloaded, changed: {", ".join(changed) or "nothing"}')
+
+
+@handler('message', is_admin=True, commands=['export'])
+def admin_export_command(message: Message):
+    """/export [csv|ndjson] [<words>] [user=<user_id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD] - history as a gzip file"""
+    args = message.text.split()[1:]
+    export_format = EXPORT_FORMATS[0]
+    if args and args[0].lower() in EXPORT_FORMATS:
+        export_format = args.pop(0).lower()
+    history_query = parse_search_args(args) if args else HistoryQuery([])
+    if history_query is None:
+        retry_in_background(bot.send_message)(message.chat.id, SEARCH_USAGE, parse_mode='HTML')
+        return
+    start_history_export(bot, message, export_format, history_query)
+
+
+@handler('callback_query', is_admin=True, func=lambda c: c.data == AdmMenuState.statistics)
+def admin_menu_statistics(call: CallbackQuery):
+    """Jobs per day and the top users, read from the rollups (O(days), not O(jobs))"""
+    report = prepare_statistics_report(db_request_queue, cfg.advanced.stats_days)
+    if report is None:
+        bot_answer_with_error(bot, call.message, BOT_MSG[lang(call.message)]['db_answer_fail'])
+        return
+    menu = InlineKeyboardMarkup()
+    menu.add(make_back_button(AdmMenuState.back_to_main))
+    retry_in_background(bot.edit_message_text)(report, call.message.chat.id, call.message.id, parse_mode='HTML',
+                                               reply_markup=menu)
+
+
+@handler('message', is_admin=True, commands=['search'])
+def admin_search_command(message: Message):
+    """/search <words> [user=<user_id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD] - full-text search in the history"""
+    history_query = parse_search_args(message.text.split()[1:])
+    if history_query is None:
+        retry_in_background(bot.send_message)(message.chat.id, SEARCH_USAGE, parse_mode='HTML')
+        return
+    limit = cfg.advanced.history_search_results
+    entries = search_history(db_request_queue, history_query, limit)
+    if entries is None:
+        bot_answer_with_error(bot, message, BOT_MSG[lang(message)]['db_answer_fail'])
+        return
+    retry_in_background(bot.send_message)(message.chat.id, prepare_search_result(message, entries, limit),
+                                          parse_mode='HTML', disable_web_page_preview=True)
+
+
+@handler('callback_query', is_admin=True, func=lambda c: c.data.startswith(AdmMenuState.edit_users))
+def admin_menu_edit_users_menu(call: CallbackQuery):
+    """Users with their buttons in one message, every click edits it in place (one API call).
+    The page lives in a menu session, callback_data carries only its token and the action"""
+
+    token, action = parse_menu_callback(call.data, AdmMenuState.edit_users)
+    session = menu_sessions.get(token)
+    if session is None:
+        # "Edit Users" of the previous menu, or a session which has expired
+        session = menu_sessions.create(offset=0, user_ids=[])
+        action = ''
+    offset = session.state['offset']
+    user_ids = session.state['user_ids']
+    per_page = cfg.advanced.users_on_page
+    if action == 'prev':
+        offset = max(0, offset - per_page)
+    elif action == 'next':
+        offset += per_page
+    elif action[:1] in ('a', 'u') and action[1:].isdigit() and int(action[1:]) < len(user_ids):
+        change_user_privilege(user_ids[int(action[1:])], action[0])
 
     entries_query = (
         select(TelegramUser.id, TelegramUser.user_name, TelegramUser.first_name, TelegramUser.last_name,
                UserPermissions.is_user, UserPermissions.is_admin)
-        .outerjoin(UserPermissions).offset(current_offset).limit(USER_PER_PAGE)).order_by(TelegramUser.user_name)
+        .outerjoin(UserPermissions).offset(offset).limit(per_page)).order_by(TelegramUser.user_name)
     count_query = select(func.count('*')).select_from(TelegramUser).outerjoin(UserPermissions)
     result = select_entries_and_count(entries_query, count_query, db_request_queue)
     if result is None:
-        retry(bot.delete_message)(call.message.chat.id, call.message.id)
         bot_answer_with_error(bot, call.message, BOT_MSG[lang(call.message)]['db_answer_fail'])
         return
     entries_answer = result[0]
-    count_answer = normalize_count_result(result[1])
-    message_list = []
-    for entry in entries_answer:
-        user_edit_menu = InlineKeyboardMarkup(row_width=2)
-        user_edit_menu.add(*make_user_edit_buttons(entry[0], entry[5], entry[4]))
-        try:
-            message = retry(bot.send_message)(call.message.chat.id, f'<b>{entry[2]}</b>[{entry[0]}]',
-                                              parse_mode='HTML', reply_markup=user_edit_menu, disable_notification=True)
-
-        except Exception as e:
-            log.exception('ex', e)
-            message = call.message
-        message_list.append(message.message_id.__str__())
-
-    menu = InlineKeyboardMarkup()
-    go_front = InlineKeyboardButton('>>', callback_data=AdmMenuState.edit_users +
-                                                        f'{next_offset}-{"-".join(message_list)}')
-    go_back = InlineKeyboardButton('<<', callback_data=AdmMenuState.edit_users +
-                                                       f'{prev_offset}-{"-".join(message_list)}')
-    button_list = []
-    if current_offset - prev_offset > 0:
-        button_list.append(go_back)
-    if count_answer - next_offset > 0:
-        button_list.append(go_front)
-    row_width = 2
-    if len(button_list) == 1:
-        row_width = 1
-    button_list.append(make_back_button(AdmMenuState.user_control + '-'.join(message_list)))
-    menu.add(*button_list, row_width=row_width)
-    retry(bot.send_message)(call.message.chat.id, f'Total users: {count_answer}', disable_web_page_preview=True,
-                            parse_mode='HTML', reply_markup=menu, disable_notification=True)
+    count_answer = normalize_count_result(result[1]) or 0
+    session.state.update(offset=offset, user_ids=[entry[0] for entry in entries_answer])
+    text, menu = make_user_browser(session.token, entries_answer, count_answer, offset, per_page)
+    retry_in_background(bot.edit_message_text)(text, call.message.chat.id, call.message.id, parse_mode='HTML',
+                                               reply_markup=menu)
 
 
-@bot.message_handler(is_admin=True, commands=['admin'])
+@handler('message', is_admin=True, commands=['admin'])
 def admin_menu_first_show(message: Message):
     """Receive an /admin command, delete it and show the admin menu"""
 
-    retry(bot.delete_message)(message.chat.id, message.id)
+    retry_in_background(bot.delete_message)(message.chat.id, message.id)
     menu = get_main_admin_menu()
-    retry(bot.send_message)(message.chat.id, '<b>Welcome to Admin menu</b>', reply_markup=menu, parse_mode='HTML',
-                            disable_notification=True)
+    retry_in_background(bot.send_message)(message.chat.id, '<b>Welcome to Admin menu</b>', reply_markup=menu,
+                                          parse_mode='HTML', disable_notification=True)
 
 
-@bot.message_handler(is_user=True, func=lambda m: m.content_type == 'text' and url(m.text))
+@handler('message', is_user=True, func=lambda m: m.content_type == 'text' and bool(extract_links(m.text)))
 def download_file_from_link(message: Message):
-    """Central func of the bot, receive a link and convert it to mp3 file"""
+    """Central func of the bot, receive a link and convert it to mp3 file.
+    Playlists and messages with several links go as one batch"""
 
     log.info(f'Input message from {message.from_user.username} id: {message.from_user.id} , text: {message.text}')
-    dl_list = [message.text]
-    # TODO: Make some checks of the incoming message
-    bot_msg = bot.send_message(message.chat.id, BOT_MSG[lang(message)]["prepare_download"])
-
-    downloading_hook = get_download_progress_hook(bot, bot_msg, msg_edit_queue)
-    # Download file options, do not change tmpl without testing
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'no_color': True,
-        'outtmpl': {
-            'default': '%(title)s.%(ext)s',
-        },
-        'progress_hooks': [downloading_hook],
-        'logger': log,
-    }
-    # Send history to DB
-    db_request_queue.put(
-        DBMessage(command=DBCommand.AddNew, db_obj=BotHistory.new_from_message_obj(message), block=False))
-
-    with MyYoutubeDL(params=ydl_opts) as ydl:
-        try:
-            info = retry(ydl.extract_info)(dl_list[0], gen_answer=True, bot_obj=bot, download=False,
-                                           tg_message_obj=message,
-                                           tg_error_msg=BOT_MSG[lang(message)]["error_getting_ydl_info"])
-        except Exception as e:
-            bot_answer_with_error(bot, message, str(e))
-            log.exception(e)
-            return
-
-        file_name = os.path.join(MP3_DIR, file_name_manipulate(ydl.prepare_filename(info)))
-        log.info(f"Title of downloaded file: {info.get('title')}")
-        log_debug(info)
-        # Prepare output filename
-        ydl.params.update({'outtmpl': {'default': file_name}})
-
-        # Calculate bitrate based on duration (Telegram has max transfer size 50 MB)
-        video_duration: int = info.get('duration')
-        bitrate_to_set = calculate_mp3_bitrate(video_duration)
+    # Offline check, links which yt-dlp can't handle are rejected before any network request
+    routed_links = [r for r in (link_router.route(link, time_range) for link, time_range in extract_links(message.text))
+                    if r is not None]
+    if not routed_links:
+        retry_in_background(bot.send_message)(message.chat.id, BOT_MSG[lang(message)]["unsupported_link"])
+        return
+    routed = routed_links[0]
+    # A link of unknown type (channel tab, post) is resolved by the flat probe of the batch
+    is_batch = len(routed_links) > 1 or routed.is_playlist is not False
+    if not is_batch and dispatcher.is_in_flight(message, routed):
+        retry_in_background(bot.send_message)(message.chat.id, BOT_MSG[lang(message)]["already_in_progress"])
+        return
+    # Admission control, overload is rejected before any extraction
+    user_id = message.from_user.id
+    rejected = quota.admit(message, lambda: dispatcher.active_jobs(user_id))
+    if rejected is not None:
+        retry_in_background(bot.send_message)(message.chat.id, BOT_MSG[lang(message)][rejected])
+        return
+    dispatched = False
+    try:
+        bot_msg = bot.send_message(message.chat.id, BOT_MSG[lang(message)]["prepare_download"])
 
-        if bitrate_to_set == 0:
-            retry(bot.delete_message)(bot_msg.chat.id, bot_msg.message_id)
-            retry(bot.send_message)(message.chat.id, BOT_MSG[lang(message)]["file_too_long"])
-            return
+        # Send history to DB, the probe of a single link adds its title for the search
+        history = BotHistory.new_from_message_obj(message, None if is_batch else routed.key)
+        db_request_queue.put(DBMessage(command=DBCommand.AddNew, db_obj=history, block=False))
 
-        # Install PP with right bitrate
-        post_processor = ControlledPostProcessor(message=bot_msg, bot=bot,
-                                                 user_lang_code=message.from_user.language_code, preferredcodec='mp3',
-                                                 preferredquality=str(bitrate_to_set), msg_queue=msg_edit_queue)
-        ydl.add_post_processor(post_processor)
-        # Run process
-        retry(ydl.download)(dl_list, gen_answer=True, bot_obj=bot, tg_message_obj=message,
-                            tg_error_msg='Problem with downloading or postprocessing')
-        # Delete inform message
-        retry(bot.delete_message)(chat_id=message.chat.id, message_id=bot_msg.message_id)
+        if is_batch:
+            dispatched = dispatcher.dispatch_batch(message, bot_msg, routed_links[:cfg.advanced.batch_max_items])
+        else:
+            dispatched = dispatcher.dispatch(message, bot_msg, routed)
+        if not dispatched:
+            retry_in_background(bot.delete_message)(bot_msg.chat.id, bot_msg.message_id)
+            bot_answer_with_error(bot, message, BOT_MSG[lang(message)]['db_answer_fail'])
+    finally:
+        # A job which hasn't been dispatched doesn't count against jobs_per_hour
+        quota.settle(user_id, dispatched)
 
 
-@bot.message_handler(commands=['id'])
+@handler('message', commands=['id'])
 def get_id(message: Message):
-    retry(bot.send_message)(message.chat.id, '{} {}'.format(BOT_MSG[lang(message)]['get_id'], message.from_user.id))
+    retry_in_background(bot.send_message)(message.chat.id,
+                                          '{} {}'.format(BOT_MSG[lang(message)]['get_id'], message.from_user.id))
+
+
+@handler('message', is_user=True, commands=['format'])
+def choose_output_format(message: Message):
+    """/format [auto|mp3|opus|aac] - show or choose the output profile of the user"""
+    args = message.text.split()[1:]
+    variants = ', '.join(PROFILE_PREFERENCES)
+    if args:
+        if args[0].lower() not in PROFILE_PREFERENCES:
+            retry_in_background(bot.send_message)(message.chat.id,
+                                                  BOT_MSG[lang(message)]['format_unknown'].format(variants))
+            return
+        if not set_preference(db_request_queue, message.from_user.id, 'output_profile', args[0].lower()):
+            bot_answer_with_error(bot, message, BOT_MSG[lang(message)]['db_answer_fail'])
+            return
+    current = get_preferences(db_request_queue, message.from_user.id)['output_profile']
+    retry_in_background(bot.send_message)(message.chat.id,
+                                          BOT_MSG[lang(message)]['format_current'].format(current, variants))
+
+
+@handler('message', is_user=True, commands=['speech'])
+def choose_speech_mode(message: Message):
+    """/speech [auto|on|off] - show or choose when the speech profile is used"""
+    args = message.text.split()[1:]
+    variants = ', '.join(SPEECH_MODES)
+    if args:
+        if args[0].lower() not in SPEECH_MODES:
+            retry_in_background(bot.send_message)(message.chat.id,
+                                                  BOT_MSG[lang(message)]['format_unknown'].format(variants))
+            return
+        if not set_preference(db_request_queue, message.from_user.id, 'speech_mode', args[0].lower()):
+            bot_answer_with_error(bot, message, BOT_MSG[lang(message)]['db_answer_fail'])
+            return
+    current = get_preferences(db_request_queue, message.from_user.id)['speech_mode']
+    retry_in_background(bot.send_message)(message.chat.id,
+                                          BOT_MSG[lang(message)]['speech_current'].format(current, variants))
 
 
-@bot.message_handler(is_user=False, commands=['start'])
+@handler('message', is_user=False, commands=['start'])
 def start_unauthorized(message: Message):
-    retry(bot.send_message)(message.chat.id,
-                            BOT_MSG[lang(message)]['start_unauth'].format(message.from_user.first_name))
+    retry_in_background(bot.send_message)(message.chat.id,
+                                          BOT_MSG[lang(message)]['start_unauth'].format(message.from_user.first_name))
 
 
-@bot.message_handler(is_user=True, commands=['start'])
+@handler('message', is_user=True, commands=['start'])
 def start_authorized(message: Message):
-    pass
+    """/start dl-<token> comes from the button of an inline query, its link is processed as a usual message"""
+    args = message.text.split()[1:]
+    if not args:
+        return
+    link = deep_links.resolve(args[0])
+    if link is None:
+        retry_in_background(bot.send_message)(message.chat.id, BOT_MSG[lang(message)]['inline_link_expired'])
+        return
+    message.text = link
+    download_file_from_link(message)
+
+
+@handler('inline', is_user=True, func=lambda query: True)
+def answer_inline_query(inline_query: InlineQuery):
+    """@bot <link or words> - audio which has already been sent, no yt-dlp, ffmpeg or upload.
+    A link which is not in the cache gets a button to the bot, it starts a usual job"""
+    text = inline_query.query.strip()
+    button = None
+    links = extract_links(text)
+    if links:
+        routed = link_router.route(*links[0])
+        found = audio_index.find_media(routed.key) if routed is not None else []
+        if not found and routed is not None:
+            time_range = routed.time_range
+            link = routed.url + (f' {time_range.start}-{time_range.end or ""}' if time_range is not None else '')
+            button = InlineQueryResultsButton(text=BOT_MSG[lang(inline_query)]['inline_download'],
+                                              start_parameter=deep_links.remember(link))
+    else:
+        found = audio_index.search(text, cfg.advanced.inline_results)
+    results = [InlineQueryResultCachedAudio(str(audio.row_id), audio.file_id)
+               for audio in found[:cfg.advanced.inline_results]]
+    # An answer after the inline query timeout is useless, so there is only one attempt
+    retry_in_background(bot.answer_inline_query)(inline_query.id, results, cache_time=cfg.advanced.inline_cache_time,
+                                                 is_personal=True, button=button, max_attempt=1)
 
 
-@bot.message_handler(is_user=True)
+@handler('inline', func=lambda query: True)
+def answer_inline_query_unauthorized(inline_query: InlineQuery):
+    retry_in_background(bot.answer_inline_query)(inline_query.id, [], is_personal=True, max_attempt=1)
+
+
+@handler('message', is_user=True)
 def invalid_message(message: Message):
     bot.send_message(message.chat.id, BOT_MSG[lang(message)]['invalid_message'])
 
 
-@bot.message_handler(func=lambda m: True)
+@handler('message', func=lambda m: True)
 def unauthorized(message: Message):
     bot.send_message(message.chat.id, BOT_MSG[lang(message)]['not_authorized'])
     log.warning(f'Unauthorized message from {message.from_user.username} id: {message.from_user.id}, '
                 f'message{message.id}')
 
 
-# Bot start messages
-print(f'Elemental YouTube DL Tg Bot Version {BOT_VERSION}')
-log.info(f'Starting Elemental YouTube DL Tg Bot Version {BOT_VERSION}')
-
-# Bot Infinity polling
-try:
-    bot.infinity_polling()
-except KeyboardInterrupt:
-    pass
-except Exception as e:
-    log.exception(e)
-finally:
-    # Close threads when Interrupt
+########################################################################################################################
+# Application factory and entry point
+
+
+def create_app(db_queue: queue.Queue = None, threaded: bool = True) -> TeleBot:
+    """Build the bot: DB and MSG edit threads, filters, quotas, inline index, download pipeline (standalone mode)
+    and the handlers. Independent startup steps (permissions, known users, commands menu, link router, YoutubeDL
+    warm-up) run concurrently, the ones the first updates don't need go on in the background.
+
+    Another runtime (async_bot) passes its DB adapter as db_queue and threaded=False: it receives the updates
+    itself and hands them to bot.process_new_updates() in its own threads"""
+    global bot, db_request_queue, msg_edit_queue, job_progress_exit, user_filter, admin_filter, middleware, quota, \
+        quota_exit, quota_thread, audio_index, inline_exit, inline_thread, deep_links, menu_sessions, \
+        download_pipeline, storage, storage_exit, dispatcher
+    timer = StartupTimer(Config.load().advanced.startup_budget_sec)
+    apihelper.RETRY_ON_ERROR = True
+    log.setLevel(logging.INFO)
+    bot = TeleBot(cfg.main.telegram_token, threaded=threaded, num_threads=HANDLER_THREADS, use_class_middlewares=True)
+    run_mode = cfg.main.run_mode
+
+    # Run DB Thread, the schema is checked before it
+    timer.timed('database', get_engine)()
+    if db_queue is None:
+        db_request_queue = queue.Queue()
+        run_db_thread(db_consumer, db_request_queue)
+    else:
+        db_request_queue = db_queue
+
+    # Run MSG edit threads
+    msg_edit_queue = queue.Queue()
+    run_msg_threads(msg_editing_consumer, msg_edit_queue, bot)
+    # Pools follow the config on SIGHUP or /reload, the other values are read at their next use
+    Config.on_reload(lambda new_cfg: run_msg_threads(msg_editing_consumer, msg_edit_queue, bot))
+    reload_on_sighup()
+
+    # Run job progress thread (frontend mode, forwards progress of worker processes to the MSG edit threads)
+    if run_mode == 'frontend':
+        job_progress_exit = run_job_progress_thread(db_request_queue, msg_edit_queue)
+
+    # Filters and the known users are loaded before the first update. The commands menu, the link router (routing
+    # waits for it) and YoutubeDL instances (jobs create them on demand) aren't
+    user_filter = IsUser(db_request_queue)
+    admin_filter = IsAdmin(db_request_queue)
+    background = {
+        'commands': lambda: retry_in_background(bot.set_my_commands)(commands=BOT_COMMANDS, endpoint='telegram'),
+        'link router': link_router.build,
+    }
+    if run_mode == 'standalone':
+        background['ydl pool'] = ydl_pool.warm_up
+    started = run_startup_tasks(timer, required={
+        'users': user_filter.update_users,
+        'admins': admin_filter.update_users,
+        'known users': lambda: UserCollectMiddleware(db_request_queue),
+    }, background=background)
+    middleware = started['known users']
+
+    # Quotas, checked before a link is extracted. Counters are persisted by their own thread
+    quota = QuotaManager(db_request_queue, is_admin=admin_filter.contains)
+    quota_exit = threading.Event()
+    quota_thread = quota.run_persist_thread(quota_exit)
+
+    # Inline mode answers from the local index of already sent audio, refreshed by its own thread
+    audio_index = AudioIndex(db_request_queue)
+    inline_exit = threading.Event()
+    inline_thread = audio_index.run_refresh_thread(inline_exit)
+    deep_links = DeepLinks()
+    menu_sessions = MenuSessions()
+
+    # Storage sweep and the probe -> download -> transcode -> upload stages (standalone mode)
+    if run_mode == 'standalone':
+        storage = StorageManager(cfg.main.mp3_dir, db_request_queue)
+        storage_exit = threading.Event()
+        storage.run_sweep_thread(storage_exit)
+        download_pipeline = make_download_pipeline(bot, db_request_queue, storage, is_admin=admin_filter.check)
+    dispatcher = make_dispatcher(run_mode, bot, download_pipeline, msg_edit_queue, db_request_queue, storage, quota)
+
+    register_handlers(bot)
+    timer.report()
+    return bot
+
+
+def register_handlers(bot_obj: TeleBot):
+    """Filters, the middleware and _handlers in the order of declaration"""
+    bot_obj.add_custom_filter(user_filter)
+    bot_obj.add_custom_filter(admin_filter)
+    bot_obj.setup_middleware(middleware)
+    for kind, callback, filters in _handlers:
+        getattr(bot_obj, f'register_{kind}_handler')(callback, **filters)
+
+
+def shutdown():
+    """Stop the threads started by create_app()"""
+    if job_progress_exit is not None:
+        job_progress_exit.set()
+    if download_pipeline is not None:
+        download_pipeline.shutdown()
+    if storage_exit is not None:
+        storage_exit.set()
+    quota_exit.set()
+    quota_thread.join()
+    inline_exit.set()
+    inline_thread.join()
     db_request_queue.put(DBMessage(command=DBCommand.Quit))
     close_msg_edit_thread(msg_edit_queue)
-    print('Quit')
+    ydl_pool.close()
+
+
+def main():
+    create_app()
+    # Bot start messages
+    print(f'Elemental YouTube DL Tg Bot Version {BOT_VERSION}')
+    log.info(f'Starting Elemental YouTube DL Tg Bot Version {BOT_VERSION}')
+
+    # Bot Infinity polling or webhook server
+    try:
+        if cfg.main.ingest_mode == 'webhook':
+            run_webhook(bot)
+        else:
+            bot.infinity_polling()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log.exception(e)
+    finally:
+        # Close threads when Interrupt
+        shutdown()
+        print('Quit')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,38 @@
 import os
 import queue
 import threading
-from typing import TypedDict, Optional
+from typing import TypedDict, Optional, List
 
 import yt_dlp as youtube_dl
-from telebot import logger as log, TeleBot
+from telebot import logger as log
 from telebot.types import Message
 from yt_dlp import FFmpegExtractAudioPP
+from yt_dlp.postprocessor import PostProcessor
 
-from lang_support import BOT_MSG
 from msg_editor import size_analyse_thread
-from utils import retry, choose_language as lang, send_audio_file
 
 
 class MyYoutubeDL(youtube_dl.YoutubeDL):
+    def __init__(self, params=None, auto_init=True):
+        super().__init__(params=params, auto_init=auto_init)
+        # Params of the pool instance, every job starts from them
+        self.base_params = dict(self.params)
+
     def run_all_pps(self, key, info, *, additional_pps=None):
         return super().run_all_pps(key, info, additional_pps=None)
 
+    def prepare_for_job(self, job_params: dict):
+        """Reuse the instance (extractors, cookies, opener, player caches) for a new job with its own params"""
+        self.params.clear()
+        self.params.update(self.base_params)
+        self.params.update({k: v for k, v in job_params.items() if k != 'progress_hooks'})
+        self._progress_hooks = []
+        for hook in job_params.get('progress_hooks', []):
+            self.add_progress_hook(hook)
+        for pps in self._pps.values():
+            pps.clear()
+        self._download_retcode = 0
+
     def download(self, url_list):
         log.info(f'Downloading {url_list}')
         return super().download(url_list)
@@ -27,14 +43,28 @@ class InfoYDLObj(TypedDict):
     filename: str
 
 
+class DownloadedInfoPP(PostProcessor):
+    """Keeps the info of the downloaded file (final filepath), conversion is made by another stage"""
+
+    def __init__(self, downloader=None):
+        super().__init__(downloader)
+        self.info: Optional[dict] = None
+
+    def run(self, info):
+        self.info = info
+        return [], info
+
+
 class ControlledPostProcessor(FFmpegExtractAudioPP):
-    """Set bitrate in super func, get Finish Status of FFmgegPostProcessing and sent audio file"""
+    """Set bitrate in super func, get Finish Status of FFmgegPostProcessing and draw the converting status bar.
+    extra_args are added to the ffmpeg output options (speech profile: channels, sample rate, filters)"""
 
-    def __init__(self, *args, message: Message, bot: TeleBot, user_lang_code=None, msg_queue: queue.Queue, **kwargs):
+    def __init__(self, *args, message: Message, user_lang_code=None, msg_queue: queue.Queue,
+                 extra_args: List[str] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.extra_args = extra_args or []
         self.msg_queue = msg_queue
         self.run_thread = True
-        self.bot = bot
         try:
             self.preferredquality = int(kwargs['preferredquality'])
         except Exception as e:
@@ -52,22 +82,30 @@ class ControlledPostProcessor(FFmpegExtractAudioPP):
 
             pp_thread = threading.Thread(target=size_analyse_thread,
                                          args=(file_name, duration, self.preferredquality, self.message, self.msg_queue,
-                                               exit_event))
+                                               exit_event, self._preferredcodec))
             pp_thread.start()
-        _a, _b = super().run(info)
-        if exit_event is not None:
-            exit_event.set()
-        retry(send_audio_file)(self.bot, _b['filepath'], self.message, gen_answer=True,
-                               tg_message_obj=self.message,
-                               tg_error_msg=BOT_MSG[lang(self.message)]['file_sending_error'])
-        return _a, _b
+        try:
+            return super().run(info)
+        finally:
+            if exit_event is not None:
+                exit_event.set()
+
+    def get_audio_codec(self, path):
+        """The source is always encoded: a stream copy (opus -> opus, aac -> m4a) would keep the source bitrate,
+        which may not fit the 50 MB limit, and can't apply extra_args"""
+        codec = super().get_audio_codec(path)
+        return None if codec is None else f'{codec}-source'
+
+    def run_ffmpeg(self, path, out_path, codec, more_opts):
+        super().run_ffmpeg(path, out_path, codec, [*more_opts, *self.extra_args])
 
     def _get_file_name_and_duration(self, info: InfoYDLObj):
         file_name: Optional[str] = None
         duration: Optional[int] = None
-        if info['filename'] is not None:
-            file_name = os.path.splitext(info['filename'])[0]
-        if info['duration'] is not None:
+        path = info.get('filepath') or info.get('filename')
+        if path is not None:
+            file_name = os.path.splitext(path)[0]
+        if info.get('duration') is not None:
             duration = info['duration']
         if not (file_name and duration):
             self.run_thread = False
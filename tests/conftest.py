@@ -0,0 +1,18 @@
+import json
+import os
+import sys
+import tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+sys.path.insert(0, APP_DIR)
+
+# The modules read the config at its first use: bot_conf.json of the repo with a token, an admin and a temp DB
+_tmp_dir = tempfile.mkdtemp(prefix='ydl-bot-tests-')
+with open(os.path.join(os.path.dirname(APP_DIR), 'bot_conf.json')) as _file:
+    _config = json.load(_file)
+_config['main'].update(telegram_token='123456:test-token', super_admin_list=[1], mp3_dir=_tmp_dir,
+                       db_dsn=f'sqlite:///{os.path.join(_tmp_dir, "database.db")}')
+_config_path = os.path.join(_tmp_dir, 'bot_conf.json')
+with open(_config_path, 'w') as _file:
+    json.dump(_config, _file)
+os.environ['BOT_CONFIG_PATH'] = _config_path
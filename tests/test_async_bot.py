@@ -0,0 +1,97 @@
+import asyncio
+import queue
+from types import SimpleNamespace
+
+import pytest
+from telebot import BaseMiddleware, TeleBot, custom_filters, types
+
+import async_bot
+import youtube_bot
+from lang_support import BOT_MSG
+from quota import QuotaManager
+
+
+class AllowAll(custom_filters.SimpleCustomFilter):
+    def __init__(self, key: str):
+        self.key = key
+
+    def check(self, message) -> bool:
+        return True
+
+
+class FakeMiddleware(BaseMiddleware):
+    update_types = ['message']
+
+    def pre_process(self, message, data):
+        pass
+
+    def post_process(self, message, data, exception):
+        pass
+
+
+class FakeBot(TeleBot):
+    """Processes updates like the bot of youtube_bot, sends nothing"""
+
+    def __init__(self):
+        super().__init__('1:test', threaded=False, use_class_middlewares=True)
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=len(self.sent))
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.dispatched = []
+
+    def is_in_flight(self, message, routed) -> bool:
+        return False
+
+    def active_jobs(self, user_id: int) -> int:
+        return 0
+
+    def dispatch(self, message, bot_msg, routed) -> bool:
+        self.dispatched.append(routed.key)
+        return True
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """async_bot on top of the youtube_bot state, without threads and network"""
+    bot, dispatcher = FakeBot(), FakeDispatcher()
+    quota = QuotaManager(queue.Queue())
+
+    def create_app(db_queue=None, threaded=True):
+        assert not threaded
+        monkeypatch.setattr(youtube_bot, 'bot', bot)
+        monkeypatch.setattr(youtube_bot, 'db_request_queue', queue.Queue())
+        monkeypatch.setattr(youtube_bot, 'user_filter', AllowAll('is_user'))
+        monkeypatch.setattr(youtube_bot, 'admin_filter', AllowAll('is_admin'))
+        monkeypatch.setattr(youtube_bot, 'middleware', FakeMiddleware())
+        monkeypatch.setattr(youtube_bot, 'quota', quota)
+        monkeypatch.setattr(youtube_bot, 'dispatcher', dispatcher)
+        youtube_bot.register_handlers(bot)
+
+    monkeypatch.setattr(youtube_bot, 'create_app', create_app)
+    transport = async_bot.create_app()
+    yield transport, bot, dispatcher, quota
+    async_bot.handler_executor.shutdown(wait=True)
+
+
+def link_update(update_id: int, text: str) -> types.Update:
+    return types.Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text, 'chat': {'id': 2, 'type': 'private'},
+        'from': {'id': 2, 'is_bot': False, 'first_name': 'User', 'language_code': 'en'}}})
+
+
+def test_links_are_admitted_by_the_quota(app):
+    transport, bot, dispatcher, quota = app
+    quota.overrides[2] = {'jobs_per_hour': 1}
+    updates = [link_update(1, 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+               link_update(2, 'https://youtu.be/9bZkp7q19f0')]
+    for update in updates:
+        asyncio.run(transport.process_new_updates([update]))
+    assert len(dispatcher.dispatched) == 1
+    assert bot.sent[-1] == BOT_MSG['EN']['quota_jobs_per_hour']
+    assert quota.usage(2).jobs_in_hour == 1
@@ -0,0 +1,36 @@
+import queue
+from types import SimpleNamespace
+
+from batch import BatchJob, _ItemProgress
+from msg_editor import get_download_progress_hook
+
+
+def make_batch(msg_queue: queue.Queue) -> BatchJob:
+    message = SimpleNamespace(from_user=SimpleNamespace(id=2, language_code='en'), chat=SimpleNamespace(id=2),
+                              message_id=1)
+    bot_msg = SimpleNamespace(from_user=message.from_user, chat=message.chat, message_id=2, date=0, edit_date=None)
+    # No bot: an item must not edit the status message of the batch itself
+    return BatchJob(None, message, bot_msg, [], submit=None, msg_queue=msg_queue, db_request_queue=None,
+                    storage=None)
+
+
+def edits(msg_queue: queue.Queue):
+    texts = []
+    while not msg_queue.empty():
+        texts.append(msg_queue.get_nowait().message_str)
+    return texts
+
+
+def test_item_progress_goes_through_the_batch():
+    msg_queue = queue.Queue()
+    batch = make_batch(msg_queue)
+    hooks = [get_download_progress_hook(batch.bot_msg, _ItemProgress(batch, index)) for index in range(2)]
+    hooks[0]({'status': 'downloading', 'filename': 'First.webm', '_percent_str': '10%'})
+    # Throttled: ticks of the other item within a second are not shown
+    hooks[1]({'status': 'downloading', 'filename': 'Second.webm', '_percent_str': '10%'})
+    assert len(edits(msg_queue)) == 1
+    # A finished download is shown at once, in the batch status
+    hooks[1]({'status': 'finished', 'filename': 'Second.webm'})
+    texts = edits(msg_queue)
+    assert len(texts) == 1
+    assert '0/0\n#2 ' in texts[0] and 'Second.webm' in texts[0]
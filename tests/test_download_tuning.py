@@ -0,0 +1,70 @@
+import pytest
+
+from config_parse import Config
+from download_tuning import DownloadTuner, MIN_RATELIMIT
+
+
+class FakeYDL(object):
+    def __init__(self):
+        self.params = {}
+        self.hooks = []
+
+    def add_progress_hook(self, hook):
+        self.hooks.append(hook)
+
+    def progress(self, speed):
+        for hook in self.hooks:
+            hook({'status': 'downloading', 'speed': speed})
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    advanced = Config.load().advanced
+    monkeypatch.setattr(advanced, 'download_bandwidth_kb', 1000)
+    monkeypatch.setattr(advanced, 'download_rate_limit_kb', 0)
+    monkeypatch.setattr(advanced, 'adaptive_download', True)
+    return 1000 * 1024
+
+
+def test_budget_is_shared(budget):
+    tuner = DownloadTuner()
+    first, second = FakeYDL(), FakeYDL()
+    with tuner.job('Youtube', first):
+        assert first.params['ratelimit'] == budget
+        with tuner.job('Youtube', second):
+            assert first.params['ratelimit'] == second.params['ratelimit'] == budget // 2
+            # The first one can't use its share, the second one gets the rest
+            tuner._rebalanced = 0
+            first.progress(100 * 1024)
+            assert first.params['ratelimit'] == int(100 * 1024 * 1.25)
+            assert second.params['ratelimit'] == budget - int(100 * 1024 * 1.25)
+        assert first.params['ratelimit'] == int(100 * 1024 * 1.25)
+
+
+def test_released_instance_is_not_touched(budget):
+    tuner = DownloadTuner()
+    released, running = FakeYDL(), FakeYDL()
+    with tuner.job('Youtube', released):
+        pass
+    ratelimit = released.params['ratelimit']
+    with tuner.job('Youtube', running):
+        tuner._rebalanced = 0
+        running.progress(10 * 1024)
+    assert released.params['ratelimit'] == ratelimit
+    assert tuner.jobs == []
+
+
+def test_no_budget_no_limit(monkeypatch):
+    monkeypatch.setattr(Config.load().advanced, 'download_bandwidth_kb', 0)
+    monkeypatch.setattr(Config.load().advanced, 'download_rate_limit_kb', 0)
+    ydl = FakeYDL()
+    with DownloadTuner().job('Youtube', ydl):
+        assert 'ratelimit' not in ydl.params
+        assert ydl.params['concurrent_fragment_downloads'] == Config.load().advanced.concurrent_fragment_downloads
+
+
+def test_small_share_is_not_zero(budget, monkeypatch):
+    monkeypatch.setattr(Config.load().advanced, 'download_bandwidth_kb', 1)
+    ydl = FakeYDL()
+    with DownloadTuner().job('Youtube', ydl):
+        assert ydl.params['ratelimit'] == MIN_RATELIMIT
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import APP_DIR
+
+# Runs in a fresh interpreter: the other tests have already imported (and started) things in this one
+CHECK_IMPORT = '''
+import sys
+import threading
+
+import database
+
+module = __import__(sys.argv[1])
+assert threading.active_count() == 1, [thread.name for thread in threading.enumerate()]
+assert database._engine is None
+for name in sys.argv[2:]:
+    assert getattr(module, name) is None, name
+'''
+
+
+@pytest.mark.parametrize('module, state', [
+    ('youtube_bot', ['bot', 'db_request_queue', 'download_pipeline', 'dispatcher']),
+    ('worker', []),
+    ('async_bot', ['transport', 'handler_executor']),
+])
+def test_nothing_starts_at_import(module, state):
+    result = subprocess.run([sys.executable, '-c', CHECK_IMPORT, module, *state], cwd=APP_DIR, env=os.environ,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,107 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import batch
+from link_router import TimeRange, link_router
+
+
+@pytest.mark.parametrize('link, video_id', [
+    ('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'dQw4w9WgXcQ'),
+    ('https://youtu.be/dQw4w9WgXcQ?t=42', 'dQw4w9WgXcQ'),
+    # A video opened from a playlist is the video
+    ('https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG', 'dQw4w9WgXcQ'),
+])
+def test_youtube_video(link, video_id):
+    routed = link_router.route(link)
+    assert routed.extractor == 'Youtube'
+    assert routed.video_id == video_id
+    assert routed.is_playlist is False
+
+
+def test_youtube_playlist():
+    routed = link_router.route('https://www.youtube.com/playlist?list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG')
+    assert routed.is_playlist is True
+
+
+@pytest.mark.parametrize('link', ['https://www.youtube.com/@channel',
+                                  'https://www.youtube.com/channel/UC38IQsAvIsxxjztdMZQtwHA'])
+def test_youtube_channel_is_unknown(link):
+    # The tab extractor can return a video or a playlist, the flat probe of the batch decides
+    assert link_router.route(link).is_playlist is None
+
+
+def test_unsupported_link():
+    assert link_router.route('https://example.com/page.html') is None
+
+
+def test_patterns_are_compiled_by_build():
+    def compiled():
+        return sum('_VALID_URL_RE' in ie.__dict__ for ie in link_router._extractors)
+
+    link_router.build()
+    before = compiled()
+    # The full scan of an unknown host doesn't compile anything on the handler thread
+    assert link_router.route('https://unknown-host.example/watch?v=1') is None
+    assert compiled() == before
+
+
+@pytest.mark.parametrize('text, time_range', [
+    ('1:02:10-1:07:45', TimeRange(3730, 4065)),
+    ('62:10-67:45', TimeRange(3730, 4065)),
+    ('3730-4065', TimeRange(3730, 4065)),
+    # Up to the end
+    ('1:02:03-', TimeRange(3723)),
+    ('0-5', TimeRange(0, 5)),
+])
+def test_time_range(text, time_range):
+    assert TimeRange.parse(text) == time_range
+
+
+@pytest.mark.parametrize('text', ['1:07:45-1:02:10', '10-10', '-5', '1:2:3:4-', '1:02:10', 'a-b', ''])
+def test_bad_time_range(text):
+    assert TimeRange.parse(text) is None
+
+
+def test_time_range_out_of_media():
+    assert TimeRange(3723).clip_duration(3800) == 77
+    # The end of the range is clipped to the media, a range after the end is empty
+    assert TimeRange(3600, 4000).clip_duration(3800) == 200
+    assert TimeRange(4000, 4100).clip_duration(3800) == 0
+    assert TimeRange(4000).clip_duration(3800) == 0
+    assert TimeRange(3723).clip_duration(None) is None
+    assert TimeRange(3600, 4000).clip_duration(None) == 400
+
+
+class FakeYDL(object):
+    def __init__(self, infos):
+        self.infos = infos
+
+    def extract_info(self, link, download=False):
+        return self.infos[link]
+
+
+def expand(monkeypatch, routed_links, infos):
+    @contextmanager
+    def acquire(job_params):
+        assert job_params == {'extract_flat': 'in_playlist'}
+        yield FakeYDL(infos)
+
+    monkeypatch.setattr(batch.ydl_pool, 'acquire', acquire)
+    message = SimpleNamespace(from_user=SimpleNamespace(language_code='en'))
+    return batch.expand_links(None, message, routed_links)
+
+
+def test_channel_is_expanded(monkeypatch):
+    channel = link_router.route('https://www.youtube.com/@channel')
+    entries = [{'url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'}, {'url': 'https://youtu.be/9bZkp7q19f0'}]
+    items = expand(monkeypatch, [channel], {channel.url: {'_type': 'playlist', 'entries': entries}})
+    assert [item.video_id for item in items] == ['dQw4w9WgXcQ', '9bZkp7q19f0']
+    assert all(item.is_playlist is False for item in items)
+
+
+def test_unknown_single_video_stays_one_item(monkeypatch):
+    channel = link_router.route('https://www.youtube.com/@channel')
+    items = expand(monkeypatch, [channel], {channel.url: {'_type': 'video', 'id': 'dQw4w9WgXcQ'}})
+    assert items == [channel._replace(is_playlist=False)]
@@ -0,0 +1,27 @@
+import pytest
+
+from output_profile import DEFAULT_SPEECH_MODE, is_speech, variant_key
+from preferences import PREFERENCE_DEFAULTS
+
+LECTURE = {'categories': ['Education']}
+LONG_TALK = {'categories': ['People & Blogs']}
+LONG_MIX = {'categories': ['Music']}
+
+
+def test_speech_is_opt_in():
+    assert PREFERENCE_DEFAULTS['speech_mode'] == DEFAULT_SPEECH_MODE == 'off'
+    for info in (LECTURE, LONG_TALK):
+        assert not is_speech(DEFAULT_SPEECH_MODE, info, 2 * 3600)
+    # The default keeps the plain cache key
+    assert variant_key('youtube:dQw4w9WgXcQ', 'auto', DEFAULT_SPEECH_MODE) == 'youtube:dQw4w9WgXcQ'
+
+
+@pytest.mark.parametrize('info, duration, speech', [
+    (LECTURE, 600, True),
+    (LONG_TALK, 2 * 3600, True),
+    (LONG_TALK, 600, False),
+    (LONG_MIX, 2 * 3600, False),
+])
+def test_speech_auto(info, duration, speech):
+    assert is_speech('auto', info, duration) is speech
+    assert is_speech('on', info, duration)
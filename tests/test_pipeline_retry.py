@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from config_parse import Config
+from pipeline import StageExecutor
+from retry_policy import RetryLater
+from utils import retry_later
+
+
+class Task(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.attempts = {}
+        self.success = False
+        self.done = threading.Event()
+
+    def finish(self):
+        self.done.set()
+
+
+@pytest.fixture
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(Config.load().advanced, 'retry_base_delay', 0.3)
+    monkeypatch.setattr(Config.load().advanced, 'retry_max_delay', 0.3)
+
+
+def test_transient_error_is_retried_later(short_backoff):
+    calls = []
+
+    def flaky(attempt_of):
+        calls.append(attempt_of)
+        if len(calls) == 1:
+            raise ConnectionError('reset')
+        return 'sent'
+
+    with pytest.raises(RetryLater):
+        retry_later(flaky)('a', attempts={}, key='send', endpoint='test-later')
+    attempts = {'send': 1}
+    assert retry_later(flaky)('a', attempts=attempts, key='send', endpoint='test-later') == 'sent'
+    assert attempts == {'send': 2}
+
+
+def test_last_attempt_gives_up(short_backoff):
+    def broken():
+        raise ConnectionError('reset')
+
+    attempts = {'send': 2}
+    assert retry_later(broken)(attempts=attempts, key='send', max_attempt=3, endpoint='test-give-up') is None
+    assert attempts == {'send': 3}
+
+
+def test_worker_is_not_held_by_a_retry():
+    order = []
+
+    def stage(task):
+        order.append(task.name)
+        if task.name == 'flaky' and order.count('flaky') == 1:
+            raise RetryLater(0.3)
+        task.success = True
+        return False
+
+    stage_executor = StageExecutor('test', stage, workers=1, queue_size=4)
+    try:
+        flaky, other = Task('flaky'), Task('other')
+        stage_executor.submit(flaky)
+        stage_executor.submit(other)
+        assert other.done.wait(5) and flaky.done.wait(5)
+    finally:
+        stage_executor.shutdown()
+    # The only worker has handled the other task while the flaky one was waiting for its retry
+    assert order == ['flaky', 'other', 'flaky']
+    assert flaky.success
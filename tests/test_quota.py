@@ -0,0 +1,154 @@
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+from config_parse import Config, QuotaLimits
+from database.async_db_access import DBCommand, execute_db_message
+from quota import QuotaManager, parse_quota_override
+
+USER, ADMIN, SUPERADMIN = 2, 3, 1
+
+
+class SyncDB(object):
+    """Runs every DBMessage at once on the test database. fail_writes - transactions are rolled back"""
+
+    def __init__(self, fail_writes: bool = False):
+        self.fail_writes = fail_writes
+
+    def put(self, db_message, block=True, timeout=None):
+        if self.fail_writes and db_message.command is DBCommand.Transaction:
+            db_message.result_queue.put(False)
+            return
+        execute_db_message(db_message)
+
+
+def message(user_id: int):
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id))
+
+
+def admit(quota: QuotaManager, user_id: int, active_jobs: int = 0):
+    """Admission of a job which is dispatched at once"""
+    rejected = quota.admit(message(user_id), lambda: active_jobs)
+    if rejected is None:
+        quota.settle(user_id, dispatched=True)
+    return rejected
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    quota_cfg = Config.load().quota
+    monkeypatch.setattr(quota_cfg, 'user', QuotaLimits(concurrent_jobs=2, jobs_per_hour=3,
+                                                       source_minutes_per_day=10, mb_per_day=5))
+    monkeypatch.setattr(quota_cfg, 'admin', QuotaLimits(concurrent_jobs=4, jobs_per_hour=0,
+                                                        source_minutes_per_day=0, mb_per_day=0))
+    monkeypatch.setattr(quota_cfg, 'superadmin', QuotaLimits(concurrent_jobs=0, jobs_per_hour=0,
+                                                             source_minutes_per_day=0, mb_per_day=0))
+    return QuotaManager(queue.Queue(), is_admin=lambda user_id: user_id == ADMIN)
+
+
+def test_roles(quota):
+    assert [quota.role_of(user_id) for user_id in (USER, ADMIN, SUPERADMIN)] == ['user', 'admin', 'superadmin']
+
+
+def test_concurrent_jobs(quota):
+    assert admit(quota, USER, 1) is None
+    assert admit(quota, USER, 2) == 'quota_concurrent_jobs'
+    assert admit(quota, ADMIN, 3) is None
+    # 0 is no limit
+    assert admit(quota, SUPERADMIN, 100) is None
+
+
+def test_concurrent_admissions_reserve(quota):
+    # The first job isn't dispatched yet, the dispatcher doesn't count it
+    assert quota.admit(message(USER), lambda: 1) is None
+    assert quota.admit(message(USER), lambda: 1) == 'quota_concurrent_jobs'
+    quota.settle(USER, dispatched=True)
+    assert admit(quota, USER, 2) == 'quota_concurrent_jobs'
+    assert quota.reserved == {}
+
+
+def test_failed_dispatch_is_refunded(quota):
+    for _ in range(3):
+        assert quota.admit(message(USER), lambda: 0) is None
+        quota.settle(USER, dispatched=False)
+    assert quota.usage(USER).jobs_in_hour == 0
+    assert admit(quota, USER) is None
+
+
+def test_jobs_per_hour(quota):
+    for _ in range(3):
+        assert admit(quota, USER) is None
+    assert admit(quota, USER) == 'quota_jobs_per_hour'
+    # A rejected job is not counted
+    assert quota.usage(USER).jobs_in_hour == 3
+
+
+def test_source_minutes_and_bytes(quota):
+    quota.charge(USER, source_seconds=10 * 60)
+    assert admit(quota, USER) == 'quota_source_minutes'
+    quota.charge(ADMIN, bytes_sent=10 * 1024 ** 2)
+    assert admit(quota, ADMIN) is None
+
+
+def test_mb_per_day(quota):
+    quota.charge(USER, bytes_sent=5 * 1024 ** 2 - 1)
+    assert admit(quota, USER) is None
+    quota.charge(USER, bytes_sent=1)
+    assert admit(quota, USER) == 'quota_mb_per_day'
+
+
+def test_override(quota):
+    quota.overrides[USER] = {'jobs_per_hour': 1, 'concurrent_jobs': None}
+    limits = quota.limits_of(USER)
+    assert (limits.jobs_per_hour, limits.concurrent_jobs) == (1, 2)
+    assert admit(quota, USER) is None
+    assert admit(quota, USER) == 'quota_jobs_per_hour'
+    # The override doesn't change the limits of the role
+    assert Config.load().quota.user.jobs_per_hour == 3
+
+
+@pytest.mark.parametrize('args, values', [
+    (['jobs_per_hour=10'], {'jobs_per_hour': 10}),
+    (['jobs_per_hour=0', 'mb_per_day=default'], {'jobs_per_hour': 0, 'mb_per_day': None}),
+    ([], {}),
+])
+def test_parse_quota_override(args, values):
+    assert parse_quota_override(args) == values
+
+
+@pytest.mark.parametrize('args', [['jobs=10'], ['jobs_per_hour'], ['jobs_per_hour=ten'], ['mb_per_day=-1'],
+                                  ['jobs_per_hour=1', 'unknown=2']])
+def test_parse_quota_override_errors(args):
+    assert parse_quota_override(args) is None
+
+
+def test_persist_adds_up_processes(quota):
+    user_id = 1001
+    bot, worker = QuotaManager(SyncDB()), QuotaManager(SyncDB())
+    admit(bot, user_id)
+    bot.charge(user_id, source_seconds=60, bytes_sent=100)
+    worker.charge(user_id, source_seconds=30)
+    # The first persist creates the row, the next ones add to it
+    bot.persist()
+    worker.persist()
+    bot.charge(user_id, bytes_sent=50)
+    bot.persist()
+    worker.persist()
+    for manager in (bot, worker):
+        counters = manager.usage(user_id)
+        assert (counters.jobs_in_hour, counters.source_seconds, counters.bytes_sent) == (1, 90, 150)
+        assert not counters.dirty
+
+
+def test_failed_persist_keeps_deltas(quota):
+    user_id = 1002
+    db = SyncDB(fail_writes=True)
+    manager = QuotaManager(db)
+    manager.charge(user_id, source_seconds=60)
+    manager.persist()
+    assert manager.usage(user_id).delta_seconds == 60
+    db.fail_writes = False
+    manager.persist()
+    counters = manager.usage(user_id)
+    assert (counters.base_seconds, counters.delta_seconds) == (60, 0)
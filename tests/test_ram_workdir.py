@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from ram_workdir import RamWorkDir
+from utils import is_job_file
+
+
+@pytest.mark.parametrize('name', ['Song', 'Song.webm', 'Song.mp3', 'Song.webm.part', 'Song.webm.ytdl',
+                                  'Song.temp.mp3', 'Song.f251.webm', 'Song.f251.webm.part-Frag3'])
+def test_files_of_the_job(name):
+    assert is_job_file(name, 'Song')
+
+
+@pytest.mark.parametrize('name', ['Song (Live).webm', 'Song (Live).mp3.part', 'Songbird.mp3', 'Song.live.mp3',
+                                  'Another Song.mp3'])
+def test_files_of_other_jobs(name):
+    assert not is_job_file(name, 'Song')
+
+
+def test_stem_with_dots():
+    assert is_job_file('Mr. Song.mp3', 'Mr. Song')
+    assert not is_job_file('Mr. Song.mp3', 'Mr')
+
+
+def test_discard_keeps_concurrent_jobs(tmp_path):
+    names = ['Song.webm', 'Song.mp3', 'Song.webm.part', 'Song (Live).webm.part', 'Song (Live).mp3', 'Songbird.mp3']
+    for name in names:
+        (tmp_path / name).write_bytes(b'0')
+    ram_dir = RamWorkDir(str(tmp_path), 10, 100)
+    assert ram_dir.reserve(1024)
+    ram_dir.release(1024, os.path.join(str(tmp_path), 'Song'))
+    assert sorted(os.listdir(tmp_path)) == ['Song (Live).mp3', 'Song (Live).webm.part', 'Songbird.mp3']
+    assert ram_dir.used == 0
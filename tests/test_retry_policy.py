@@ -0,0 +1,127 @@
+import pytest
+
+import retry_policy
+from config_parse import Config
+from retry_policy import CircuitBreaker, CircuitOpenError, TRIAL_RETRY_SEC, backoff_delay, call_with_breaker, \
+    classify_error, extractor_endpoint
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retry_policy, 'time', clock)
+    return clock
+
+
+class Transient(Exception):
+    pass
+
+
+def fail(e: Exception):
+    raise e
+
+
+@pytest.mark.parametrize('attempt, upper', [(1, 1), (2, 2), (3, 4), (5, 10), (20, 10)])
+def test_backoff_delay(monkeypatch, attempt, upper):
+    # Full jitter: uniform from 0 up to base * 2 ** (attempt - 1), capped
+    monkeypatch.setattr(retry_policy.random, 'uniform', lambda low, high: (low, high))
+    assert backoff_delay(attempt, base=1, cap=10) == (0, upper)
+
+
+def test_backoff_delay_is_random():
+    delays = [backoff_delay(4, base=1, cap=10) for _ in range(100)]
+    assert all(0 <= delay <= 8 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_breaker_opens_after_threshold(clock, monkeypatch):
+    monkeypatch.setattr(retry_policy, '_breakers', {})
+    monkeypatch.setattr(Config.load().advanced, 'breaker_failure_threshold', 3)
+    for _ in range(2):
+        with pytest.raises(Transient):
+            call_with_breaker(fail, 'test', Transient())
+    assert call_with_breaker(lambda: 'ok', 'test') == 'ok'
+    for _ in range(3):
+        with pytest.raises(Transient):
+            call_with_breaker(fail, 'test', Transient())
+    # The call is not made
+    with pytest.raises(CircuitOpenError):
+        call_with_breaker(fail, 'test', Transient())
+    # Another endpoint has its own breaker
+    assert call_with_breaker(lambda: 'ok', 'other') == 'ok'
+
+
+def test_every_extractor_has_its_breaker(clock, monkeypatch):
+    monkeypatch.setattr(retry_policy, '_breakers', {})
+    monkeypatch.setattr(Config.load().advanced, 'breaker_failure_threshold', 1)
+    with pytest.raises(Transient):
+        call_with_breaker(fail, extractor_endpoint('Vimeo'), Transient())
+    with pytest.raises(CircuitOpenError):
+        call_with_breaker(lambda: 'ok', extractor_endpoint('Vimeo'))
+    assert call_with_breaker(lambda: 'ok', extractor_endpoint('Youtube')) == 'ok'
+
+
+def test_permanent_errors_dont_open(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_sec=30)
+    breaker.before_call()
+    breaker.on_failure(transient=False)
+    breaker.before_call()
+    assert breaker.opened_at is None
+
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_sec=30)
+    breaker.on_failure(transient=True)
+    breaker.on_success()
+    breaker.on_failure(transient=True)
+    breaker.before_call()
+    assert breaker.opened_at is None
+
+
+def test_half_open(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_sec=30)
+    breaker.on_failure(transient=True)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    # Cooled down: one trial call, the others are still rejected
+    clock.now += 30
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    # The trial failed: open again for reset_sec
+    breaker.on_failure(transient=True)
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 1
+    breaker.before_call()
+    # The trial succeeded: closed
+    breaker.on_success()
+    breaker.before_call()
+    breaker.before_call()
+    assert (breaker.failures, breaker.opened_at) == (0, None)
+
+
+def test_open_circuit_is_retried_after_cool_down(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_sec=30)
+    breaker.on_failure(transient=True)
+    clock.now += 10
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    transient, retry_after = classify_error(error.value)
+    assert transient
+    assert 20 <= retry_after <= 20 + TRIAL_RETRY_SEC
+    # Half-open with the trial running: the others look again soon
+    clock.now += 20
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert TRIAL_RETRY_SEC <= classify_error(error.value)[1] <= 2 * TRIAL_RETRY_SEC
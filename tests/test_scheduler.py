@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler
+from config_parse import Config
+from scheduler import JobScheduler
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class Task(object):
+    def __init__(self, user_id: int, duration: float = None, file_path: str = None):
+        self.message = SimpleNamespace(from_user=SimpleNamespace(id=user_id))
+        self.duration = duration
+        self.file_path = file_path
+        self.finish_callbacks = []
+
+    def on_finish(self, callback):
+        self.finish_callbacks.append(callback)
+
+    def finish(self):
+        for callback in self.finish_callbacks:
+            callback()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    advanced = Config.load().advanced
+    monkeypatch.setattr(advanced, 'sched_aging_factor', 10.0)
+    monkeypatch.setattr(advanced, 'sched_user_share_penalty_sec', 900)
+    monkeypatch.setattr(advanced, 'sched_unknown_duration_sec', 600)
+    monkeypatch.setattr(advanced, 'sched_admin_bonus_sec', 1800)
+    clock = Clock()
+    monkeypatch.setattr(scheduler, 'time', clock)
+    return clock
+
+
+def get_all(job_scheduler: JobScheduler, count: int):
+    return [job_scheduler.get(block=False) for _ in range(count)]
+
+
+def test_short_jobs_go_first(clock):
+    job_scheduler = JobScheduler(10)
+    long_task, unknown, short, stored = Task(2, 3600), Task(3), Task(4, 60), Task(5, 3600, file_path='a.mp3')
+    for task in (long_task, unknown, short, stored):
+        job_scheduler.put(task)
+    # A file from the storage costs nothing, an unknown duration costs sched_unknown_duration_sec
+    assert get_all(job_scheduler, 4) == [stored, short, unknown, long_task]
+
+
+def test_waiting_job_ages(clock):
+    job_scheduler = JobScheduler(10)
+    long_task = Task(2, 1200)
+    job_scheduler.put(long_task)
+    # 1200 - 10 * 100 = 200 < 300
+    clock.now += 100
+    short = Task(3, 300)
+    job_scheduler.put(short)
+    assert get_all(job_scheduler, 2) == [long_task, short]
+
+
+def test_equal_scores_keep_fifo(clock):
+    job_scheduler = JobScheduler(10)
+    first, second = Task(2, 300), Task(3, 300)
+    job_scheduler.put(first)
+    job_scheduler.put(second)
+    assert get_all(job_scheduler, 2) == [first, second]
+
+
+def test_share_penalty(clock):
+    job_scheduler = JobScheduler(10)
+    running = Task(2, 60)
+    job_scheduler.put(running)
+    assert job_scheduler.get(block=False) is running
+    # The user already has a running job: 60 + 900 > 600
+    same_user, other_user = Task(2, 60), Task(3, 600)
+    job_scheduler.put(same_user)
+    job_scheduler.put(other_user)
+    assert job_scheduler.get(block=False) is other_user
+    # The penalty is gone when the running job has finished
+    running.finish()
+    assert job_scheduler.active_per_user == {3: 1}
+    job_scheduler.put(Task(4, 120))
+    assert job_scheduler.get(block=False) is same_user
+
+
+def test_admin_lane(clock):
+    job_scheduler = JobScheduler(10, is_admin=lambda message: message.from_user.id == 7)
+    user_task, admin_task = Task(2, 60), Task(7, 1800)
+    job_scheduler.put(user_task)
+    job_scheduler.put(admin_task)
+    # 1800 - 1800 bonus = 0 < 60
+    assert get_all(job_scheduler, 2) == [admin_task, user_task]
+
+
+def test_lane_is_found_at_put(clock):
+    checked = []
+
+    def is_admin(message):
+        checked.append(message.from_user.id)
+        return False
+
+    job_scheduler = JobScheduler(10, is_admin=is_admin)
+    for user_id in (2, 3, 4):
+        job_scheduler.put(Task(user_id, 60))
+    get_all(job_scheduler, 3)
+    assert checked == [2, 3, 4]
@@ -0,0 +1,74 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from config_parse import Config
+from database.async_db_access import DBCommand
+from downloader import DownloadTask
+from storage_manager import StorageManager
+
+
+class FakeDB(object):
+    """Answers every select with the same rows"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def put(self, db_message, block=True, timeout=None):
+        if db_message.command is DBCommand.Select:
+            db_message.result_queue.put(self.rows)
+
+
+@pytest.fixture
+def mp3_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config.load().advanced, 'orphan_max_age_sec', 60)
+    return tmp_path
+
+
+def make_files(directory, names, age_sec=3600):
+    for name in names:
+        path = directory / name
+        path.write_bytes(b'0')
+        os.utime(path, (path.stat().st_atime - age_sec, path.stat().st_mtime - age_sec))
+
+
+def test_sweep_keeps_outputs(mp3_dir):
+    stored = ['Song.mp3', 'Mr. Talk.m4a']
+    leftovers = ['Song.webm', 'Song.f251.webm', 'Mr. Talk.webm', 'Other.webm.part', 'Other.webm.ytdl',
+                 'Other.f140.m4a.part-Frag7', 'Other.temp.mp3']
+    # Outputs which are not registered yet (sending, waiting for the rest of a batch) and files of other jobs
+    kept = ['Lecture.m4a', 'Podcast.webm', 'Song (Live).webm', 'Songbird.m4a']
+    make_files(mp3_dir, stored + leftovers + kept)
+    storage = StorageManager(str(mp3_dir), FakeDB([(str(mp3_dir / name),) for name in stored]))
+    storage.sweep_orphans()
+    assert sorted(os.listdir(mp3_dir)) == sorted(stored + kept)
+
+
+def test_sweep_keeps_fresh_and_pinned_files(mp3_dir):
+    make_files(mp3_dir, ['Old.webm.part', 'Pinned.webm.part'])
+    make_files(mp3_dir, ['Fresh.webm.part'], age_sec=0)
+    storage = StorageManager(str(mp3_dir), FakeDB([]))
+    storage.pin(str(mp3_dir / 'Pinned.webm.part'))
+    storage.sweep_orphans()
+    assert sorted(os.listdir(mp3_dir)) == ['Fresh.webm.part', 'Pinned.webm.part']
+
+
+@pytest.mark.parametrize('in_batch', [False, True])
+def test_pin_is_released_when_the_task_is_dropped(mp3_dir, monkeypatch, in_batch):
+    monkeypatch.setattr(Config.load().advanced, 'auto_delete_files', False)
+    make_files(mp3_dir, ['Song.mp3'])
+    storage = StorageManager(str(mp3_dir), FakeDB([(1, str(mp3_dir / 'Song.mp3'), 128)]))
+    task = DownloadTask(SimpleNamespace(from_user=SimpleNamespace(id=2)), None, 'link', 'key')
+    task.batch = object() if in_batch else None
+    # What the probe stage does on a storage hit
+    file_path, _ = storage.lookup('key')
+    task.on_file_release(lambda: storage.unpin(file_path))
+    assert storage._is_pinned(file_path)
+    # Failed before the upload stage
+    task.finish()
+    if in_batch:
+        # The batch sends the item later, it releases the file itself
+        assert storage._is_pinned(file_path)
+        task.release_file()
+    assert not storage._is_pinned(file_path)
@@ -0,0 +1,90 @@
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from webhook_server import SECRET_HEADER, UpdateIntake, make_webhook_handler
+
+PATH = '/telegram-webhook'
+SECRET = 'test-secret'
+
+
+class BlockingBot(object):
+    """process_new_updates waits until the test releases it, so the intake queue fills up"""
+
+    def __init__(self):
+        self.updates = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def process_new_updates(self, updates):
+        self.started.set()
+        self.release.wait(5)
+        self.updates.extend(updates)
+
+
+@pytest.fixture
+def webhook():
+    bot = BlockingBot()
+    intake = UpdateIntake(bot, size=1, threads=1)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_webhook_handler(intake, PATH, SECRET))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server.server_address[1], bot
+    bot.release.set()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    intake.close()
+
+
+def post(port: int, body: bytes, path: str = PATH, secret: str = SECRET) -> int:
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        headers = {SECRET_HEADER: secret, 'Content-Type': 'application/json'}
+        connection.request('POST', path, body=body, headers=headers)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def update(update_id: int) -> bytes:
+    return json.dumps({'update_id': update_id}).encode()
+
+
+def test_wrong_path(webhook):
+    port, _ = webhook
+    assert post(port, update(1), path='/other') == 404
+
+
+def test_wrong_secret(webhook):
+    port, bot = webhook
+    assert post(port, update(1), secret='guess') == 403
+    assert post(port, update(1), secret='') == 403
+    assert not bot.started.is_set()
+
+
+@pytest.mark.parametrize('body', [b'', b'{not json', b'x' * (1024 ** 2 + 1)], ids=['empty', 'not-json', 'too-big'])
+def test_bad_body(webhook, body):
+    port, bot = webhook
+    assert post(port, body) == 400
+    assert not bot.started.is_set()
+
+
+def test_update_is_accepted(webhook):
+    port, bot = webhook
+    assert post(port, update(1)) == 200
+    assert bot.started.wait(5)
+    bot.release.set()
+
+
+def test_full_intake_answers_503(webhook):
+    port, bot = webhook
+    # The only consumer is busy with the first update, the second one waits in the queue of one place
+    assert post(port, update(1)) == 200
+    assert bot.started.wait(5)
+    assert post(port, update(2)) == 200
+    assert post(port, update(3)) == 503
+    bot.release.set()